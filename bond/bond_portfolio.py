@@ -0,0 +1,126 @@
+import datetime as dt
+
+
+class BondPortfolio(object):
+    """
+    Book of fixed rate bond positions that keeps running sums of the market value weighted
+    analytics so book level numbers can be refreshed in O(1) on every trade or price tick
+    """
+
+    def __init__(self, trade_dt=None):
+        ''' Constructor
+        Parameters
+        ==========
+        trade_dt : date
+            trade date used for all yield and duration calcs, DEFAULT = today
+
+        Return
+        ======
+        NONE
+        '''
+        self._trade_dt = trade_dt or dt.datetime.today()
+        # name --> dict with bond, quantity, price and cached per unit analytics
+        self._positions = {}
+        # running sums over all positions
+        self._mv = 0.
+        self._yld_mv = 0.
+        self._dur_mv = 0.
+
+    def _calcAnalytics(self, pos):
+        ''' Solves yield and duration for one unit of the bond at its current price.
+            Only called when the bond's price or the trade date changes
+        '''
+        ytm = pos['bond'].getYield(pos['px'], self._trade_dt)
+        pos['yld'] = ytm
+        pos['dur'] = pos['bond'].calcDurationModified(pos['px'], self._trade_dt, ytm=ytm)
+
+    def _addContribution(self, pos, sign=1):
+        mv = pos['qty'] * pos['px']
+        self._mv += sign * mv
+        self._yld_mv += sign * mv * pos['yld']
+        self._dur_mv += sign * mv * pos['dur']
+
+    def setPosition(self, name, bond, qty, px):
+        ''' Adds a new position or replaces an existing one
+        Parameters
+        ==========
+        name : str
+            identifier of the position
+        bond : FixedRateBond
+            instrument held
+        qty : float
+            number of bonds held
+        px : float
+            current market price of the bond
+
+        Return
+        ======
+        NONE
+        '''
+        if name in self._positions:
+            self.removePosition(name)
+        pos = {'bond': bond, 'qty': qty, 'px': px}
+        self._calcAnalytics(pos)
+        self._positions[name] = pos
+        self._addContribution(pos)
+
+    def removePosition(self, name):
+        pos = self._positions.pop(name)
+        self._addContribution(pos, sign=-1)
+
+    def trade(self, name, qty):
+        ''' Changes the quantity of a position by qty, per unit analytics are unchanged
+            so no yield or duration is recalculated
+        '''
+        pos = self._positions[name]
+        self._addContribution(pos, sign=-1)
+        pos['qty'] += qty
+        self._addContribution(pos)
+
+    def updatePrice(self, name, px):
+        ''' Applies a price tick to a position, only this bond's analytics are recalculated '''
+        pos = self._positions[name]
+        if px == pos['px']:
+            return
+        self._addContribution(pos, sign=-1)
+        pos['px'] = px
+        self._calcAnalytics(pos)
+        self._addContribution(pos)
+
+    def setTradeDate(self, trade_dt):
+        ''' Rolls the book to a new trade date, every bond's inputs change so all are recalculated '''
+        if trade_dt == self._trade_dt:
+            return
+        self._trade_dt = trade_dt
+        for pos in self._positions.values():
+            self._calcAnalytics(pos)
+        self.rebuild()
+
+    def rebuild(self):
+        ''' Recomputes the running sums from the cached per position analytics,
+            can be used periodically to clear accumulated floating point drift
+        '''
+        self._mv = 0.
+        self._yld_mv = 0.
+        self._dur_mv = 0.
+        for pos in self._positions.values():
+            self._addContribution(pos)
+
+    def getMarketValue(self):
+        return self._mv
+
+    def getYield(self):
+        ''' Market value weighted yield of the book '''
+        if not self._mv:
+            return 0.
+        return self._yld_mv / self._mv
+
+    def getDuration(self):
+        ''' Market value weighted duration of the book '''
+        if not self._mv:
+            return 0.
+        return self._dur_mv / self._mv
+
+    def getDV01(self):
+        ''' Dollar value of a 1bp move in rates for the whole book '''
+        return self._dur_mv * 0.0001
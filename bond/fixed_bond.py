@@ -89,9 +89,11 @@ class FixedRateBond(Bond):
         '''
         return calcYieldToDate(px, self._par, self._mat_dt, self._cpn, freq=self._freq, start_date=trade_dt)
     
-    def calcDurationModified(self, px, trade_dt=dt.datetime.today()):
+    def calcDurationModified(self, px, trade_dt=dt.datetime.today(), ytm=None):
         # Units: for every 1% movement in interest rates, bond in price by 2.621%.
-        ytm = self.getYield(px, trade_dt)
+        # ytm can be passed in if already solved for this price to skip the yield calc
+        if ytm is None:
+            ytm = self.getYield(px, trade_dt)
         dur = 0
         for cf in self._cash_flows:
             t = (cf[0] - trade_dt).days / 365
@@ -101,9 +103,10 @@ class FixedRateBond(Bond):
             dur += (d_temp / px)
         return dur
     
-    def calcDurationMacauley(self, px, trade_dt=dt.datetime.today()):
+    def calcDurationMacauley(self, px, trade_dt=dt.datetime.today(), ytm=None):
         # Weighted average # of yrs until the pv of the bond's cash flows equals amount paid for the bond
-        ytm = self.getYield(px, trade_dt)
+        if ytm is None:
+            ytm = self.getYield(px, trade_dt)
         dur = 0
         for cf in self._cash_flows:
             t = (cf[0] - trade_dt).days / 365
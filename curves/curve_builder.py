@@ -0,0 +1,90 @@
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+
+from utils.fi_funcs import createZeroCurve
+
+
+def _bootstrapChunk(chunk):
+    ''' Worker for createZeroCurves, bootstraps every par curve in the chunk and
+        returns the resulting zero curves as flat columns
+    Parameters
+    ==========
+    chunk : list of tuples
+        (position, ParCurve) pairs, position is the index of the key in the batch
+
+    Return
+    ======
+    tuple of arrays
+        key positions, maturities and zero rates of all points in the chunk
+    '''
+    pos, mats, rates = [], [], []
+    for p, pc in chunk:
+        zc = createZeroCurve(pc, pc.trade_dt)
+        pos.extend([p] * len(zc.mats))
+        mats.extend(zc.mats)
+        rates.extend(zc.rates)
+    return (np.array(pos, dtype=np.int32), np.array(mats, dtype='datetime64[us]'),
+            np.array(rates, dtype=np.float64))
+
+
+def createZeroCurves(par_curves, processes=None, chunksize=None, key_names=('trade_dt', 'currency')):
+    ''' Bootstraps a batch of independent par curves (ex: one per date and currency)
+        across a process pool
+    Parameters
+    ==========
+    par_curves : dict or list of tuples
+        key --> ParCurve, keys are usually (trade_dt, currency) tuples
+    processes : int
+        number of worker processes, 1 runs in the current process, DEFAULT = cpu count
+    chunksize : int
+        number of curves sent to a worker at once, DEFAULT = spread evenly to ~4 chunks per worker
+    key_names : tuple of str
+        column names for the parts of the keys, if keys are not tuples a single
+        'key' column is used
+
+    Return
+    ======
+    DataFrame
+        one row per curve point with the key columns, 'mat' and 'rate', in the order
+        the curves were passed in
+    '''
+    items = list(par_curves.items()) if isinstance(par_curves, dict) else list(par_curves)
+    keys = [k for k, pc in items]
+    if processes is None:
+        processes = mp.cpu_count()
+    if chunksize is None:
+        chunksize, extra = divmod(len(items), processes * 4)
+        chunksize += 1 if extra else 0
+    chunksize = max(chunksize, 1)
+    chunks = [[(p, items[p][1]) for p in range(s, min(s + chunksize, len(items)))]
+              for s in range(0, len(items), chunksize)]
+
+    # each chunk's points are appended to the output columns as soon as it is done
+    pos, mats, rates = [], [], []
+    if processes == 1 or len(chunks) <= 1:
+        results = map(_bootstrapChunk, chunks)
+        for p, m, r in results:
+            pos.append(p)
+            mats.append(m)
+            rates.append(r)
+    else:
+        with mp.Pool(processes) as pool:
+            for p, m, r in pool.imap(_bootstrapChunk, chunks):
+                pos.append(p)
+                mats.append(m)
+                rates.append(r)
+    pos = np.concatenate(pos) if pos else np.array([], dtype=np.int32)
+    mats = np.concatenate(mats) if mats else np.array([], dtype='datetime64[us]')
+    rates = np.concatenate(rates) if rates else np.array([], dtype=np.float64)
+
+    cols = {}
+    if keys and isinstance(keys[0], tuple):
+        for n, name in enumerate(key_names):
+            part = [k[n] for k in keys]
+            cols[name] = np.array(part)[pos] if part else np.array(part)
+    else:
+        cols['key'] = np.array(keys, dtype=object)[pos]
+    cols['mat'] = mats
+    cols['rate'] = rates
+    return pd.DataFrame(cols)
@@ -1,6 +1,8 @@
 import sys, pdb
 sys.path.append("/home/ubuntu/workspace/finance_lib")
 
+import threading
+import itertools
 import numpy as np
 import pandas as pd
 import datetime as dt
@@ -13,6 +15,18 @@ from dx.frame import get_year_deltas
 # fwd rate - rate from one period in time in the future to a second period of time in the future
 # par rate - rate at a given maturity matching the YTM of a coupon paying bond at that maturity
 
+# global counter so every published curve snapshot gets a unique, increasing version
+_curve_versions = itertools.count(1)
+
+
+def _freezeCurve(curve):
+    ''' returns an immutable copy of a zero or fwd curve stamped with a new version '''
+    frozen = curve.__class__(tuple(curve.mats), tuple(curve.rates))
+    frozen._frozen = True
+    frozen.version = next(_curve_versions)
+    return frozen
+
+
 class ZeroCurve(object):
     """
     ZeroCurve object - handles basic nominal discounting
@@ -34,11 +48,24 @@ class ZeroCurve(object):
             raise ValueError('Zero curve and maturities must be equal length')
         self.mats = mats
         self.rates = rates
+        # only frozen snapshots carry a version, see freeze()
+        self._frozen = False
+        self.version = None
     
     def addRate(self, mat, rt):
+        if self._frozen:
+            raise ValueError('Cannot add rates to a frozen curve, publish a new version instead')
         self.mats.append(mat)
         self.rates.append(rt)
     
+    def freeze(self):
+        ''' Returns an immutable, versioned snapshot of the curve that can be shared
+            between threads without copying
+        '''
+        if self._frozen:
+            return self
+        return _freezeCurve(self)
+    
     def getZeroRate(self, mat):
         """
         Get the zero rate at a particular maturity point, must be interior.
@@ -72,6 +99,8 @@ class ZeroCurve(object):
         :param mat: float
         :return: float
         """
+        # utils.fi_funcs imports this module, so its names may not be bound yet
+        from utils.fi_funcs import calcDiscountFactor
         r = self.getZeroRate(mat)
         mat = get_year_deltas([trade_dt, mat])[-1]
         return calcDiscountFactor(mat, r)
@@ -120,11 +149,21 @@ class FwdCurve(object):
             raise ValueError('Fwd curve and maturities must be equal length')
         self.mats = mats
         self.rates = rates
+        self._frozen = False
+        self.version = None
     
     def addRate(self, mat, rt):
+        if self._frozen:
+            raise ValueError('Cannot add rates to a frozen curve, publish a new version instead')
         self.mats.append(mat)
         self.rates.append(rt)
     
+    def freeze(self):
+        ''' Returns an immutable, versioned snapshot of the curve '''
+        if self._frozen:
+            return self
+        return _freezeCurve(self)
+    
     def createSpotCurve(self, trade_dt):
         ''' will make a spot curve (aka zero curve) from a fwd curve
             Assumes that trade_dt will be before first maturity on curve
@@ -194,4 +233,47 @@ class ParCurve(object):
                 return ((1-fac)*prev_par) + (fac*self.rates[pos])
             prev_mat = self.mats[pos]
             prev_par = self.rates[pos]
-    
\ No newline at end of file
+    
+
+
+class CurveHandle(object):
+    """
+    Curve Handle object - holds the currently published snapshot of a curve.
+    Readers call get() and keep using the snapshot they got, the builder
+    publishes a new version with publish() which swaps the reference atomically
+    """
+    def __init__(self, curve=None):
+        ''' Constructor
+        Parameters
+        ==========
+        curve : ZeroCurve or FwdCurve
+            optional initial curve, will be frozen
+        Return
+        ======
+        NONE
+        '''
+        self._lock = threading.Lock()
+        self._curve = None
+        if curve is not None:
+            self.publish(curve)
+
+    def publish(self, curve):
+        ''' Freezes the curve and makes it the current version, returns the snapshot
+            Later changes to a mutable curve passed in do not affect the published one
+        '''
+        snapshot = curve.freeze()
+        with self._lock:
+            # versions only move forward even if an older snapshot is republished
+            if self._curve is not None and snapshot.version <= self._curve.version:
+                snapshot = _freezeCurve(snapshot)
+            self._curve = snapshot
+        return snapshot
+
+    def get(self):
+        ''' Returns the current snapshot, no locking needed on the read side '''
+        return self._curve
+
+    @property
+    def version(self):
+        curve = self._curve
+        return curve.version if curve is not None else None
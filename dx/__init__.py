@@ -1,5 +1,6 @@
 import pdb
 from .frame import *
+from .solvers import *
 from .models import *
 from .valuation import *
 from .analytical import *
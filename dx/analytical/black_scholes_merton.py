@@ -1,7 +1,7 @@
 from math import log, exp, sqrt
 from scipy import stats
-from scipy.optimize import fsolve
 from ..frame import market_environment
+from ..solvers import newton
 
 
 class BSM_european_option(object):
@@ -104,19 +104,26 @@ class BSM_european_option(object):
 
     def imp_vol(self, price, otype='call', volatility_est=0.2):
         ''' Return implied volatility given option price. '''
-        me = market_environment('iv', self.pricing_date)
-        me.add_environment(self.mar_env)
+        me = self.mar_env.derive('iv')
         me.add_constant('volatility', volatility_est)
         option = BSM_european_option('ivc', me)
         option.update_ttm()
 
+        if otype not in ('call', 'put'):
+            raise ValueError('No valid option type.')
+
         def difference(volatility_est):
             option.volatility = volatility_est
             if otype == 'call':
                 return option.call_value() - price
-            if otype == 'put':
-                return (option.put_value() - price) ** 2
-            else:
-                raise ValueError('No valid option type.')
-        iv = fsolve(difference, volatility_est)[0]
+            return option.put_value() - price
+
+        def vega(volatility_est):
+            # call and put share the same vega
+            option.volatility = volatility_est
+            return option.vega()
+        # bracketed Newton with analytic vega, falls back to
+        # bisection for deep in/out of the money quotes
+        iv = newton(difference, volatility_est, fprime=vega,
+                    bracket=(1e-6, 5.0), tol=1e-10)
         return iv
\ No newline at end of file
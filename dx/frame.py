@@ -23,16 +23,26 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program. If not, see http://www.gnu.org/licenses/.
 #
-import math, pdb
+import copy, itertools, math, pdb, warnings, zlib
 import numpy as np
 import pandas as pd
 import datetime as dt
 import scipy.interpolate as sci
 import scipy.optimize as sco
+import scipy.special as scs
+from scipy.stats import qmc
+from collections import ChainMap, OrderedDict
 
 # Helper functions
 
 
+# cache of year fractions for time grids that are converted repeatedly,
+# keyed on the identity of the grid object; an entry holds the grid (so
+# its id cannot be reused) and a copy of its dates (to see changes)
+_year_deltas_cache = OrderedDict()
+_year_deltas_cache_size = 32
+
+
 def get_year_deltas(time_list, day_count=365.):
     ''' Return vector of floats with time deltas in years.
     Initial value normalized to zero.
@@ -46,14 +56,155 @@ def get_year_deltas(time_list, day_count=365.):
     Results
     =======
     delta_list : array
-        year fractions
+        year fractions; for array/DatetimeIndex time grids the (read-only)
+        result is cached so a grid shared by many objects is converted once
+    '''
+    if (isinstance(time_list, simulation_time_grid) and
+            day_count == time_list.day_count):
+        return time_list.year_fractions
+    cacheable = (isinstance(time_list, (np.ndarray, pd.DatetimeIndex)) and
+                 len(time_list) > 2)
+    if cacheable:
+        key = (id(time_list), day_count)
+        entry = _year_deltas_cache.get(key)
+        # guard against in place changes of (array) grids, a
+        # DatetimeIndex is immutable
+        if (entry is not None and entry[0] is time_list and
+                (entry[1] is None or np.array_equal(entry[1], time_list))):
+            _year_deltas_cache.move_to_end(key)
+            return entry[2]
+    if len(time_list) == 0:
+        return np.array([])
+    try:
+        if isinstance(time_list, np.ndarray) and time_list.dtype.kind == 'M':
+            times = time_list
+        elif isinstance(time_list[0], (dt.date, np.datetime64)):
+            times = pd.DatetimeIndex(time_list).values
+        else:
+            raise TypeError('No datetime objects.')
+        # floor division matches timedelta.days for partial days
+        days = (times - times[0]) // np.timedelta64(1, 'D')
+        delta_list = days / day_count
+    except (TypeError, ValueError):
+        start = time_list[0]
+        delta_list = np.array([(time - start).days / day_count
+                               for time in time_list])
+    if cacheable:
+        delta_list.setflags(write=False)
+        dates = time_list.copy() if isinstance(time_list, np.ndarray) else None
+        _year_deltas_cache[key] = (time_list, dates, delta_list)
+        if len(_year_deltas_cache) > _year_deltas_cache_size:
+            _year_deltas_cache.popitem(last=False)
+    return delta_list
+
+
+class simulation_time_grid(np.ndarray):
+    ''' Immutable time grid of a simulation, shared by reference between
+    all underlyings and valuation objects using it. Behaves like the
+    object array of datetime objects used before; slices and element-wise
+    operations return plain arrays.
+    Attributes
+    ==========
+    dates64 : array
+        dates as datetime64 values
+    year_fractions : array
+        year fractions from the first date (as get_year_deltas)
+    step_sizes : array
+        year fractions of the M - 1 time steps
+    date_index : dict
+        date --> index in the grid
+    day_count : float
+        number of days for a year
+    Methods
+    =======
+    get_index :
+        returns the index of a date in O(1)
     '''
-    delta_list = []
-    start = time_list[0]
-    for time in time_list:
-        days = (time - start).days
-        delta_list.append(days / day_count)
-    return np.array(delta_list)
+
+    def __new__(cls, dates, day_count=365.):
+        dates = list(dates)
+        obj = np.array(dates, dtype=object).view(cls)
+        obj.setflags(write=False)
+        obj.day_count = day_count
+        obj.dates64 = pd.DatetimeIndex(dates).values
+        obj.year_fractions = get_year_deltas(dates, day_count)
+        obj.step_sizes = np.diff(obj.year_fractions)
+        for a in (obj.dates64, obj.year_fractions, obj.step_sizes):
+            a.setflags(write=False)
+        obj.date_index = dict((d, i) for i, d in
+                              enumerate(obj.view(np.ndarray)))
+        return obj
+
+    def __reduce__(self):
+        return (simulation_time_grid,
+                (list(self.view(np.ndarray)), self.day_count))
+
+    def __getitem__(self, key):
+        return self.view(np.ndarray)[key]
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        inputs = [x.view(np.ndarray) if isinstance(x, simulation_time_grid)
+                  else x for x in inputs]
+        return getattr(ufunc, method)(*inputs, **kwargs)
+
+    def __contains__(self, date):
+        try:
+            return self._as_key(date) in self.date_index
+        except TypeError:
+            return False
+
+    @staticmethod
+    def _as_key(date):
+        if isinstance(date, np.datetime64):
+            return pd.Timestamp(date).to_pydatetime()
+        return date
+
+    def get_index(self, date):
+        ''' Returns the index of date in the grid; raises KeyError if the
+        date is not part of the grid. '''
+        return self.date_index[self._as_key(date)]
+
+
+# cache of time grids built by get_time_grid, so that objects with the
+# same simulation dates share a single grid object
+_time_grid_cache = OrderedDict()
+_time_grid_cache_size = 64
+
+
+def get_time_grid(start, end, frequency, special_dates=()):
+    ''' Returns the (cached) simulation_time_grid from start to end with
+    the given pandas frequency, including start, end and all special
+    dates later than start.
+    Parameters
+    ==========
+    start, end : datetime
+        first and last date of the grid
+    frequency : string
+        pandas frequency, e.g. 'B', 'W' or 'ME'
+    special_dates : list
+        additional dates (e.g. maturities) to include
+    Results
+    =======
+    time_grid : simulation_time_grid
+        shared grid object (do not modify)
+    '''
+    add_dates = tuple(sorted(set(d for d in special_dates if d > start)))
+    key = (start, end, frequency, add_dates)
+    time_grid = _time_grid_cache.get(key)
+    if time_grid is not None:
+        _time_grid_cache.move_to_end(key)
+        return time_grid
+    # pandas date_range function
+    dates = list(pd.date_range(start=start, end=end,
+                               freq=frequency).to_pydatetime())
+    # enhance time_grid by start, end and special_dates
+    dates.extend([start, end])
+    dates.extend(add_dates)
+    time_grid = simulation_time_grid(sorted(set(dates)))
+    _time_grid_cache[key] = time_grid
+    if len(_time_grid_cache) > _time_grid_cache_size:
+        _time_grid_cache.popitem(last=False)
+    return time_grid
 
 
 def sn_random_numbers(shape, antithetic=False, moment_matching=True, fixed_seed=False):
@@ -91,6 +242,604 @@ def sn_random_numbers(shape, antithetic=False, moment_matching=True, fixed_seed=
     else:
         return ran
 
+def get_stream_key(name):
+    ''' Return a stable integer for a stream name (str or int);
+    the builtin hash() is salted per process and cannot be used. '''
+    if isinstance(name, (int, np.integer)):
+        return int(name)
+    return zlib.crc32(str(name).encode('utf-8'))
+
+
+class random_number_service(object):
+    ''' Class providing reproducible, statistically independent streams of
+    standard normally distributed (pseudo-)random numbers based on the
+    counter-based Philox bit generator.
+    Every (risk factor, component, path block) triple has its own stream
+    derived from the seed, so the numbers of a block of paths can be
+    generated anywhere (e.g. in a worker process) and exactly match those
+    of a serial run with the same total number of paths.
+    Attributes
+    ==========
+    seed : int
+        base seed of all streams
+    block_size : int
+        number of paths per stream block
+    path_block_size : int
+        default number of paths per block of a streamed (block by block)
+        valuation, a multiple of block_size
+    antithetic : boolean
+        generation of antithetic variates (within each block)
+    moment_matching : boolean
+        matching of first and second moments per time step and block
+    Methods
+    =======
+    get_generator :
+        returns the NumPy Generator for a single stream
+    standard_normal :
+        returns an (M, I) array of standard normal numbers
+    standard_normal_chunks :
+        yields the same numbers in chunks of time steps
+    get_estimator :
+        returns an online_estimator for per path values
+    get_standard_error :
+        returns the standard error of the mean of per path values
+    '''
+
+    def __init__(self, seed=1000, block_size=8192, antithetic=False,
+                 moment_matching=True):
+        self.seed = seed
+        self.block_size = block_size
+        self.path_block_size = block_size
+        self.antithetic = antithetic
+        self.moment_matching = moment_matching
+
+    def get_generator(self, factor, component=0, block=0, fixed_seed=True):
+        ''' Returns the Generator for the given stream; with
+        fixed_seed=False fresh entropy is used instead of the seed. '''
+        spawn_key = (get_stream_key(factor), get_stream_key(component), block)
+        if fixed_seed is True:
+            seq = np.random.SeedSequence(self.seed, spawn_key=spawn_key)
+        else:
+            seq = np.random.SeedSequence(spawn_key=spawn_key)
+        return np.random.Generator(np.random.Philox(seq))
+
+    def get_blocks(self, paths, path_offset=0):
+        ''' Returns (block number, number of paths) pairs covering the
+        paths [path_offset, path_offset + paths). '''
+        if path_offset % self.block_size != 0:
+            raise ValueError('Path offset must be a multiple of the block size.')
+        first = path_offset // self.block_size
+        blocks = []
+        while paths > 0:
+            n = min(self.block_size, paths)
+            blocks.append((first + len(blocks), n))
+            paths -= n
+        return blocks
+
+    def standard_normal_chunks(self, shape, factor, component=0,
+                               path_offset=0, chunk_steps=None,
+                               fixed_seed=True, dtype=np.float64,
+                               times=None):
+        ''' Yields the (M, I) array of standard normal numbers of a stream
+        in consecutive chunks of chunk_steps time steps; concatenated they
+        equal standard_normal() for the same arguments.
+        Parameters
+        ==========
+        shape : tuple (M, I)
+            number of time steps and paths
+        factor : string
+            name of the risk factor
+        component : string or int
+            random component of the risk factor (e.g. 'volatility')
+        path_offset : int
+            number of the first path, a multiple of the block size
+        chunk_steps : int
+            number of time steps per chunk (default: all)
+        times : array
+            year fractions of the time grid; not needed for
+            pseudo-random numbers
+        '''
+        M, I = shape
+        if chunk_steps is None:
+            chunk_steps = max(M, 1)
+        blocks = self.get_blocks(I, path_offset)
+        gens = [self.get_generator(factor, component, b, fixed_seed)
+                for b, n in blocks]
+        for start in range(0, max(M, 1), chunk_steps):
+            k = min(chunk_steps, M - start)
+            ran = np.empty((k, I), dtype=dtype)
+            col = 0
+            for gen, (b, n) in zip(gens, blocks):
+                # the numbers are written into the columns of ran
+                block = ran[:, col:col + n]
+                if self.antithetic is True:
+                    # antithetic ensures mean = 0 for normal distribution
+                    h = (n + 1) // 2
+                    half = gen.standard_normal((k, h), dtype=dtype)
+                    block[:, :h] = half
+                    np.negative(half[:, :n - h], out=block[:, h:])
+                else:
+                    block[:] = gen.standard_normal((k, n), dtype=dtype)
+                if self.moment_matching is True and n > 1:
+                    # moment matching per time step ensures mean = 0 and
+                    # std dev = 1 across the paths of the block
+                    block -= block.mean(axis=1, keepdims=True)
+                    block /= block.std(axis=1, keepdims=True)
+                col += n
+            yield ran
+
+    def standard_normal(self, shape, factor, component=0, path_offset=0,
+                        fixed_seed=True, dtype=np.float64, times=None):
+        ''' Returns an (M, I) array of standard normal numbers for the given
+        risk factor and component (see standard_normal_chunks). '''
+        return next(self.standard_normal_chunks(
+            shape, factor, component, path_offset, None, fixed_seed, dtype,
+            times))
+
+    def get_estimator(self):
+        ''' Returns an online_estimator for values of paths of this
+        service. '''
+        return online_estimator()
+
+    def get_standard_error(self, values):
+        ''' Returns the standard error of the mean of the per path values
+        (e.g. discounted payoffs). '''
+        values = np.asarray(values, dtype=np.float64)
+        return np.std(values, ddof=1) / math.sqrt(len(values))
+
+
+class sobol_number_service(random_number_service):
+    ''' Class providing randomized quasi-random numbers: scrambled Sobol
+    sequences mapped to standard normal increments by Brownian bridge
+    construction over the time grid, so that the first (best distributed)
+    Sobol dimensions determine the coarse shape of the paths.
+    The paths are split into independently scrambled replicates (path j
+    belongs to replicate j % randomizations) which give an unbiased
+    estimate of the standard error. With R replicates the error of the
+    estimate divided by this standard error is Student t distributed
+    with R - 1 degrees of freedom: for the default R = 8, errors of up to
+    2.4 (95%) or 3.5 (99%) standard errors are expected. More replicates
+    give a more reliable standard error but fewer, less uniform points
+    per replicate (for a BSM call on 8192 paths, R = 32 doubles the error
+    of R = 8).
+    Attributes
+    ==========
+    seed : int
+        base seed of the scramblings
+    randomizations : int
+        number of independent replicates (default 8); a power of two
+        number of paths per replicate gives the best uniformity
+    Methods
+    =======
+    get_bridge :
+        returns the Brownian bridge construction schedule for a time grid
+    standard_normal :
+        returns an (M, I) array of standard normal increments
+    standard_normal_chunks :
+        yields the same numbers in chunks of time steps
+    get_estimator :
+        returns an online_estimator grouping the paths by replicate
+    get_standard_error :
+        returns the randomized QMC standard error of per path values
+    '''
+
+    def __init__(self, seed=1000, randomizations=8):
+        super(sobol_number_service, self).__init__(
+            seed, block_size=randomizations, antithetic=False,
+            moment_matching=False)
+        self.randomizations = randomizations
+        # streamed valuation in blocks of (about) 8192 paths, since every
+        # block sets up its own Sobol samplers
+        self.path_block_size = -(-8192 // randomizations) * randomizations
+
+    def get_bridge(self, times):
+        ''' Returns the Brownian bridge schedule for the year fractions
+        times as a list of (index, left, right, left weight, right weight,
+        std dev) tuples, in the order in which the points are filled. '''
+        n = len(times) - 1
+        schedule = [(n, 0, 0, 0., 0., math.sqrt(times[n] - times[0]))]
+        intervals = [(0, n)]
+        while intervals:
+            new_intervals = []
+            for l, r in intervals:
+                if r - l < 2:
+                    continue
+                m = (l + r) // 2
+                tl, tm, tr = times[l], times[m], times[r]
+                schedule.append((m, l, r, (tr - tm) / (tr - tl),
+                                 (tm - tl) / (tr - tl),
+                                 math.sqrt((tm - tl) * (tr - tm) / (tr - tl))))
+                new_intervals.extend([(l, m), (m, r)])
+            intervals = new_intervals
+        return schedule
+
+    def standard_normal_chunks(self, shape, factor, component=0,
+                               path_offset=0, chunk_steps=None,
+                               fixed_seed=True, dtype=np.float64,
+                               times=None):
+        ''' Yields the (M, I) array of standard normal increments in
+        consecutive chunks of chunk_steps time steps. Row t holds the
+        increment from times[t - 1] to times[t] (row 0 is zero), as used
+        by the simulation classes; times defaults to an equidistant grid.
+        '''
+        M, I = shape
+        R = self.randomizations
+        if path_offset % R != 0:
+            raise ValueError('Path offset must be a multiple of the '
+                             'number of randomizations.')
+        ran = np.zeros((M, I), dtype=dtype)
+        if times is None:
+            times = np.arange(M, dtype=np.float64)
+        times = np.asarray(times, dtype=np.float64)
+        if M > 1 and I > 0:
+            schedule = self.get_bridge(times)
+            sqrt_dt = np.sqrt(np.diff(times))[:, np.newaxis]
+            first = path_offset // R
+            spawn = (get_stream_key(factor), get_stream_key(component))
+            for r in range(min(R, I)):
+                count = len(range(r, I, R))
+                seq = np.random.SeedSequence(
+                    self.seed if fixed_seed is True else None,
+                    spawn_key=spawn + (r,))
+                sampler = qmc.Sobol(M - 1, scramble=True,
+                                    seed=np.random.Generator(
+                                        np.random.Philox(seq)))
+                with warnings.catch_warnings():
+                    # point counts other than powers of 2 are allowed
+                    warnings.simplefilter('ignore', UserWarning)
+                    if first > 0:
+                        sampler.fast_forward(first)
+                    u = sampler.random(count)
+                z = scs.ndtri(np.clip(u.T, 1e-15, 1 - 1e-15))
+                w = np.zeros((M, count))
+                for k, (m, l, rr, wl, wr, sd) in enumerate(schedule):
+                    w[m] = wl * w[l] + wr * w[rr] + sd * z[k]
+                ran[1:, r::R] = np.diff(w, axis=0) / sqrt_dt
+        if chunk_steps is None:
+            chunk_steps = max(M, 1)
+        for start in range(0, max(M, 1), chunk_steps):
+            yield ran[start:start + chunk_steps]
+
+    def get_estimator(self):
+        ''' Returns an online_estimator grouping the paths by replicate. '''
+        return online_estimator(self.randomizations)
+
+    def get_standard_error(self, values):
+        ''' Returns the standard error of the mean of the per path values
+        from the spread of the replicate means (with randomizations - 1
+        degrees of freedom, see the class docstring). '''
+        values = np.asarray(values, dtype=np.float64)
+        R = min(self.randomizations, len(values))
+        if R < 2:
+            raise ValueError('At least two randomizations are needed.')
+        means = np.array([values[r::R].mean() for r in range(R)])
+        return np.std(means, ddof=1) / math.sqrt(R)
+
+
+
+class online_estimator(object):
+    ''' Class to accumulate a Monte Carlo estimator over blocks of paths
+    in constant memory (count, sum and sum of squares, in float64).
+    Attributes
+    ==========
+    replicates : int
+        number of randomized QMC replicates (path j belongs to replicate
+        j % replicates); None for pseudo-random sampling
+    n : int
+        number of values accumulated
+    Methods
+    =======
+    update :
+        adds a block of per path values
+    merge :
+        adds the accumulated values of another estimator
+    mean :
+        returns the estimate
+    variance :
+        returns the sample variance of the values
+    standard_error :
+        returns the standard error of the estimate
+    '''
+
+    def __init__(self, replicates=None):
+        self.replicates = replicates
+        self.n = 0
+        # sums are taken around a shift (the first block mean) to avoid
+        # cancellation in the variance
+        self.shift = None
+        self.sum = 0.
+        self.sum_squares = 0.
+        if replicates is not None:
+            self.replicate_sums = np.zeros(replicates)
+            self.replicate_counts = np.zeros(replicates)
+
+    def update(self, values, path_offset=0):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if len(values) == 0:
+            return
+        if self.shift is None:
+            self.shift = values.mean()
+        centered = values - self.shift
+        self.n += len(values)
+        self.sum += centered.sum()
+        self.sum_squares += np.dot(centered, centered)
+        if self.replicates is not None:
+            index = (path_offset + np.arange(len(values))) % self.replicates
+            self.replicate_sums += np.bincount(
+                index, weights=values, minlength=self.replicates)
+            self.replicate_counts += np.bincount(
+                index, minlength=self.replicates)
+
+    def merge(self, other):
+        if other.n == 0:
+            return
+        if self.shift is None:
+            self.shift = other.shift
+        # move the other sums to this shift
+        d = other.shift - self.shift
+        self.sum_squares += (other.sum_squares + 2 * d * other.sum +
+                             other.n * d ** 2)
+        self.sum += other.sum + other.n * d
+        self.n += other.n
+        if self.replicates is not None:
+            self.replicate_sums += other.replicate_sums
+            self.replicate_counts += other.replicate_counts
+
+    def mean(self):
+        return self.shift + self.sum / self.n
+
+    def variance(self):
+        return ((self.sum_squares - self.sum ** 2 / self.n) /
+                (self.n - 1))
+
+    def standard_error(self):
+        if self.replicates is None:
+            return math.sqrt(self.variance() / self.n)
+        means = self.replicate_sums / self.replicate_counts
+        return np.std(means, ddof=1) / math.sqrt(self.replicates)
+
+class path_cache(object):
+    ''' Process-wide LRU cache of simulated paths under a byte budget. The
+    keys identify a simulation (model type, parameters, time grid, random
+    number streams, discount curve); the cached arrays are read-only.
+    Attributes
+    ==========
+    max_bytes : int
+        byte budget; least recently used entries are evicted beyond it
+    hits, misses, evictions : int
+        counters of the cache lookups and evictions
+    Methods
+    =======
+    get :
+        returns the cached arrays for a key or None
+    put :
+        stores arrays under a key
+    clear :
+        removes all entries (the counters are kept)
+    get_statistics :
+        returns the counters and the current size
+    '''
+
+    def __init__(self, max_bytes=2 ** 29):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, arrays, refs=()):
+        ''' Stores the dict arrays under key; refs are the objects whose
+        ids are part of the key, kept alive so the ids stay unique. '''
+        nbytes = sum(a.nbytes for a in arrays.values())
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key)[2]
+        # entries larger than the budget are not stored
+        store = nbytes <= self.max_bytes
+        # evict down to the (possibly changed) budget
+        while self.entries and (self.nbytes + store * nbytes >
+                                self.max_bytes):
+            self.nbytes -= self.entries.popitem(last=False)[1][2]
+            self.evictions += 1
+        if not store:
+            return
+        for a in arrays.values():
+            a.setflags(write=False)
+        self.entries[key] = (arrays, refs, nbytes)
+        self.nbytes += nbytes
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+    def get_statistics(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'entries': len(self.entries),
+                'bytes': self.nbytes, 'max_bytes': self.max_bytes}
+
+
+_path_cache = path_cache()
+
+
+def get_path_cache():
+    ''' Returns the process-wide path cache. '''
+    return _path_cache
+
+
+class correlated_shock_generator(object):
+    ''' Provides the correlated standard normal numbers of the risk factors
+    of a portfolio to all underlyings. Given a random number service, the
+    independent streams of the risk factors are drawn lazily, block of
+    steps by block of steps and only for the requested block of paths;
+    since the Cholesky matrix is lower triangular, risk factor i only
+    draws the streams of the risk factors 0, ..., i. Given an array of
+    independent numbers, it is transformed in place instead and every
+    underlying reads its own row as a view.
+    Attributes
+    ==========
+    cholesky_matrix : array (N, N)
+        Cholesky factor of the correlation matrix
+    random_numbers : array (N, M, I) or None
+        independent standard normal numbers per risk factor (owned by the
+        generator, overwritten with the correlated numbers)
+    block_steps : int
+        number of steps transformed at once (default: all for an array,
+        64 for a service)
+    service : random_number_service
+        source of the independent numbers if random_numbers is None
+    factors : list
+        names of the risk factors in the order of the Cholesky matrix
+    shape : tuple (M, I)
+        number of time steps and paths
+    fixed_seed : boolean
+        if False, the streams get one fresh seed for the generator
+    dtype : np.float32 or np.float64
+        type of the independent numbers
+    times : array
+        year fractions of the time grid (for Sobol sampling)
+    Methods
+    =======
+    get_shocks :
+        returns the correlated numbers of one risk factor
+    '''
+
+    def __init__(self, cholesky_matrix, random_numbers=None, block_steps=None,
+                 service=None, factors=None, shape=None, fixed_seed=True,
+                 dtype=np.float64, times=None):
+        self.cholesky_matrix = np.asarray(cholesky_matrix)
+        self.shocks = random_numbers
+        if random_numbers is not None:
+            N, M = random_numbers.shape[:2]
+            if block_steps is None:
+                block_steps = max(M, 1)
+            self.block_steps = block_steps
+            self.done = np.zeros(-(-M // block_steps), dtype=bool)
+            return
+        if fixed_seed is False:
+            # all underlyings (and repeated reads) see the same numbers
+            service = copy.copy(service)
+            service.seed = np.random.SeedSequence().entropy
+        self.service = service
+        self.factors = list(factors)
+        self.shape = shape
+        self.block_steps = 64 if block_steps is None else block_steps
+        self.dtype = dtype
+        self.times = times
+        # per risk factor: paths, first step and streams of the last block
+        self.states = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # streams are restarted after unpickling
+        state['states'] = {}
+        return state
+
+    def get_shocks(self, index, start=0, stop=None, path_offset=0,
+                   paths=None):
+        ''' Returns the (stop - start, paths) correlated numbers of risk
+        factor index (row of the Cholesky matrix) for the given steps and
+        paths; a view for an array of numbers. '''
+        if self.shocks is not None:
+            return self.get_array_shocks(index, start, stop, path_offset,
+                                         paths)
+        M, I = self.shape
+        stop = M if stop is None else min(stop, M)
+        if paths is None:
+            paths = I - path_offset
+        state = self.states.get(index)
+        if (state is None or state['paths'] != (path_offset, paths) or
+                start < state['start']):
+            # (re)start the streams, they draw the same numbers again
+            streams = [self.service.standard_normal_chunks(
+                (M, paths), factor, path_offset=path_offset,
+                chunk_steps=self.block_steps, fixed_seed=True,
+                dtype=self.dtype, times=self.times)
+                for factor in self.factors[:index + 1]]
+            state = {'paths': (path_offset, paths), 'streams': streams,
+                     'start': 0, 'block': np.zeros((0, paths), self.dtype)}
+            self.states[index] = state
+        parts = []
+        while True:
+            first = state['start']
+            last = first + len(state['block'])
+            if start < last and first < stop:
+                parts.append(state['block'][max(start - first, 0):
+                                            stop - first])
+            if stop <= last or last >= M:
+                break
+            block = np.zeros((min(self.block_steps, M - last), paths),
+                             self.dtype)
+            for weight, stream in zip(self.cholesky_matrix[index],
+                                      state['streams']):
+                ran = next(stream)
+                if weight != 0:
+                    block += weight * ran
+            state['start'], state['block'] = last, block
+        if len(parts) == 1:
+            return parts[0]
+        return np.concatenate(parts)
+
+    def get_array_shocks(self, index, start=0, stop=None, path_offset=0,
+                         paths=None):
+        ''' Returns the correlated numbers of get_shocks from the array of
+        numbers, transformed in place when first needed, as a view. '''
+        M = self.shocks.shape[1]
+        stop = M if stop is None else min(stop, M)
+        first, last = start // self.block_steps, -(-stop // self.block_steps)
+        for b in np.flatnonzero(~self.done[first:last]) + first:
+            block = self.shocks[:, b * self.block_steps:
+                                (b + 1) * self.block_steps]
+            block[:] = np.tensordot(self.cholesky_matrix, block, axes=1)
+            self.done[b] = True
+        end = None if paths is None else path_offset + paths
+        return self.shocks[index, start:stop, path_offset:end]
+
+
+def get_correlated_shocks(env):
+    ''' Returns the correlated shock generator of a market environment:
+    the list 'correlated_shocks' if given, otherwise a new generator for
+    (a copy of) the lists 'cholesky_matrix' and 'random_numbers'. '''
+    try:
+        return env.get_list('correlated_shocks')
+    except KeyError:
+        return correlated_shock_generator(
+            env.get_list('cholesky_matrix'),
+            np.array(env.get_list('random_numbers')))
+
+
+def get_random_number_service(env):
+    ''' Returns the random number service of a market environment: the
+    'random_number_service' constant if given, otherwise a new service
+    according to the 'sampling' constant ('pseudo' (default) or 'sobol'
+    with 'qmc_randomizations' replicates). '''
+    try:
+        return env.get_constant('random_number_service')
+    except KeyError:
+        pass
+    try:
+        sampling = env.get_constant('sampling')
+    except KeyError:
+        sampling = 'pseudo'
+    if sampling == 'pseudo':
+        return random_number_service()
+    if sampling == 'sobol':
+        try:
+            randomizations = env.get_constant('qmc_randomizations')
+        except KeyError:
+            randomizations = 8
+        return sobol_number_service(randomizations=randomizations)
+    raise ValueError("Sampling must be 'pseudo' or 'sobol'.")
+
+
 # Discounting classes
 
 class constant_short_rate(object):
@@ -117,9 +866,11 @@ class constant_short_rate(object):
         if short_rate < 0:
             raise ValueError('Short rate negative.')
 
-    def get_forward_rates(self, time_list, paths=None, dtobjects=True):
+    def get_forward_rates(self, time_list, paths=None, dtobjects=True,
+                          path_offset=0):
         ''' time_list either list of datetime objects or list of
-        year deltas as decimal number (dtobjects=False)
+        year deltas as decimal number (dtobjects=False); paths and
+        path_offset are not needed for deterministic rates
         '''
         forward_rates = np.array(len(time_list) * (self.short_rate,))
         return time_list, forward_rates
@@ -152,11 +903,37 @@ class deterministic_short_rate(object):
         return discount factors given a time list/array
     '''
 
+    # fitted to yield_list, not part of the curve's key in the path cache
+    uncached_attributes = frozenset(['yield_splines', 'fitted_yields'])
+
     def __init__(self, name, yield_list):
         self.name = name
         self.yield_list = np.array(yield_list)
         if np.sum(np.where(self.yield_list[:, 1] < 0, 1, 0)) > 0:
             raise ValueError('Negative yield(s).')
+        self.fit_yield_splines()
+
+    def fit_yield_splines(self):
+        ''' Fits the splines to yield_list once instead of on every call;
+        the cubic spline needs at least four yields. '''
+        dlist = get_year_deltas(self.yield_list[:, 0])
+        yields = self.yield_list[:, 1].astype(float)
+        self.yield_splines = {1: sci.splrep(dlist, yields, k=1)}
+        if len(dlist) > 3:
+            self.yield_splines[3] = sci.splrep(dlist, yields, k=3)
+        self.fitted_yields = self.yield_list.tolist()
+
+    def get_yield_spline(self, n):
+        ''' Returns the spline used for a time list of length n
+        (linear for up to three dates, cubic otherwise); the splines are
+        fitted again if yield_list was changed in place. '''
+        if self.yield_list.tolist() != self.fitted_yields:
+            self.fit_yield_splines()
+        k = 1 if n <= 3 else 3
+        if k not in self.yield_splines:
+            raise ValueError('At least four yields needed for cubic '
+                             'interpolation.')
+        return self.yield_splines[k]
 
     def get_interpolated_yields(self, time_list, dtobjects=True):
         ''' time_list either list of datetime objects or list of
@@ -166,50 +943,210 @@ class deterministic_short_rate(object):
             tlist = get_year_deltas(time_list)
         else:
             tlist = time_list
-        dlist = get_year_deltas(self.yield_list[:, 0])
-        if len(time_list) <= 3:
-            k = 1
-        else:
-            k = 3
-        yield_spline = sci.splrep(dlist, self.yield_list[:, 1], k=k)
+        yield_spline = self.get_yield_spline(len(time_list))
         yield_curve = sci.splev(tlist, yield_spline, der=0)
         yield_deriv = sci.splev(tlist, yield_spline, der=1)
         return np.array([time_list, yield_curve, yield_deriv]).T
 
-    def get_forward_rates(self, time_list, paths=None, dtobjects=True):
-        yield_curve = self.get_interpolated_yields(time_list, dtobjects=dtobjects)
+    def get_forward_rates(self, time_list, paths=None, dtobjects=True,
+                          path_offset=0):
         if dtobjects is True:
             tlist = get_year_deltas(time_list)
         else:
-            tlist = time_list
-        forward_rates = yield_curve[:, 1] + yield_curve[:, 2] * tlist
+            tlist = np.asarray(time_list, dtype=float)
+        yield_spline = self.get_yield_spline(len(time_list))
+        # forward rate f(t) = y(t) + y'(t) * t
+        forward_rates = (sci.splev(tlist, yield_spline, der=0) +
+                         sci.splev(tlist, yield_spline, der=1) * tlist)
         return time_list, forward_rates
 
     def get_discount_factors(self, time_list, paths=None, dtobjects=True):
-        discount_factors = []
         if dtobjects is True:
             dlist = get_year_deltas(time_list)
         else:
-            dlist = time_list
+            dlist = np.asarray(time_list, dtype=float)
         time_list, forward_rate = self.get_forward_rates(time_list, dtobjects=dtobjects)
-        for no in range(len(dlist)):
-            factor = 0.0
-            for d in range(no, len(dlist) - 1):
-                factor += ((dlist[d + 1] - dlist[d]) * (0.5 * (forward_rate[d + 1] + forward_rate[d])))
-            discount_factors.append(np.exp(-factor))
-        return time_list, discount_factors
+        # trapezoid integral of the forward rates from each date to the
+        # last date as reverse cumulative sum, O(n)
+        factor = np.zeros(len(dlist))
+        increments = np.diff(dlist) * 0.5 * (forward_rate[1:] + forward_rate[:-1])
+        factor[:-1] = np.cumsum(increments[::-1])[::-1]
+        return time_list, np.exp(-factor)
+
+    def get_discount_factors_batch(self, time_lists, paths=None, dtobjects=True):
+        ''' Discount factors for several time lists/arrays at once, with
+        one spline evaluation per spline order for all of them.
+        Returns a list of (time_list, discount_factors) tuples. '''
+        if len(time_lists) == 0:
+            return []
+        if dtobjects is True:
+            dlists = [get_year_deltas(tl) for tl in time_lists]
+        else:
+            dlists = [np.asarray(tl, dtype=float) for tl in time_lists]
+        lengths = np.array([len(d) for d in dlists])
+        dlist = np.concatenate(dlists)
+        # spline order depends on the length of each time list
+        order = np.repeat(np.where(lengths <= 3, 1, 3), lengths)
+        forward_rate = np.empty(len(dlist))
+        for k in np.unique(order):
+            sel = order == k
+            yield_spline = self.get_yield_spline(1 if k == 1 else 4)
+            forward_rate[sel] = (
+                sci.splev(dlist[sel], yield_spline, der=0) +
+                sci.splev(dlist[sel], yield_spline, der=1) * dlist[sel])
+        ends = np.cumsum(lengths) - 1
+        increments = np.zeros(len(dlist))
+        increments[:-1] = np.diff(dlist) * 0.5 * (forward_rate[1:] + forward_rate[:-1])
+        # no integration across the boundary between two time lists
+        increments[ends] = 0.
+        rev_cum = np.cumsum(increments[::-1])[::-1]
+        factor = rev_cum - np.repeat(rev_cum[ends], lengths)
+        discount_factors = np.split(np.exp(-factor), ends[:-1] + 1)
+        return list(zip(time_lists, discount_factors))
+
+
+class zero_curve_short_rate(object):
+    ''' Class for discounting based on a bootstrapped zero curve
+    (e.g. curves.ZeroCurve) with annually compounded zero rates that are
+    linearly interpolated between maturities (flat outside).
+    Attributes
+    ==========
+    name : string
+        name of the object
+    zero_curve : object with mats/rates lists
+        zero curve; the points are copied so later changes to the curve
+        do not affect this object
+    pricing_date : datetime object
+        date the curve's year fractions are measured from
+    Methods
+    =======
+    get_forward_rates :
+        return instantaneous forward rates given a time list/array
+    get_discount_factors :
+        return discount factors given a time list/array
+    '''
+
+    # not part of the curve's key in the path cache
+    uncached_attributes = frozenset(['cache'])
+
+    def __init__(self, name, zero_curve, pricing_date, cache_size=16):
+        self.name = name
+        self.pricing_date = pricing_date
+        # versioned curve snapshots allow caches to key on this object
+        self.version = getattr(zero_curve, 'version', None)
+        self.mat_deltas = get_year_deltas([pricing_date] + list(zero_curve.mats))[1:]
+        self.rates = np.array(zero_curve.rates, dtype=float)
+        if len(self.rates) == 0:
+            raise ValueError('Empty zero curve.')
+        if len(self.rates) > 1:
+            self.slopes = np.diff(self.rates) / np.diff(self.mat_deltas)
+        else:
+            self.slopes = np.zeros(0)
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    def get_curve_arrays(self, time_list, dtobjects=True):
+        ''' Returns the (forward rates, discount factors) arrays for a time
+        list/array. Results for array time grids are cached per grid object,
+        so simulation and valuation of the same grid compute them once. '''
+        cacheable = isinstance(time_list, (np.ndarray, pd.DatetimeIndex))
+        key = (id(time_list), dtobjects)
+        if cacheable and key in self.cache:
+            grid, arrays = self.cache[key]
+            if grid is time_list and len(arrays[0]) == len(time_list):
+                self.cache.move_to_end(key)
+                return arrays
+        if dtobjects is True:
+            tlist = get_year_deltas([self.pricing_date] + list(time_list))[1:]
+        else:
+            tlist = np.array(time_list, dtype=float)
+        r = np.interp(tlist, self.mat_deltas, self.rates)
+        # slope of the linear zero rate interpolation, zero outside the curve
+        seg = np.searchsorted(self.mat_deltas, tlist, side='right') - 1
+        inside = (seg >= 0) & (seg < len(self.slopes))
+        slope = np.where(inside, self.slopes[np.clip(seg, 0, max(len(self.slopes) - 1, 0))]
+                         if len(self.slopes) else 0., 0.)
+        # log P(t) = -t * log(1 + r(t)); forward = -d log P / dt
+        log_df = -tlist * np.log1p(r)
+        forward_rates = np.log1p(r) + tlist * slope / (1 + r)
+        # discount factors from the last date back to each date
+        discount_factors = np.exp(log_df[-1] - log_df) if len(tlist) else log_df
+        arrays = (forward_rates, discount_factors)
+        for a in arrays:
+            a.setflags(write=False)
+        if cacheable:
+            self.cache[key] = (time_list, arrays)
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return arrays
+
+    def get_forward_rates(self, time_list, paths=None, dtobjects=True,
+                          path_offset=0):
+        return time_list, self.get_curve_arrays(time_list, dtobjects)[0]
+
+    def get_discount_factors(self, time_list, paths=None, dtobjects=True):
+        return time_list, self.get_curve_arrays(time_list, dtobjects)[1]
 
 
 # Market environment class
 
+# global counter for environment versions, a change anywhere in a chain
+# of environments always yields a version larger than all previous ones
+_env_versions = itertools.count(1)
+
+
+class _environment_layer(dict):
+    ''' Dictionary holding the keys set locally on a market environment;
+    every change stamps the owning environment with a new version. '''
+
+    def __init__(self, env):
+        super(_environment_layer, self).__init__()
+        self.env = env
+
+    def _touch(self):
+        # the attribute is missing while unpickling
+        env = getattr(self, 'env', None)
+        if env is not None:
+            env._stamp = next(_env_versions)
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self._touch()
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._touch()
+
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self._touch()
+
+    def pop(self, *args):
+        value = dict.pop(self, *args)
+        self._touch()
+        return value
+
+    def clear(self):
+        dict.clear(self)
+        self._touch()
+
+
 class market_environment(object):
     ''' Class to model a market environment relevant for valuation.
+    An environment can be layered on a parent environment: it then only
+    stores the keys set on it and looks up all other keys in the parent
+    (copy-on-write), e.g. for stress scenarios.
     Attributes
     ==========
     name: string
         name of the market environment
     pricing_date : datetime object
         date of the market environment
+    parent : market_environment
+        environment to look up keys not set locally (optional)
+    version : int
+        increases with every change of the environment or of any of its
+        parents; caches can key on (id(env), env.version)
     Methods
     =======
     add_constant :
@@ -227,14 +1164,30 @@ class market_environment(object):
     add_environment :
         adding and overwriting whole market environments
         with constants, lists and curves
+    derive :
+        returns a new environment layered on this one
     '''
 
-    def __init__(self, name, pricing_date):
+    def __init__(self, name, pricing_date, parent=None):
         self.name = name
         self.pricing_date = pricing_date
-        self.constants = {}
-        self.lists = {}
-        self.curves = {}
+        self.parent = parent
+        self._stamp = next(_env_versions)
+        # local layers first, then the layers of the parent chain
+        if parent is None:
+            parent_maps = ([], [], [])
+        else:
+            parent_maps = (parent.constants.maps, parent.lists.maps,
+                           parent.curves.maps)
+        self.constants = ChainMap(_environment_layer(self), *parent_maps[0])
+        self.lists = ChainMap(_environment_layer(self), *parent_maps[1])
+        self.curves = ChainMap(_environment_layer(self), *parent_maps[2])
+
+    @property
+    def version(self):
+        if self.parent is None:
+            return self._stamp
+        return max(self._stamp, self.parent.version)
 
     def add_constant(self, key, constant):
         self.constants[key] = constant
@@ -255,9 +1208,16 @@ class market_environment(object):
         return self.curves[key]
 
     def add_environment(self, env):
-        for key in env.curves:
-            self.curves[key] = env.curves[key]
-        for key in env.lists:
-            self.lists[key] = env.lists[key]
-        for key in env.constants:
-            self.constants[key] = env.constants[key]
\ No newline at end of file
+        # only references are copied into the local layers
+        self.curves.maps[0].update(env.curves)
+        self.lists.maps[0].update(env.lists)
+        self.constants.maps[0].update(env.constants)
+
+    def derive(self, name=None, pricing_date=None):
+        ''' Returns a new, empty environment layered on this one; keys
+        set on it leave this environment unchanged. '''
+        if name is None:
+            name = self.name
+        if pricing_date is None:
+            pricing_date = self.pricing_date
+        return market_environment(name, pricing_date, parent=self)
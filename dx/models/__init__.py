@@ -6,12 +6,14 @@ from .stoch_vol_jump_diffusion import stoch_vol_jump_diffusion
 from .square_root_diffusion import *
 from .mean_reverting_diffusion import mean_reverting_diffusion
 from .square_root_jump_diffusion import *
-from .sabr_stochastic_volatility import sabr_stochastic_volatility
+from .sabr_stochastic_volatility import sabr_stochastic_volatility, sabr_implied_vol, \
+    sabr_implied_vol_jacobian
 
 __all__ = ['simulation_class', 'general_underlying',
            'geometric_brownian_motion', 'jump_diffusion',
            'stochastic_volatility', 'stoch_vol_jump_diffusion',
            'square_root_diffusion', 'mean_reverting_diffusion',
            'square_root_jump_diffusion', 'square_root_jump_diffusion_plus',
-           'sabr_stochastic_volatility', 'srd_forwards',
-           'stochastic_short_rate']
\ No newline at end of file
+           'sabr_stochastic_volatility', 'sabr_implied_vol',
+           'sabr_implied_vol_jacobian', 'srd_forwards',
+           'srd_forwards_jacobian', 'stochastic_short_rate']
\ No newline at end of file
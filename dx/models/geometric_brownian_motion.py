@@ -19,8 +19,15 @@ class geometric_brownian_motion(simulation_class):
         updates parameters
     generate_paths :
         returns Monte Carlo paths given the market environment
+    generate_observed_paths :
+        returns the path values at the observation dates only
+    bridge_values :
+        samples values between two dates by a log-normal bridge
     '''
 
+    # the paths scale linearly in initial_value
+    homogeneous = True
+
     def __init__(self, name, mar_env, corr=False):
         super(geometric_brownian_motion, self).__init__(name, mar_env, corr)
 
@@ -47,42 +54,77 @@ class geometric_brownian_motion(simulation_class):
         M = len(self.time_grid)
         # number of paths
         I = self.paths
-        # array initialization for path simulation
-        paths = np.zeros((M, I))
-        # initialize first date with initial_value
-        paths[0] = self.initial_value
-        if self.correlated is False:
-            # if not correlated generate random numbers
-            rand = sn_random_numbers((1, M, I), fixed_seed=fixed_seed)
-        else:
-            # if correlated use random number object as provided
-            # in market environment
-            rand = self.random_numbers
+        # paths and random numbers
+        self.check_memory(M, I, 2)
 
         # forward rates for drift of process
-        forward_rates = self.discount_curve.get_forward_rates(self.time_grid, self.paths, dtobjects=True)[1]
+        forward_rates = self.discount_curve.get_forward_rates(
+            self.time_grid, self.paths, dtobjects=True,
+            path_offset=self.path_offset)[1]
+        # difference between two dates as year fractions
+        dt = np.diff(get_year_deltas(self.time_grid, day_count))
+        # rt = the drift factor, interpolated rate of each step
+        rt = (forward_rates[1:] + forward_rates[:-1]) / 2
+        if rt.ndim == 1:
+            rt = rt[:, np.newaxis]
+        # exact transition, log increment of each step:
+        # ln S(t) - ln S(t-1) = (rt - 0.5 * vol ** 2) * dt + vol * sqrt(dt) * z
+        drift = (rt - 0.5 * self.volatility ** 2) * dt[:, np.newaxis]
+        diffusion = (self.volatility * np.sqrt(dt))[:, np.newaxis]
+
+        rows = self.get_observation_rows()
+        if rows is not None:
+            self.instrument_values = self.generate_observed_paths(
+                rows, drift, diffusion, fixed_seed)
+            return
+
+        # own or correlated standard normal numbers for all steps
+        ran = self.get_diffusion_random_numbers(M, I, fixed_seed=fixed_seed)
+        # the log increments of all steps at once, accumulated with
+        # cumsum (in place in the path array)
+        paths = np.empty((M, I), dtype=self.dtype)
+        paths[0] = self.initial_value
+        log_paths = paths[1:]
+        np.multiply(ran[1:], diffusion, out=log_paths)
+        log_paths += drift
+        np.cumsum(log_paths, axis=0, out=log_paths)
+        np.exp(log_paths, out=log_paths)
+        log_paths *= self.initial_value
+        self.instrument_values = paths
+
+    def generate_observed_paths(self, rows, drift, diffusion, fixed_seed):
+        ''' Returns the values at the observation steps rows only; the log
+        increments are accumulated chunk by chunk of steps in a rolling
+        (float64) state. '''
+        M = len(self.time_grid)
+        I = self.paths
+        values = np.empty((len(rows), I), dtype=self.dtype)
+        log_s = np.zeros(I)
+        for start, ran in self.iter_diffusion_random_chunks(M, I, fixed_seed):
+            # row 0 carries no increment
+            first, end = max(start, 1), start + len(ran)
+            if end <= first:
+                continue
+            log_chunk = np.multiply(ran[first - start:],
+                                    diffusion[first - 1:end - 1],
+                                    dtype=np.float64)
+            log_chunk += drift[first - 1:end - 1]
+            np.cumsum(log_chunk, axis=0, out=log_chunk)
+            log_chunk += log_s
+            log_s = log_chunk[-1].copy()
+            for n, t in enumerate(rows):
+                if first <= t < end:
+                    values[n] = self.initial_value * np.exp(log_chunk[t - first])
+        values[0] = self.initial_value
+        return values
 
-        for t in range(1, len(self.time_grid)):
-            # select the right time slice from the relevant
-            # random number set
-            if self.correlated is False:
-                ran = rand[t]
-            else:
-                # A list of random numbers is generated for each member
-                # Cholesky correlation matrix then used to ensure the random numbers are appropriately correlated
-                # A matrix * the cholesky correlation matrix creates an array of correlated values
-                ran = np.dot(self.cholesky_matrix, rand[:, t, :])
-                ran = ran[self.rn_set]
-            dt = (self.time_grid[t] - self.time_grid[t - 1]).days / day_count
-            
-            # rt = the drift factor
-            # difference between two dates as year fraction
-            rt = (forward_rates[t - 1] + forward_rates[t]) / 2
-            
-            # No rate volatility - true Brownian motion
-            # paths[t] = paths[t - 1] + rt * dt + self.volatility * np.sqrt(dt) * ran
-            
-            # With rate volatility
-            paths[t] = paths[t - 1] * np.exp((rt - 0.5 * self.volatility ** 2) * dt + self.volatility * np.sqrt(dt) * ran)
-            # generate simulated values for the respective date
-        self.instrument_values = paths
\ No newline at end of file
+    def bridge_values(self, left, right, dt_left, dt_right, z):
+        ''' Samples the values at a new date by a Brownian bridge of the
+        log values; for a drift constant between the two dates the log
+        value is normal with the linearly interpolated mean and variance
+        vol ** 2 * dt_left * dt_right / (dt_left + dt_right). '''
+        dt = dt_left + dt_right
+        w = dt_left / dt
+        log_values = (1 - w) * np.log(left) + w * np.log(right)
+        log_values += self.volatility * math.sqrt(dt_left * dt_right / dt) * z
+        return np.exp(log_values)
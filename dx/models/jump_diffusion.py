@@ -1,5 +1,5 @@
 from ..frame import *
-from .simulation_class import simulation_class
+from .simulation_class import simulation_class, chunked_random_numbers
 
 
 class jump_diffusion(simulation_class):
@@ -21,6 +21,9 @@ class jump_diffusion(simulation_class):
         returns Monte Carlo paths given the market environment
     '''
 
+    # the paths scale linearly in initial_value
+    homogeneous = True
+
     def __init__(self, name, mar_env, corr=False):
         super(jump_diffusion, self).__init__(name, mar_env, corr)
         try:
@@ -60,54 +63,38 @@ class jump_diffusion(simulation_class):
         # number of paths
         I = self.paths
         # array initialization for path simulation
-        paths = np.zeros((M, I))
+        # paths and random numbers, the jumps are sparse
+        self.check_memory(M, I, 2)
+        paths = self.get_path_array(M, I)
         # initialize first date with initial_value
         paths[0] = self.initial_value
-        if self.correlated is False:
-            # if not correlated generate random numbers
-            sn1 = sn_random_numbers((1, M, I),
-                                    fixed_seed=fixed_seed)
-        else:
-            # if correlated use random number object as provided
-            # in market environment
-            sn1 = self.random_numbers
+        # own or (in a portfolio context) correlated random numbers
+        sn1 = chunked_random_numbers(
+            self.iter_diffusion_random_chunks(M, I, fixed_seed), M, I)
 
-        # Standard normally distributed seudo-random numbers
-        # for the jump component
-        sn2 = sn_random_numbers((1, M, I),
-                                fixed_seed=fixed_seed)
+        # jump times and sizes of all paths drawn up front; only the
+        # steps with jumps carry entries
+        bounds, jump_index, jump_factors = self.generate_jumps(fixed_seed,
+                                                               day_count)
 
         forward_rates = self.discount_curve.get_forward_rates(
-            self.time_grid, self.paths, dtobjects=True)[1]
+            self.time_grid, self.paths, dtobjects=True,
+            path_offset=self.path_offset)[1]
 
         
         # rj --> drift correction for the riskless rate so jumps maintain risk neutrality
         rj = self.lamb * (np.exp(self.mu + 0.5 * self.delt ** 2) - 1)
-        
-        for t in range(1, len(self.time_grid)):
-            # select the right time slice from the relevant
-            # random number set
-            if self.correlated is False:
-                ran = sn1[t]
-            else:
-                # only with correlation in portfolio context
-                # A list of random numbers is generated for each member
-                # Cholesky correlation matrix then used to ensure the random numbers are appropriately correlated
-                ran = np.dot(self.cholesky_matrix, sn1[:, t, :])
-                ran = ran[self.rn_set]
-            
-            # difference between two dates as year fraction
-            dt = (self.time_grid[t] - self.time_grid[t - 1]).days / day_count
-            
-            # Poisson distributed pseudo-random numbers for jump component
-            # will determine whether a jump occurs or not given lambda
-            poi = np.random.poisson(self.lamb * dt, I)
-            
+        dt = np.diff(get_year_deltas(self.time_grid, day_count))
+
+        for t in range(1, M):
             # Interpolated rate for this step
             rt = (forward_rates[t - 1] + forward_rates[t]) / 2
-            
+
             # next = prev * (e^(r - rj - 0.5 * sigma^2 * dt + sigma * sqrt(dt) * rand) + possible jump)
-            # (e^(mu + delta*rand) - 1) * poi --> will add jump compoenent if there is a jump, poi will be 0 if not
-            paths[t] = paths[t - 1] * (np.exp((rt - rj - 0.5 * self.volatility ** 2) * dt + 
-                        self.volatility * np.sqrt(dt) * ran) + (np.exp(self.mu + self.delt * sn2[t]) - 1) * poi)
-        self.instrument_values = paths
\ No newline at end of file
+            # (e^(mu + delta*rand) - 1) --> jump component, only added on the paths that jump in this step
+            factor = np.exp((rt - rj - 0.5 * self.volatility ** 2) * dt[t - 1] +
+                            self.volatility * np.sqrt(dt[t - 1]) * sn1[t])
+            jumps = slice(bounds[t], bounds[t + 1])
+            factor[jump_index[jumps]] += jump_factors[jumps]
+            paths[t] = paths[t - 1] * factor
+        self.instrument_values = self.get_stored_values(paths)
@@ -1,5 +1,40 @@
 from ..frame import *
 from .square_root_diffusion import square_root_diffusion
+from .simulation_class import chunked_random_numbers
+
+
+def linear_recursion(x0, a, e, out, max_log_range=30.):
+    ''' Solves x[t] = a[t - 1] * x[t - 1] + e[t - 1] for all steps without
+    a loop over the time steps.
+    Within a block of steps x[t] = A[t] * (x[s] + sum(e[k] / A[k])) with
+    the running products A of a; blocks end before the range of A exceeds
+    exp(max_log_range) so that the divisions stay well conditioned.
+    Parameters
+    ==========
+    x0 : float or array (I,)
+        start values
+    a : array (M - 1,)
+        coefficients, non-zero
+    e : array (M - 1, I)
+        increments
+    out : array (M, I)
+        receives x0 and the M - 1 recursion values; e may be out[1:]
+    '''
+    out[0] = x0
+    log_range = np.cumsum(np.abs(np.log(np.abs(a))))
+    s = 0
+    while s < len(a):
+        # largest block starting at step s within the range limit
+        limit = max_log_range + (log_range[s - 1] if s > 0 else 0.)
+        n = max(1, int(np.searchsorted(log_range, limit, side='right')) - s)
+        A = np.cumprod(a[s:s + n])[:, np.newaxis]
+        block = out[s + 1:s + n + 1]
+        np.divide(e[s:s + n], A, out=block)
+        np.cumsum(block, axis=0, out=block)
+        block += out[s]
+        block *= A
+        s += n
+    return out
 
 
 class mean_reverting_diffusion(square_root_diffusion):
@@ -13,52 +48,137 @@ class mean_reverting_diffusion(square_root_diffusion):
         market environment data for simulation
     corr : boolean
         True if correlated with other model object
+    truncation : boolean
+        if True, paths are floored at 0 (full truncation)
+    scheme : string
+        'euler' (default) for the Euler discretization or 'exact' for
+        the exact Gaussian (Ornstein-Uhlenbeck) transition
     Methods
     =======
     update :
         updates parameters
     generate_paths :
         returns Monte Carlo paths given the market environment
+    generate_observed_paths :
+        returns the path values at the observation dates only
+    bridge_values :
+        samples values between two dates by an Ornstein-Uhlenbeck bridge
     '''
 
-    def __init__(self, name, mar_env, corr=False, truncation=False):
+    def __init__(self, name, mar_env, corr=False, truncation=False,
+                 scheme='euler'):
         super(mean_reverting_diffusion,
               self).__init__(name, mar_env, corr)
+        if scheme not in ('euler', 'exact'):
+            raise ValueError("Scheme must be 'euler' or 'exact'.")
         self.truncation = truncation
+        self.scheme = scheme
+
+    def get_transition(self, dt):
+        ''' Returns the coefficients (a, b, c) of the step transitions
+        x[t] = a * x[t - 1] + b + c * z for the year fractions dt. '''
+        if self.scheme == 'exact' and self.kappa != 0:
+            a = np.exp(-self.kappa * dt)
+            b = self.theta * (1 - a)
+            c = self.volatility * np.sqrt((1 - a ** 2) / (2 * self.kappa))
+        else:
+            a = 1 - self.kappa * dt
+            b = self.kappa * self.theta * dt
+            c = self.volatility * np.sqrt(dt)
+        return a, b, c
 
     def generate_paths(self, fixed_seed=True, day_count=365.):
         if self.time_grid is None:
             self.generate_time_grid()
         M = len(self.time_grid)
         I = self.paths
-        paths = np.zeros((M, I))
-        paths_ = np.zeros_like(paths)
+        # two path arrays and random numbers
+        self.check_memory(M, I, 3)
+        dt = np.diff(get_year_deltas(self.time_grid, day_count))
+        a, b, c = self.get_transition(dt)
+        rows = self.get_observation_rows()
+
+        # Next value = a * prev value + b + c * stochastic variable; for
+        # Euler a = 1 - kappa * dt, b = kappa * theta * dt, c = vol * sqrt(dt)
+        # theta - prev val --> how far we are from long term value (theta)
+        # kappa --> how quickly we revert to mean
+        if self.truncation is False and np.all(a != 0):
+            # linear in the previous value: all steps at once
+            if rows is not None:
+                self.instrument_values = self.generate_observed_paths(
+                    rows, a, b, c, fixed_seed)
+                return
+            # own or correlated standard normal numbers for all steps
+            ran = self.get_diffusion_random_numbers(M, I, fixed_seed=fixed_seed)
+            paths = np.zeros((M, I), dtype=self.dtype)
+            np.multiply(ran[1:], c[:, np.newaxis], out=paths[1:])
+            paths[1:] += b[:, np.newaxis]
+            linear_recursion(self.initial_value, a, paths[1:], paths)
+            self.instrument_values = paths
+            return
+
+        # full truncation: the floor at 0 makes the recursion
+        # non-linear, so step through the time grid
+        ran = chunked_random_numbers(
+            self.iter_diffusion_random_chunks(M, I, fixed_seed), M, I)
+        paths = self.get_path_array(M, I)
+        paths_ = self.get_path_array(M, I, record=False)
         paths[0] = self.initial_value
         paths_[0] = self.initial_value
-        if self.correlated is False:
-            rand = sn_random_numbers((1, M, I),
-                                     fixed_seed=fixed_seed)
-        else:
-            rand = self.random_numbers
-            
-        pdb.set_trace()
-        for t in range(1, len(self.time_grid)):
-            dt = (self.time_grid[t] - self.time_grid[t - 1]).days / day_count
-            if self.correlated is False:
-                ran = rand[t]
-            else:
-                ran = np.dot(self.cholesky_matrix, rand[:, t, :])
-                ran = ran[self.rn_set]
-
-            # full truncation Euler discretization
-            # Truncation defines if paths have a floor of 0 or not
-            # Next value = prev value + vol * sotchastic variable + (kappa * (theta - prev val)
-            # theta - prev val --> how far we are from long term value (theta)      kappa --> how quickly we revert to mean
+        for t in range(1, M):
             if self.truncation is True:
-                paths_[t] = (paths_[t - 1] + self.kappa * (self.theta - np.maximum(0, paths_[t - 1])) * dt + 
-                            self.volatility * np.sqrt(dt) * ran)
+                paths_[t] = (paths_[t - 1] + b[t - 1] +
+                             (a[t - 1] - 1) * np.maximum(0, paths_[t - 1]) +
+                             c[t - 1] * ran[t])
                 paths[t] = np.maximum(0, paths_[t])
             else:
-                paths[t] = (paths[t - 1] + self.kappa * (self.theta - paths[t - 1]) * dt + 
-                            self.volatility * np.sqrt(dt) * ran)
-        self.instrument_values = paths
\ No newline at end of file
+                paths[t] = (a[t - 1] * paths[t - 1] + b[t - 1] +
+                            c[t - 1] * ran[t])
+        self.instrument_values = self.get_stored_values(paths)
+
+    def generate_observed_paths(self, rows, a, b, c, fixed_seed):
+        ''' Returns the values at the observation steps rows only; the
+        linear recursion is solved chunk by chunk of steps starting from
+        the (float64) state at the end of the previous chunk. '''
+        M = len(self.time_grid)
+        I = self.paths
+        values = np.empty((len(rows), I), dtype=self.dtype)
+        state = np.full(I, self.initial_value, dtype=np.float64)
+        for start, ran in self.iter_diffusion_random_chunks(M, I, fixed_seed):
+            # row 0 carries no increment
+            first, end = max(start, 1), start + len(ran)
+            if end <= first:
+                continue
+            out = np.empty((end - first + 1, I))
+            np.multiply(ran[first - start:], c[first - 1:end - 1, np.newaxis],
+                        out=out[1:])
+            out[1:] += b[first - 1:end - 1, np.newaxis]
+            linear_recursion(state, a[first - 1:end - 1], out[1:], out)
+            state = out[-1].copy()
+            for n, t in enumerate(rows):
+                if first <= t < end:
+                    values[n] = out[t - first + 1]
+        values[0] = self.initial_value
+        return values
+
+    def bridge_values(self, left, right, dt_left, dt_right, z):
+        ''' Samples the values at a new date from the Gaussian
+        Ornstein-Uhlenbeck transition conditional on the values at both
+        neighbouring dates; None with truncation (non-Gaussian paths). '''
+        if self.truncation is True:
+            return None
+
+        def variance(dt):
+            if self.kappa == 0:
+                return self.volatility ** 2 * dt
+            return (self.volatility ** 2 *
+                    (1 - math.exp(-2 * self.kappa * dt)) / (2 * self.kappa))
+        a_right = math.exp(-self.kappa * dt_right)
+        var_left, var_right = variance(dt_left), variance(dt_right)
+        # variance of the right value given the left one
+        var = a_right ** 2 * var_left + var_right
+        mean = self.theta + (left - self.theta) * math.exp(
+            -self.kappa * dt_left)
+        mean_right = self.theta + (mean - self.theta) * a_right
+        return (mean + a_right * var_left / var * (right - mean_right) +
+                math.sqrt(var_left * var_right / var) * z)
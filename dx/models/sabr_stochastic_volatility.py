@@ -1,5 +1,109 @@
 from ..frame import *
-from .simulation_class import simulation_class
+from .simulation_class import simulation_class, chunked_random_numbers
+from scipy.sparse import csr_matrix
+
+
+def sabr_implied_vol(forward, strike, expiry, alpha, beta, rho, vol_vol):
+    ''' Lognormal (Black) implied volatility approximation of Hagan et al.
+    (2002), vectorized; all arguments broadcast against each other (e.g.
+    strikes of shape (1, K) and expiries of shape (E, 1) for a surface).
+    Parameters
+    ==========
+    forward : float or array
+        forward (initial) value
+    strike : float or array
+        strike(s)
+    expiry : float or array
+        time(s) to expiry in years
+    alpha, beta, rho, vol_vol : float or array
+        SABR parameters
+    Returns
+    =======
+    sigma : array
+        implied volatilities
+    '''
+    forward, strike = np.asarray(forward, float), np.asarray(strike, float)
+    one_beta = 1. - beta
+    log_fk = np.log(forward / strike)
+    fk_beta = (forward * strike) ** (one_beta / 2.)
+    z = vol_vol / alpha * fk_beta * log_fk
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = np.log((np.sqrt(1. - 2 * rho * z + z ** 2) + z - rho) /
+                   (1 - rho))
+        # z / x tends to 1 - rho * z / 2 at the money
+        z_x = np.where(np.abs(z) > 1e-8, z / x, 1. - 0.5 * rho * z)
+    denominator = fk_beta * (1. + one_beta ** 2 / 24. * log_fk ** 2 +
+                             one_beta ** 4 / 1920. * log_fk ** 4)
+    correction = (one_beta ** 2 / 24. * alpha ** 2 / fk_beta ** 2 +
+                  0.25 * rho * beta * vol_vol * alpha / fk_beta +
+                  (2. - 3. * rho ** 2) / 24. * vol_vol ** 2)
+    return alpha / denominator * z_x * (1. + correction * expiry)
+
+
+def sabr_implied_vol_jacobian(forward, strike, expiry, alpha, beta, rho,
+                              vol_vol):
+    ''' Analytic partial derivatives of sabr_implied_vol (same arguments,
+    broadcast in the same way).
+    Returns
+    =======
+    jacobian : dict
+        'alpha', 'beta', 'rho', 'vol_vol' and 'forward' --> derivatives of
+        the implied volatilities
+    '''
+    forward, strike = np.asarray(forward, float), np.asarray(strike, float)
+    sigma = sabr_implied_vol(forward, strike, expiry, alpha, beta, rho,
+                             vol_vol)
+    one_beta = 1. - beta
+    log_fk = np.log(forward / strike)
+    fk_beta = (forward * strike) ** (one_beta / 2.)
+    # derivatives of fk_beta
+    fk_beta_b = -0.5 * np.log(forward * strike) * fk_beta
+    fk_beta_f = 0.5 * one_beta * fk_beta / forward
+    z = vol_vol / alpha * fk_beta * log_fk
+    z_a = -z / alpha
+    z_b = vol_vol / alpha * fk_beta_b * log_fk
+    z_v = fk_beta * log_fk / alpha
+    z_f = vol_vol / alpha * (fk_beta_f * log_fk + fk_beta / forward)
+    # z / x and its derivatives with respect to z and rho
+    root = np.sqrt(1. - 2 * rho * z + z ** 2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = np.log((root + z - rho) / (1 - rho))
+        x_r = (-z / root - 1.) / (root + z - rho) + 1. / (1 - rho)
+        atm = np.abs(z) <= 1e-8
+        z_x = np.where(atm, 1. - 0.5 * rho * z, z / x)
+        z_x_z = np.where(atm, -0.5 * rho, (x - z / root) / x ** 2)
+        z_x_r = np.where(atm, -0.5 * z, -z / x ** 2 * x_r)
+    # denominator = fk_beta * q
+    q = 1. + one_beta ** 2 / 24. * log_fk ** 2 + one_beta ** 4 / 1920. * log_fk ** 4
+    q_b = -(one_beta / 12. * log_fk ** 2 + one_beta ** 3 / 480. * log_fk ** 4)
+    q_f = (one_beta ** 2 / 12. * log_fk +
+           one_beta ** 4 / 480. * log_fk ** 3) / forward
+    d_d = fk_beta * q
+    d_b = fk_beta_b * q + fk_beta * q_b
+    d_f = fk_beta_f * q + fk_beta * q_f
+    correction = (one_beta ** 2 / 24. * alpha ** 2 / fk_beta ** 2 +
+                  0.25 * rho * beta * vol_vol * alpha / fk_beta +
+                  (2. - 3. * rho ** 2) / 24. * vol_vol ** 2)
+    c_a = (one_beta ** 2 / 12. * alpha / fk_beta ** 2 +
+           0.25 * rho * beta * vol_vol / fk_beta)
+    c_b = (-one_beta / 12. * alpha ** 2 / fk_beta ** 2 -
+           one_beta ** 2 / 12. * alpha ** 2 / fk_beta ** 3 * fk_beta_b +
+           0.25 * rho * vol_vol * alpha *
+           (1. / fk_beta - beta * fk_beta_b / fk_beta ** 2))
+    c_r = 0.25 * beta * vol_vol * alpha / fk_beta - 0.25 * rho * vol_vol ** 2
+    c_v = (0.25 * rho * beta * alpha / fk_beta +
+           (2. - 3. * rho ** 2) / 12. * vol_vol)
+    c_f = -(one_beta ** 2 / 12. * alpha ** 2 / fk_beta ** 3 +
+            0.25 * rho * beta * vol_vol * alpha / fk_beta ** 2) * fk_beta_f
+    # sigma = alpha / denominator * z_x * (1 + correction * expiry): the
+    # relative derivatives of the factors add up
+    time = expiry / (1. + correction * expiry)
+    return {'alpha': sigma * (1. / alpha + z_x_z * z_a / z_x + c_a * time),
+            'beta': sigma * (-d_b / d_d + z_x_z * z_b / z_x + c_b * time),
+            'rho': sigma * (z_x_r / z_x + c_r * time),
+            'vol_vol': sigma * (z_x_z * z_v / z_x + c_v * time),
+            'forward': sigma * (-d_f / d_d + z_x_z * z_f / z_x +
+                                c_f * time)}
 
 
 class sabr_stochastic_volatility(simulation_class):
@@ -23,6 +127,10 @@ class sabr_stochastic_volatility(simulation_class):
     get_log_normal_implied_vol :
         returns the approximation of the lognormal Black implied volatility
         as given by Hagan et al. (2002)
+    calibrate_to_impl_vol :
+        calibrates the model to the implied volatilities of one expiry
+    calibrate_surface :
+        calibrates the model per expiry to an implied volatility surface
     '''
 
     def __init__(self, name, mar_env, corr=False):
@@ -67,60 +175,103 @@ class sabr_stochastic_volatility(simulation_class):
         self.volatility_values = None
 
     def get_log_normal_implied_vol(self, strike, expiry):
-        ''' Returns the implied volatility for fixed strike and expiry.
+        ''' Returns the implied volatility for the given strike(s) and
+        expiry(ies), see sabr_implied_vol.
         '''
         self.check_parameter_set()
-        one_beta = 1. - self.beta
-        one_beta_square = one_beta ** 2
-        if self.initial_value != strike:
-            fk = self.initial_value * strike
-            fk_beta = fk ** (one_beta / 2.)
-            log_fk = math.log(self.initial_value / strike)
-            z = self.vol_vol / self.alpha * fk_beta * log_fk
-            x = math.log((math.sqrt(1. - 2 * self.rho * z + z ** 2) +
-                          z - self.rho) / (1 - self.rho))
-
-            sigma_1 = ((self.alpha / fk_beta /
-                       (1 + one_beta_square * log_fk ** 2 / 24) +
-                        (one_beta_square ** 2 * log_fk ** 4 / 1920.)) * z / x)
-
-            sigma_ex = (one_beta_square / 24. * self.alpha ** 2 / fk_beta ** 2 +
-                        0.25 * self.rho * self.beta * self.vol_vol *
-                        self.alpha / fk_beta +
-                        (2. - 3. * self.rho ** 2) /
-                        24. * self.vol_vol ** 2)
-
-            sigma = sigma_1 * (1. + sigma_ex * expiry)
-        else:
-            f_beta = self.initial_value ** one_beta
-            f_two_beta = self.initial_value ** (2. - 2 * self.beta)
-            sigma = ((self.alpha / f_beta) *
-                     (1 + expiry * ((one_beta_square / 24. * self.alpha ** 2 /
-                      f_two_beta) + (0.25 * self.rho * self.beta *
-                      self.vol_vol * self.alpha / f_beta) +
-                      ((2. - 3 * self.rho ** 2) / 24. * self.vol_vol ** 2))))
-        return sigma
+        sigma = sabr_implied_vol(self.initial_value, strike, expiry,
+                                 self.alpha, self.beta, self.rho,
+                                 self.vol_vol)
+        return sigma[()] if np.ndim(sigma) == 0 else sigma
 
     def calibrate_to_impl_vol(self, implied_vols, maturity, para=list()):
         ''' Calibrates the parameters alpha, beta, initial_value and vol_vol
-        to a set of given implied volatilities.
+        to a set of given implied volatilities (in percent, strikes as
+        columns) by least squares; the object is updated with the result.
         '''
         if len(para) != 4:
             para = (self.alpha, self.beta, self.initial_value, self.vol_vol)
+        strikes = np.array(implied_vols.columns, dtype=float)
+        market = np.asarray(implied_vols, dtype=float).reshape(
+            -1, len(strikes))[0] / 100.
+        lower = [1e-8, 0., 1e-8, 1e-8]
+        upper = [np.inf, 1., np.inf, np.inf]
+
+        def residuals(p):
+            return sabr_implied_vol(p[2], strikes, maturity, p[0], p[1],
+                                    self.rho, p[3]) - market
+
+        def jacobian(p):
+            jac = sabr_implied_vol_jacobian(p[2], strikes, maturity, p[0],
+                                            p[1], self.rho, p[3])
+            return np.column_stack([jac['alpha'], jac['beta'],
+                                    jac['forward'], jac['vol_vol']])
+        para = np.clip(np.array(para, dtype=float), lower, upper)
+        res = sco.least_squares(residuals, para, jac=jacobian,
+                                bounds=(lower, upper), xtol=1e-10,
+                                ftol=1e-10)
+        self.update(alpha=res.x[0], beta=res.x[1], initial_value=res.x[2],
+                    vol_vol=res.x[3])
+        return res.x
+
+    def calibrate_surface(self, implied_vols, para=None):
+        ''' Calibrates alpha, rho and vol_vol per expiry to a surface of
+        implied volatilities with beta and initial_value fixed. All
+        expiries are fitted at once with the analytic, block-diagonal (per
+        expiry) sparse Jacobian.
+        Parameters
+        ==========
+        implied_vols : pd.DataFrame
+            implied volatilities in percent, expiries (dates or year
+            fractions) as index and strikes as columns; NaN for missing
+            quotes
+        para : tuple
+            initial (alpha, rho, vol_vol), default: the current values
+        Returns
+        =======
+        parameters : pd.DataFrame
+            alpha, rho and vol_vol per expiry
+        '''
+        self.check_parameter_set()
+        expiries = list(implied_vols.index)
+        if isinstance(expiries[0], (dt.datetime, dt.date, pd.Timestamp)):
+            expiries = get_year_deltas([self.pricing_date] + expiries)[1:]
+        expiries = np.array(expiries, dtype=float)[:, np.newaxis]
+        strikes = np.array(implied_vols.columns, dtype=float)[np.newaxis, :]
+        market = np.asarray(implied_vols, dtype=float) / 100.
+        quoted = ~np.isnan(market)
+        E = len(expiries)
+        if para is None:
+            para = (self.alpha, self.rho, self.vol_vol)
+        lower = np.tile([1e-8, -0.9999, 1e-8], E)
+        upper = np.tile([np.inf, 0.9999, np.inf], E)
+        x0 = np.clip(np.tile(np.array(para, dtype=float), E), lower, upper)
 
-        def error_function(para):
-            self.alpha, self.beta, self.initial_value, self.vol_vol = para
-            if (self.beta < 0 or self.beta > 1 or self.initial_value <= 0 or
-                    self.vol_vol <= 0):
-                return 10000
-            e = 0
-            for strike in implied_vols.columns:
-                e += (self.get_log_normal_implied_vol(float(strike), maturity) -
-                      float(implied_vols[strike]) / 100.) ** 2
-            return e
-        para = fmin(error_function, para, xtol=0.0000001,
-                    ftol=0.0000001, maxiter=550, maxfun=850)
-        return para
+        def residuals(p):
+            p = p.reshape(E, 3)
+            sigma = sabr_implied_vol(self.initial_value, strikes, expiries,
+                                     p[:, :1], self.beta, p[:, 1:2],
+                                     p[:, 2:])
+            return (sigma - market)[quoted]
+        # the quotes of an expiry only depend on its three parameters
+        rows = np.repeat(np.arange(quoted.sum()), 3)
+        columns = (3 * np.nonzero(quoted)[0][:, np.newaxis] +
+                   np.arange(3)).ravel()
+
+        def jacobian(p):
+            p = p.reshape(E, 3)
+            jac = sabr_implied_vol_jacobian(self.initial_value, strikes,
+                                            expiries, p[:, :1], self.beta,
+                                            p[:, 1:2], p[:, 2:])
+            data = np.stack([np.broadcast_to(jac[k], market.shape)[quoted]
+                             for k in ('alpha', 'rho', 'vol_vol')], axis=1)
+            return csr_matrix((data.ravel(), (rows, columns)),
+                              shape=(len(data), 3 * E))
+        res = sco.least_squares(residuals, x0, jac=jacobian,
+                                bounds=(lower, upper), xtol=1e-10,
+                                ftol=1e-10)
+        return pd.DataFrame(res.x.reshape(E, 3), index=implied_vols.index,
+                            columns=['alpha', 'rho', 'vol_vol'])
 
     def check_parameter_set(self):
         ''' Checks if all needed parameter are set.
@@ -141,31 +292,28 @@ class sabr_stochastic_volatility(simulation_class):
             self.generate_time_grid()
         M = len(self.time_grid)
         I = self.paths
-        paths = np.zeros((M, I))
-        va = np.zeros_like(paths)
-        va_ = np.zeros_like(paths)
+        # paths, two volatility arrays and two random number arrays
+        self.check_memory(M, I, 5)
+        paths = self.get_path_array(M, I)
+        va = self.get_path_array(M, I)
+        va_ = self.get_path_array(M, I, record=False)
         paths[0] = self.initial_value
         va[0] = self.alpha
         va_[0] = self.alpha
         # pseudo-random numbers for the monte carlo
-        if self.correlated is False:
-            sn1 = sn_random_numbers((1, M, I), fixed_seed=fixed_seed)
-        else:
-            sn1 = self.random_numbers
+        # own or correlated (shared) numbers, read step by step
+        sn1 = chunked_random_numbers(
+            self.iter_diffusion_random_chunks(M, I, fixed_seed), M, I)
 
         # pseudo-random numbers for the stochastic volatility
-        sn2 = sn_random_numbers((1, M, I), fixed_seed=fixed_seed)
+        sn2 = self.generate_random_numbers(M, I, 'volatility',
+                                           fixed_seed=fixed_seed)
 
-        pdb.set_trace()
         for t in range(1, len(self.time_grid)):
             # get fraction of year for each step
             dt = (self.time_grid[t] - self.time_grid[t - 1]).days / day_count
             square_root_dt = np.sqrt(dt)
-            if self.correlated is False:
-                ran = sn1[t]
-            else:
-                ran = np.dot(self.cholesky_matrix, sn1[:, t, :])
-                ran = ran[self.rn_set]
+            ran = sn1[t]
             rat = np.array([ran, sn2[t]])
             rat = np.dot(self.leverage, rat)
 
@@ -187,8 +335,8 @@ class sabr_stochastic_volatility(simulation_class):
             else:
                 paths[t] = p
 
-        self.instrument_values = paths
-        self.volatility_values = np.sqrt(va)
+        self.instrument_values = self.get_stored_values(paths)
+        self.volatility_values = np.sqrt(self.get_stored_values(va))
 
     def get_volatility_values(self):
         ''' Returns the volatility values for the model object.
@@ -1,6 +1,110 @@
+import bisect
+import hashlib
 from ..frame import *
 
 
+class rolling_path_array(object):
+    ''' Stand-in for an (M, I) path array in the step loops of the models
+    when only observation dates are stored: keeps the current and the
+    previous step plus the rows of the observation steps (in values).
+    Steps must be written in increasing order.
+    '''
+
+    def __init__(self, M, I, rows=(), dtype=np.float64):
+        self.shape = (M, I)
+        self.dtype = np.dtype(dtype)
+        # step --> row in values
+        self.rows = dict((t, n) for n, t in enumerate(rows))
+        self.values = np.zeros((len(self.rows), I), dtype=dtype)
+        self._ring = np.zeros((2, I), dtype=dtype)
+        self._last = 0
+
+    def _step(self, key):
+        if isinstance(key, tuple):
+            # paths[t, :]
+            key = key[0]
+        key = int(key)
+        return key + self.shape[0] if key < 0 else key
+
+    def __getitem__(self, key):
+        t = self._step(key)
+        if not self._last - 1 <= t <= self._last:
+            raise IndexError('Only the last two steps are kept (step %d '
+                             'requested, last step %d).' % (t, self._last))
+        return self._ring[t % 2]
+
+    def __setitem__(self, key, value):
+        t = self._step(key)
+        if not self._last - 1 <= t <= self._last + 1:
+            raise IndexError('Steps must be written in order (step %d, '
+                             'last step %d).' % (t, self._last))
+        self._ring[t % 2] = value
+        self._last = max(self._last, t)
+        n = self.rows.get(t)
+        if n is not None:
+            self.values[n] = self._ring[t % 2]
+
+
+class chunked_random_numbers(object):
+    ''' Stand-in for an (M, I) random number array that is read step by
+    step in increasing order; the rows are drawn chunk by chunk from an
+    iterator of (first step, chunk) pairs. '''
+
+    def __init__(self, chunks, M, I):
+        self.shape = (M, I)
+        self._chunks = chunks
+        self._start = 0
+        self._chunk = np.empty((0, I))
+
+    def __getitem__(self, t):
+        t = t + self.shape[0] if t < 0 else t
+        while t >= self._start + len(self._chunk):
+            self._start, self._chunk = next(self._chunks)
+        if t < self._start:
+            raise IndexError('Random numbers must be read in increasing '
+                             'step order.')
+        return self._chunk[t - self._start]
+
+
+def get_content_key(value):
+    ''' Returns a hashable key of the contents of an attribute value for
+    the path cache: arrays by their bytes (a digest for large arrays),
+    lists, tuples and dicts element by element and objects declaring
+    uncached_attributes (e.g. curves) by their attributes; raises
+    TypeError for unhashable values. '''
+    if isinstance(value, np.ndarray):
+        if value.dtype == object:
+            # contents, not the addresses of the objects
+            return (value.shape, tuple(get_content_key(v)
+                                       for v in value.ravel().tolist()))
+        if value.size <= 4096:
+            return (value.shape, value.dtype.str, value.tobytes())
+        return (value.shape, value.dtype.str, hashlib.blake2b(
+            np.ascontiguousarray(value).data, digest_size=16).digest())
+    if isinstance(value, (list, tuple)):
+        return (type(value), tuple(get_content_key(v) for v in value))
+    if isinstance(value, dict):
+        return (dict, tuple(sorted((repr(k), get_content_key(v))
+                                   for k, v in value.items())))
+    if hasattr(value, 'uncached_attributes'):
+        return get_object_key(value)
+    hash(value)
+    return value
+
+
+def get_object_key(obj):
+    ''' Returns a hashable key of the type and the attributes of obj,
+    except its uncached_attributes (see get_content_key); numbers and
+    other hashable objects without attributes are their own key. '''
+    if not hasattr(obj, '__dict__'):
+        hash(obj)
+        return obj
+    skip = getattr(obj, 'uncached_attributes', ())
+    return (type(obj), tuple((k, get_content_key(v))
+                             for k, v in sorted(obj.__dict__.items())
+                             if k not in skip))
+
+
 class simulation_class(object):
     ''' Providing base methods for simulation classes.
     Attributes
@@ -17,9 +121,69 @@ class simulation_class(object):
         returns time grid for simulation
     get_instrument_values:
         returns the current instrument values (array)
+    get_cache_key :
+        returns the key of the current paths in the path cache
+    generate_random_numbers :
+        returns standard normal numbers for one random component
+    get_diffusion_random_numbers :
+        returns the (possibly correlated) numbers driving the diffusion
+    iter_path_blocks :
+        generates and yields the paths block by block
+    get_random_generator :
+        returns a NumPy Generator for non-normal random components
+    iter_random_generators :
+        yields the Generators of a component per block of paths
+    get_block_means :
+        returns the means of values over the blocks of paths
+    generate_jumps :
+        returns the sparse compound Poisson jumps of the paths
+    check_memory :
+        checks the memory needed for a simulation against the budget
+    set_observation_dates :
+        stores only the given dates of the simulated paths
+    get_observation_rows :
+        returns the steps stored in instrument_values
+    value_grid :
+        time grid of the rows of instrument_values
+    insert_dates :
+        adds dates to the time grid, refining existing paths by bridges
+    bridge_values :
+        samples values between two dates conditional on both (model)
+
+    the optional constants 'dtype' (np.float32 or np.float64, default)
+    and 'memory_budget' (in bytes) of the market environment select
+    reduced precision simulation and limit the memory of a single run;
+    float32 numbers are drawn by NumPy's float32 normal sampler, so a
+    float32 run is a different sample than the float64 run of the same
+    seed, not its rounding; the optional list 'observation_dates' limits
+    the stored dates
     '''
 
+    # number of the first path simulated, changed in block generation
+    path_offset = 0
+    # steps per chunk of random numbers when only observations are stored
+    random_chunk_steps = 64
+    observation_dates = None
+    # paths of fixed seeds are shared through the process-wide path cache
+    use_path_cache = True
+    # True if the paths scale linearly in initial_value (for fixed random
+    # numbers); the cached paths then serve all initial values
+    homogeneous = False
+    cached_attributes = ('instrument_values', 'volatility_values')
+    # attributes not identifying the simulated paths
+    uncached_attributes = frozenset(['instrument_values', 'volatility_values',
+                                     'time_grid', 'discount_curve',
+                                     'random_number_service',
+                                     'correlated_shocks', 'memory_budget',
+                                     '_value_grid', 'special_dates',
+                                     'shift_values', 'forward_rates',
+                                     'shift_parameters', '_shift_state'])
+
     def __init__(self, name, mar_env, corr):
+        self.dtype = np.dtype(mar_env.constants.get('dtype', np.float64))
+        if self.dtype not in (np.float32, np.float64):
+            raise ValueError('dtype must be np.float32 or np.float64.')
+        self.memory_budget = mar_env.constants.get('memory_budget', None)
         try:
             self.name = name
             self.pricing_date = mar_env.pricing_date
@@ -34,6 +198,8 @@ class simulation_class(object):
                 # if time_grid in mar_env take this
                 # (for portfolio valuation)
                 self.time_grid = mar_env.get_list('time_grid')
+                if not isinstance(self.time_grid, simulation_time_grid):
+                    self.time_grid = simulation_time_grid(self.time_grid)
             except:
                 self.time_grid = None
             try:
@@ -41,49 +207,424 @@ class simulation_class(object):
                 self.special_dates = mar_env.get_list('special_dates')
             except:
                 self.special_dates = []
+            try:
+                # store only these dates of the paths (e.g. maturities)
+                self.set_observation_dates(
+                    mar_env.get_list('observation_dates'))
+            except KeyError:
+                self.observation_dates = None
+            # shared random number service (e.g. for a portfolio) or
+            # one according to the 'sampling' constant
+            self.random_number_service = get_random_number_service(mar_env)
             self.instrument_values = None
             self.correlated = corr
             if corr is True:
                 # only needed in a portfolio context when
                 # risk factors are correlated
-                self.cholesky_matrix = mar_env.get_list('cholesky_matrix')
                 self.rn_set = mar_env.get_list('rn_set')[self.name]
-                self.random_numbers = mar_env.get_list('random_numbers')
+                # correlated numbers shared by all underlyings
+                self.correlated_shocks = get_correlated_shocks(mar_env)
         except:
             print('Error parsing market environment.')
 
     def generate_time_grid(self):
-        start = self.pricing_date
-        end = self.final_date
-        # pandas date_range function
+        # shared (cached) grid from pricing_date to final_date with the
+        # special dates later than pricing_date
         # freq = e.g. 'B' for Business Day,
-        # 'W' for Weekly, 'M' for Monthly
-        time_grid = pd.date_range(start=start, end=end,
-                                  freq=self.frequency).to_pydatetime()
-        time_grid = list(time_grid)
-        # enhance time_grid by start, end and special_dates
-        if start not in time_grid:
-            time_grid.insert(0, start)
-            # insert start date if not in list
-        if end not in time_grid:
-            time_grid.append(end)
-            # insert end date if not in list
-        if len(self.special_dates) > 0:
-            # add all special dates later than self.pricing_date
-            add_dates = [d for d in self.special_dates
-                         if d > self.pricing_date]
-            time_grid.extend(add_dates)
-            # delete duplicates and sort
-            time_grid = sorted(set(time_grid))
-        self.time_grid = np.array(time_grid)
+        # 'W' for Weekly, 'ME' for Monthly
+        self.time_grid = get_time_grid(self.pricing_date, self.final_date,
+                                       self.frequency, self.special_dates)
+
+    def set_observation_dates(self, dates):
+        ''' Stores only the given dates (and the first date) of the
+        simulated paths in instrument_values; None stores all dates. '''
+        if dates is None:
+            self.observation_dates = None
+        else:
+            self.observation_dates = sorted(set(dates))
+            missing = [d for d in self.observation_dates
+                       if d not in self.special_dates]
+            self.special_dates.extend(missing)
+            if self.time_grid is not None and any(
+                    d not in self.time_grid for d in missing):
+                self.time_grid = None
+        self.instrument_values = None
+
+    def get_observation_rows(self):
+        ''' Returns the sorted steps stored in instrument_values or None
+        if all steps are stored. '''
+        if self.observation_dates is None:
+            return None
+        rows = set([0])
+        for d in self.observation_dates:
+            if d < self.time_grid[0]:
+                continue
+            try:
+                rows.add(self.time_grid.get_index(d))
+            except KeyError:
+                raise ValueError('Observation date %s not in time grid.' % d)
+        return sorted(rows)
+
+    @property
+    def value_grid(self):
+        ''' Time grid of the rows of instrument_values. '''
+        if self.time_grid is None:
+            self.generate_time_grid()
+        rows = self.get_observation_rows()
+        if rows is None:
+            return self.time_grid
+        key = (id(self.time_grid), tuple(rows))
+        cached = getattr(self, '_value_grid', None)
+        if cached is None or cached[0] != key:
+            grid = simulation_time_grid(self.time_grid[rows])
+            self._value_grid = cached = (key, grid)
+        return cached[1]
+
+    def get_path_array(self, M, I, record=True):
+        ''' Returns the (M, I) array for a model's step loop: a full array
+        or, if only observation dates are stored, a rolling_path_array
+        (recording the observation rows if record is True). '''
+        rows = self.get_observation_rows()
+        if rows is None:
+            return np.zeros((M, I), dtype=self.dtype)
+        return rolling_path_array(M, I, rows if record else (), self.dtype)
+
+    def get_stored_values(self, array):
+        ''' Returns the stored rows of an array from get_path_array. '''
+        if isinstance(array, rolling_path_array):
+            return array.values
+        return array
+
+    def generate_random_numbers(self, M, I, component='diffusion',
+                                fixed_seed=False):
+        ''' Returns (M, I) standard normal numbers of the model's own stream
+        for the given component; every component (diffusion, volatility,
+        jumps, ...) is an independent stream. If only observation dates
+        are stored, the rows are drawn lazily in chunks of steps. '''
+        if self.observation_dates is not None:
+            return chunked_random_numbers(
+                self.iter_random_number_chunks(M, I, component, fixed_seed),
+                M, I)
+        return self.random_number_service.standard_normal(
+            (M, I), self.name, component, path_offset=self.path_offset,
+            fixed_seed=fixed_seed, dtype=self.dtype,
+            times=get_year_deltas(self.time_grid))
+
+    def iter_random_number_chunks(self, M, I, component='diffusion',
+                                  fixed_seed=False, chunk_steps=None):
+        ''' Yields (first step, chunk) pairs of the (M, I) standard normal
+        numbers of generate_random_numbers in chunks of steps. '''
+        if chunk_steps is None:
+            chunk_steps = self.random_chunk_steps
+        chunks = self.random_number_service.standard_normal_chunks(
+            (M, I), self.name, component, path_offset=self.path_offset,
+            chunk_steps=chunk_steps, fixed_seed=fixed_seed,
+            dtype=self.dtype, times=get_year_deltas(self.time_grid))
+        start = 0
+        for chunk in chunks:
+            yield start, chunk
+            start += len(chunk)
+
+    def iter_diffusion_random_chunks(self, M, I, fixed_seed=False,
+                                     chunk_steps=None):
+        ''' Yields (first step, chunk) pairs of the numbers of
+        get_diffusion_random_numbers in chunks of steps. '''
+        if chunk_steps is None:
+            chunk_steps = self.random_chunk_steps
+        if self.correlated is False:
+            for start, chunk in self.iter_random_number_chunks(
+                    M, I, 'diffusion', fixed_seed, chunk_steps):
+                yield start, chunk
+            return
+        for start in range(0, M, chunk_steps):
+            chunk = self.correlated_shocks.get_shocks(
+                self.rn_set, start, start + chunk_steps, self.path_offset,
+                I)
+            yield start, chunk.astype(self.dtype, copy=False)
+
+    def get_diffusion_random_numbers(self, M, I, fixed_seed=False):
+        ''' Returns the (M, I) standard normal numbers driving the model's
+        diffusion: its own stream or, if correlated, its row of the
+        shared correlated shocks (a view). '''
+        if self.correlated is False:
+            return self.random_number_service.standard_normal(
+                (M, I), self.name, 'diffusion', path_offset=self.path_offset,
+                fixed_seed=fixed_seed, dtype=self.dtype,
+                times=get_year_deltas(self.time_grid))
+        return self.correlated_shocks.get_shocks(
+            self.rn_set, 0, M, self.path_offset, I).astype(self.dtype,
+                                                          copy=False)
+
+    def get_random_generator(self, component, fixed_seed=False):
+        ''' Returns a NumPy Generator for the given component, e.g. for
+        Poisson distributed jump counts. '''
+        block = self.path_offset // self.random_number_service.block_size
+        return self.random_number_service.get_generator(
+            self.name, component, block, fixed_seed=fixed_seed)
+
+    def iter_random_generators(self, component, fixed_seed=False):
+        ''' Yields (first path, number of paths, Generator) for the blocks
+        of path_block_size paths of the random number service covering
+        the model's paths, e.g. for Poisson distributed jump counts. The
+        draws of a block do not depend on the other paths, so a block by
+        block simulation draws the same numbers as a full one. '''
+        service = self.random_number_service
+        block = service.path_block_size
+        if self.path_offset % block != 0:
+            raise ValueError('Path offset must be a multiple of %d.' % block)
+        first = self.path_offset // block
+        for start in range(0, self.paths, block):
+            yield (start, min(block, self.paths - start),
+                   service.get_generator(self.name, component,
+                                         first + start // block,
+                                         fixed_seed=fixed_seed))
+
+    def get_block_means(self, values):
+        ''' Returns, for every path, the mean of values (I,) over its block
+        of path_block_size paths; corrections across paths then do not
+        depend on paths outside the block. '''
+        block = self.random_number_service.path_block_size
+        means = np.empty(len(values))
+        for start in range(0, len(values), block):
+            means[start:start + block] = np.mean(values[start:start + block],
+                                                 dtype=np.float64)
+        return means
+
+    def generate_jumps(self, fixed_seed=False, day_count=365.,
+                       log_sizes=False):
+        ''' Returns the jumps of the compound Poisson component with
+        intensity lamb and log-normal sizes (mu, delt) in sparse form.
+        Per path the jump count over the whole grid is Poisson distributed
+        and the jump times are uniform; every jump adds
+        exp(mu + delt * z) - 1 to the jump factor of its step or, with
+        log_sizes=True, mu + delt * z to the log jump size of its step
+        (the step's value is then multiplied by the exp of the sum).
+        Returns
+        =======
+        bounds : array (M + 1,)
+            the jumps of step t are entries bounds[t]:bounds[t + 1]
+        index : array
+            path of each entry (unique within a step)
+        factors : array
+            summed jump factors (or log jump sizes) of the entries
+        '''
+        times = get_year_deltas(self.time_grid, day_count)
+        M, I = len(times), self.paths
+        counts = np.empty(I, dtype=np.int64)
+        jump_times, sizes = [], []
+        for (start, n, jump_rng), (_, _, size_rng) in zip(
+                self.iter_random_generators('jump_count', fixed_seed),
+                self.iter_random_generators('jump_size', fixed_seed)):
+            counts[start:start + n] = jump_rng.poisson(
+                self.lamb * times[-1], n)
+            number = counts[start:start + n].sum()
+            jump_times.append(jump_rng.uniform(0, times[-1], number))
+            sizes.append(size_rng.standard_normal(number))
+        index = np.repeat(np.arange(I), counts)
+        # a jump at time u belongs to the step t with
+        # times[t - 1] < u <= times[t]
+        steps = np.searchsorted(times, np.concatenate(jump_times or [[]]))
+        steps = np.maximum(steps, 1)
+        factors = self.mu + self.delt * np.concatenate(sizes or [[]])
+        if log_sizes is False:
+            factors = np.expm1(factors)
+        # sort by step and path, sum several jumps of a path in a step
+        key = steps * I + index
+        order = np.argsort(key, kind='stable')
+        key, factors = key[order], factors[order]
+        if len(key):
+            first = np.flatnonzero(np.r_[True, key[1:] != key[:-1]])
+            key, factors = key[first], np.add.reduceat(factors, first)
+        steps, index = np.divmod(key, I)
+        bounds = np.searchsorted(steps, np.arange(M + 1))
+        return bounds, index, factors
+
+    def iter_path_blocks(self, block_size=None, fixed_seed=True,
+                         day_count=365.):
+        ''' Generates the paths in blocks of block_size paths and yields
+        (path offset, (M, block_size) paths) pairs, so that only one block
+        is held in memory. Every block uses its own random number
+        substreams; block_size must be a multiple of the path_block_size
+        of the random number service (its default). '''
+        block = self.random_number_service.path_block_size
+        if block_size is None:
+            block_size = block
+        if block_size % block != 0:
+            raise ValueError('Block size must be a multiple of %d.' % block)
+        total = self.paths
+        try:
+            for offset in range(0, total, block_size):
+                # correlated numbers are read at the path offset
+                self.paths = min(block_size, total - offset)
+                self.path_offset = offset
+                self.generate_paths(fixed_seed=fixed_seed,
+                                    day_count=day_count)
+                yield offset, self.instrument_values
+                self.instrument_values = None
+        finally:
+            self.paths = total
+            self.path_offset = 0
+            self.instrument_values = None
+
+    def check_memory(self, M, I, arrays):
+        ''' Returns the bytes needed for the given number of (M, I) arrays
+        in the model's dtype; raises MemoryError before any allocation if
+        this exceeds the memory budget. If only observation dates are
+        stored, an array holds at most the observation rows, two rolling
+        rows and one chunk of random numbers. '''
+        rows = self.get_observation_rows()
+        if rows is not None:
+            M = min(M, len(rows) + 2 + self.random_chunk_steps)
+        needed = arrays * M * I * self.dtype.itemsize
+        if self.memory_budget is not None and needed > self.memory_budget:
+            raise MemoryError(
+                'Simulation of %s needs %.2f GB (%d arrays of %d x %d %s), '
+                'the memory budget is %.2f GB.'
+                % (self.name, needed / 1e9, arrays, M, I, self.dtype.name,
+                   self.memory_budget / 1e9))
+        return needed
+
+    def get_cache_key(self):
+        ''' Returns the (key, referenced objects) of the paths of the current
+        parameters for the process-wide path cache; the key is None if an
+        attribute cannot be part of a key (the paths are not cached). '''
+        if self.time_grid is None:
+            self.generate_time_grid()
+        params = []
+        # paths of homogeneous models are cached for any initial value
+        scaled = self.homogeneous is True and self.initial_value != 0
+        for k, v in sorted(self.__dict__.items()):
+            if k in self.uncached_attributes or (scaled and
+                                                 k == 'initial_value'):
+                continue
+            try:
+                params.append((k, get_content_key(v)))
+            except TypeError:
+                return None, ()
+        try:
+            # by contents, so in-place changes of the curve are seen
+            curve = get_object_key(self.discount_curve)
+        except TypeError:
+            return None, ()
+        service = self.random_number_service
+        refs = (self.time_grid, getattr(self, 'correlated_shocks', None))
+        # services of the same type and settings give the same streams
+        key = (type(self), tuple(params), tuple(id(r) for r in refs), curve,
+               type(service),
+               tuple(sorted((k, v) for k, v in service.__dict__.items()
+                            if isinstance(v, (bool, int, float)))))
+        return key, refs
+
+    def bridge_values(self, left, right, dt_left, dt_right, z):
+        ''' Returns values at a new date between two dates of the paths,
+        sampled conditional on the values left and right at dt_left years
+        before and dt_right years after the new date (z standard normal);
+        None if the model has no bridge. '''
+        return None
+
+    def insert_dates(self, dates, fixed_seed=True):
+        ''' Adds dates to the time grid. The values of existing paths at
+        the new dates are sampled by bridge_values conditional on their
+        neighbouring values, all other values are kept. If there are no
+        paths, the model is correlated or has no bridge, or a date lies
+        after the last date of the grid, the paths are simulated again
+        when needed. Returns True if the existing paths were refined. '''
+        self.special_dates.extend(sorted(set(
+            d for d in dates if d not in self.special_dates)))
+        if self.time_grid is None:
+            # the grid with the special dates is generated when needed
+            if self.observation_dates is not None:
+                self.observation_dates = sorted(
+                    set(self.observation_dates) |
+                    set(d for d in dates if d > self.pricing_date))
+            self.instrument_values = None
+            return False
+        grid = self.value_grid
+        new = sorted(set(d for d in dates if d > grid[0] and d not in grid))
+        if not new:
+            return self.instrument_values is not None
+        time_grid = self.time_grid
+        if any(d not in time_grid for d in new):
+            time_grid = simulation_time_grid(sorted(set(time_grid) |
+                                                    set(new)))
+        values = self.instrument_values
+        # refined fixed seed paths replace the paths in the path cache, so
+        # that bumps of homogeneous models rescale the refined paths
+        cached = (values is not None and self.use_path_cache is True and
+                  self.get_cache_key()[0] in get_path_cache().entries)
+        if self.correlated is True or new[-1] > grid[-1]:
+            values = None
+        if values is not None:
+            values = self.bridge_new_dates(values, grid, new, fixed_seed)
+        self.time_grid = time_grid
+        if self.observation_dates is not None:
+            self.observation_dates = sorted(
+                set(self.observation_dates) | set(new))
+        self.instrument_values = values
+        if values is None:
+            return False
+        if cached:
+            key, refs = self.get_cache_key()
+            get_path_cache().put(
+                key, {'instrument_values': values,
+                      'initial_value': np.array(self.initial_value)}, refs)
+        return True
+
+    def bridge_new_dates(self, values, grid, new, fixed_seed=False):
+        ''' Returns the rows of values (on grid) with the rows of the
+        sorted new dates inserted, or None if the model has no bridge. '''
+        # sequential sampling: each new date is conditional on its
+        # closest neighbours, including the new dates sampled before
+        t_grid = list(grid.year_fractions)
+        t_new = get_year_deltas([grid[0]] + new, grid.day_count)[1:]
+        gen = self.get_random_generator('bridge', fixed_seed)
+        times, rows = list(t_grid), list(values)
+        positions, new_rows = [], []
+        for t in t_new:
+            r = bisect.bisect(times, t)
+            row = self.bridge_values(
+                np.asarray(rows[r - 1], dtype=np.float64),
+                np.asarray(rows[r], dtype=np.float64), t - times[r - 1],
+                times[r] - t, gen.standard_normal(len(values[0])))
+            if row is None:
+                return None
+            times.insert(r, t)
+            rows.insert(r, row)
+            positions.append(bisect.bisect(t_grid, t))
+            new_rows.append(row)
+        return np.insert(values, positions,
+                         np.array(new_rows, dtype=values.dtype), axis=0)
 
     def get_instrument_values(self, fixed_seed=True):
-        if self.instrument_values is None:
+        if self.instrument_values is None or fixed_seed is False:
             # only initiate simulation if there are no instrument values
-            self.generate_paths(fixed_seed=fixed_seed, day_count=365.)
-        elif fixed_seed is False:
-            # also initiate re-simulation when fixed_seed is False
-            self.generate_paths(fixed_seed=fixed_seed, day_count=365.)
+            # or when fixed_seed is False; paths of a fixed seed come
+            # from the path cache if simulated before
+            if fixed_seed is True and self.use_path_cache is True:
+                cache = get_path_cache()
+                key, refs = self.get_cache_key()
+                arrays = cache.get(key) if key is not None else None
+                if arrays is None:
+                    self.generate_paths(fixed_seed=fixed_seed, day_count=365.)
+                    arrays = dict((k, getattr(self, k))
+                                  for k in self.cached_attributes
+                                  if getattr(self, k, None) is not None)
+                    arrays['initial_value'] = np.array(self.initial_value)
+                    if key is not None:
+                        cache.put(key, arrays, refs)
+                else:
+                    # rescaled paths for a bumped initial value of a
+                    # homogeneous model, no new simulation
+                    scale = self.initial_value / arrays['initial_value']
+                    for k in self.cached_attributes:
+                        if k not in arrays:
+                            continue
+                        v = arrays[k]
+                        if k == 'instrument_values' and scale != 1:
+                            v = (v * scale).astype(v.dtype, copy=False)
+                        setattr(self, k, v)
+            else:
+                self.generate_paths(fixed_seed=fixed_seed, day_count=365.)
         return self.instrument_values
 
 
@@ -97,6 +638,9 @@ class general_underlying(object):
         self.discount_curve = val_env.get_curve('discount_curve')
         self.special_dates = []
         self.time_grid = val_env.get_list('time_grid')
+        if not isinstance(self.time_grid, simulation_time_grid):
+            self.time_grid = simulation_time_grid(self.time_grid)
+        self.value_grid = self.time_grid
         self.fit_model = None
 
     def get_instrument_values(self, fixed_seed=False):
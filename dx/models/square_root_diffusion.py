@@ -1,5 +1,5 @@
 from ..frame import *
-from .simulation_class import simulation_class
+from .simulation_class import simulation_class, chunked_random_numbers
 
 
 class square_root_diffusion(simulation_class):
@@ -13,16 +13,26 @@ class square_root_diffusion(simulation_class):
         market environment data for simulation
     corr : boolean
         True if correlated with other model object
+    scheme : string
+        'euler' (default) for the full truncation Euler discretization or
+        'exact' for sampling from the noncentral chi-square transition
+        (without discretization bias, also for large steps); correlated
+        processes always use 'euler'
     Methods
     =======
     update :
         updates parameters
     generate_paths :
         returns Monte Carlo paths given the market environment
+    generate_exact_paths :
+        returns Monte Carlo paths from the exact transition
     '''
 
-    def __init__(self, name, mar_env, corr=False):
+    def __init__(self, name, mar_env, corr=False, scheme='euler'):
         super(square_root_diffusion, self).__init__(name, mar_env, corr)
+        if scheme not in ('euler', 'exact'):
+            raise ValueError("Scheme must be 'euler' or 'exact'.")
+        self.scheme = scheme
         try:
             self.kappa = mar_env.get_constant('kappa')
             self.theta = mar_env.get_constant('theta')
@@ -50,35 +60,63 @@ class square_root_diffusion(simulation_class):
     def generate_paths(self, fixed_seed=True, day_count=365.):
         if self.time_grid is None:
             self.generate_time_grid()
+        if self.scheme == 'exact' and self.correlated is False:
+            self.instrument_values = self.generate_exact_paths(fixed_seed,
+                                                               day_count)
+            return
         M = len(self.time_grid)
         I = self.paths
-        paths = np.zeros((M, I))
-        paths_ = np.zeros_like(paths)
+        # two path arrays and random numbers
+        self.check_memory(M, I, 3)
+        paths = self.get_path_array(M, I)
+        paths_ = self.get_path_array(M, I, record=False)
         paths[0] = self.initial_value
         paths_[0] = self.initial_value
-        if self.correlated is False:
-            rand = sn_random_numbers((1, M, I),
-                                     fixed_seed=fixed_seed)
-        else:
-            rand = self.random_numbers
-        
-        pdb.set_trace()
-        for t in range(1, len(self.time_grid)):
-            dt = (self.time_grid[t] - self.time_grid[t - 1]).days / day_count
-            if self.correlated is False:
-                ran = rand[t]
-            else:
-                ran = np.dot(self.cholesky_matrix, rand[:, t, :])
-                ran = ran[self.rn_set]
+        # own or correlated standard normal numbers, read step by step
+        ran = chunked_random_numbers(
+            self.iter_diffusion_random_chunks(M, I, fixed_seed), M, I)
+        dt = np.diff(get_year_deltas(self.time_grid, day_count))
 
+        for t in range(1, M):
             # full truncation Euler discretization
             # Cox-Ingersoll-Ross model
             # Exactly the same as the mean reversion calculation except the weiner process product is multiplied
             # by the sqrt of the previous steps value...TODO: why is that helpful?
-            paths_[t] = (paths_[t - 1] + self.kappa * (self.theta - np.maximum(0, paths_[t - 1])) * dt +
-                         np.sqrt(np.maximum(0, paths_[t - 1])) * self.volatility * np.sqrt(dt) * ran)
+            paths_[t] = (paths_[t - 1] + self.kappa * (self.theta - np.maximum(0, paths_[t - 1])) * dt[t - 1] +
+                         np.sqrt(np.maximum(0, paths_[t - 1])) * self.volatility * np.sqrt(dt[t - 1]) * ran[t])
             paths[t] = np.maximum(0, paths_[t])
-        self.instrument_values = paths
+        self.instrument_values = self.get_stored_values(paths)
+
+    def generate_exact_paths(self, fixed_seed=True, day_count=365.):
+        ''' Returns paths sampled from the exact transition of the process:
+        x[t] = c * X with X noncentral chi-square distributed with
+        df = 4 * kappa * theta / vol ** 2 degrees of freedom and
+        non-centrality x[t - 1] * exp(-kappa * dt) / c, where
+        c = vol ** 2 * (1 - exp(-kappa * dt)) / (4 * kappa). '''
+        if self.kappa <= 0 or self.theta <= 0 or self.volatility <= 0:
+            raise ValueError('Exact sampling needs positive kappa, theta '
+                             'and volatility.')
+        M = len(self.time_grid)
+        I = self.paths
+        # one path array and the draws of one step
+        self.check_memory(M, I, 1)
+        paths = self.get_path_array(M, I)
+        paths[0] = self.initial_value
+        dt = np.diff(get_year_deltas(self.time_grid, day_count))
+        decay = np.exp(-self.kappa * dt)
+        c = self.volatility ** 2 * (1 - decay) / (4 * self.kappa)
+        df = 4 * self.kappa * self.theta / self.volatility ** 2
+        # one stream per block of paths, as in a block by block run
+        blocks = list(self.iter_random_generators('transition', fixed_seed))
+        # float64 state, the draws need non-negative non-centralities
+        state = np.full(I, max(self.initial_value, 0.))
+        for t in range(1, M):
+            nonc = state * (decay[t - 1] / c[t - 1])
+            for start, n, rng in blocks:
+                state[start:start + n] = c[t - 1] * rng.noncentral_chisquare(
+                    df, nonc[start:start + n])
+            paths[t] = state
+        return self.get_stored_values(paths)
 
 
 class stochastic_short_rate(object):
@@ -109,34 +147,92 @@ class stochastic_short_rate(object):
                 mar_env.get_constant('currency')
             except:
                 mar_env.add_constant('currency', 'CUR')  # dummy
-            self.process = square_root_diffusion('process', mar_env)
+            # exact transition: no discretization bias on coarse grids
+            self.process = square_root_diffusion('process', mar_env,
+                                                 scheme='exact')
             self.process.generate_paths()
         except:
             raise ValueError('Error parsing market environment.')
 
-    def get_forward_rates(self, time_list, paths, dtobjects=True):
+    def get_forward_rates(self, time_list, paths, dtobjects=True,
+                          path_offset=0):
+        ''' Simulated short rates; path_offset is the number of the first
+        path (e.g. of a block of paths valued block by block). '''
         if len(self.process.time_grid) != len(time_list) \
-                or self.process.paths != paths:
+                or self.process.paths != paths \
+                or self.process.path_offset != path_offset:
             self.process.paths = paths
+            self.process.path_offset = path_offset
             self.process.time_grid = time_list
             self.process.instrument_values = None
         rates = self.process.get_instrument_values()
         return time_list, rates
 
-    def get_discount_factors(self, time_list, paths, dtobjects=True):
-        discount_factors = []
+    def get_discount_factors(self, time_list, paths, dtobjects=True,
+                             dtype=None, dates=None, path_offset=0):
+        ''' Pathwise discount factors from the last date back to each date.
+        Parameters
+        ==========
+        dtype : NumPy dtype
+            precision of the returned factors; e.g. np.float32 halves the
+            memory of the (M, I) result, which is computed in place
+        dates : list of datetime objects (year fractions if dtobjects=False)
+            if given, only the factors for these dates are returned as a
+            (len(dates), I) array, without building the full (M, I) matrix
+        path_offset : int
+            number of the first path, for the paths of one block of a
+            block by block valuation
+        '''
         if dtobjects is True:
             dlist = get_year_deltas(time_list)
         else:
-            dlist = time_list
-        forward_rate = self.get_forward_rates(time_list, paths, dtobjects)[1]
-        for no in range(len(dlist)):
-            factor = np.zeros_like(forward_rate[0, :])
-            for d in range(no, len(dlist) - 1):
-                factor += ((dlist[d + 1] - dlist[d]) *
-                           (0.5 * (forward_rate[d + 1] + forward_rate[d])))
-            discount_factors.append(np.exp(-factor))
-        return time_list, np.array(discount_factors)
+            dlist = np.asarray(time_list, dtype=float)
+        forward_rate = self.get_forward_rates(time_list, paths, dtobjects,
+                                              path_offset)[1]
+        half_steps = 0.5 * np.diff(dlist)
+        if dtype is None:
+            dtype = forward_rate.dtype
+        if dates is None and np.dtype(dtype).itemsize < 8:
+            # reduced precision: accumulate the integral in float64 row by
+            # row and only store the factors in dtype
+            factor = np.empty(forward_rate.shape, dtype=dtype)
+            factor[-1] = 1.
+            integral = np.zeros(forward_rate.shape[1:])
+            for t in range(len(dlist) - 2, -1, -1):
+                integral += half_steps[t] * (forward_rate[t + 1].astype(float) +
+                                             forward_rate[t])
+                factor[t] = np.exp(-integral)
+            return time_list, factor
+        if dates is None:
+            # trapezoid increments, then reverse cumulative sum in place
+            factor = np.empty(forward_rate.shape, dtype=dtype)
+            factor[-1] = 0.
+            np.add(forward_rate[1:], forward_rate[:-1], out=factor[:-1])
+            factor[:-1] *= half_steps[:, np.newaxis].astype(dtype)
+            np.cumsum(factor[::-1], axis=0, out=factor[::-1])
+            np.negative(factor, out=factor)
+            np.exp(factor, out=factor)
+            return time_list, factor
+        position = {d: i for i, d in enumerate(time_list)}
+        try:
+            rows = [position[d] for d in dates]
+        except KeyError:
+            raise ValueError('Requested date not in time list.')
+        # running forward integral (in float64) recorded at the requested
+        # rows; the factor for row k is exp(-(S_end - S_k))
+        wanted = {}
+        for n, r in enumerate(rows):
+            wanted.setdefault(r, []).append(n)
+        integral = np.zeros(forward_rate.shape[1:])
+        recorded = np.empty((len(rows),) + forward_rate.shape[1:])
+        for t in range(len(dlist)):
+            if t > 0:
+                integral += half_steps[t - 1] * (forward_rate[t] +
+                                                 forward_rate[t - 1])
+            for n in wanted.get(t, ()):
+                recorded[n] = integral
+        discount_factors = np.exp(recorded - integral).astype(dtype, copy=False)
+        return dates, discount_factors
 
 
 def srd_forwards(initial_value, kts, time_grid):
@@ -168,4 +264,45 @@ def srd_forwards(initial_value, kts, time_grid):
     sum2 = initial_value * ((4 * g ** 2 * np.exp(g * t)) /
                             (2 * g + (kappa + g) * (np.exp(g * t) - 1)) ** 2)
     forwards = sum1 + sum2
-    return forwards
\ No newline at end of file
+    return forwards
+
+
+def srd_forwards_jacobian(initial_value, kts, time_grid):
+    ''' Function for the analytic derivatives of the forward vols/rates
+    of srd_forwards with respect to (kappa, theta, sigma).
+    Parameters
+    ==========
+    initial_value : float
+        initial value of the process
+    kts :
+        (kappa, theta, sigma)
+    time_grid : list/array of datetime object
+        dates to generate forwards for
+    Returns
+    =======
+    jacobian : array (len(time_grid), 3)
+        derivatives of the forwards
+    '''
+    kappa, theta, sigma = kts
+    t = get_year_deltas(time_grid)
+    g = math.sqrt(kappa ** 2 + 2 * sigma ** 2)
+    e = np.exp(g * t)
+    # forwards = a / d + initial_value * b / d ** 2
+    a = kappa * theta * (e - 1)
+    b = 4 * g ** 2 * e
+    d = 2 * g + (kappa + g) * (e - 1)
+    # partial derivatives with respect to g
+    a_g = kappa * theta * t * e
+    b_g = 8 * g * e + 4 * g ** 2 * t * e
+    d_g = 2 + (e - 1) + (kappa + g) * t * e
+
+    def total(da, db, dd):
+        return ((da * d - a * dd) / d ** 2 +
+                initial_value * (db * d - 2 * b * dd) / d ** 3)
+    g_kappa, g_sigma = kappa / g, 2 * sigma / g
+    jacobian = np.empty((len(t), 3))
+    jacobian[:, 0] = total(theta * (e - 1) + a_g * g_kappa, b_g * g_kappa,
+                           (e - 1) + d_g * g_kappa)
+    jacobian[:, 1] = total(kappa * (e - 1), 0., 0.)
+    jacobian[:, 2] = total(a_g * g_sigma, b_g * g_sigma, d_g * g_sigma)
+    return jacobian
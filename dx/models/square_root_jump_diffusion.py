@@ -1,5 +1,5 @@
 from ..frame import *
-from .simulation_class import simulation_class
+from .simulation_class import simulation_class, chunked_random_numbers
 from .square_root_diffusion import *
 
 
@@ -62,28 +62,28 @@ class square_root_jump_diffusion(simulation_class):
             self.generate_time_grid()
         M = len(self.time_grid)
         I = self.paths
-        paths = np.zeros((M, I))
-        paths_ = np.zeros_like(paths)
+        # two path arrays and random numbers, the jumps are sparse
+        self.check_memory(M, I, 3)
+        paths = self.get_path_array(M, I)
+        paths_ = self.get_path_array(M, I, record=False)
         paths[0] = self.initial_value
         paths_[0] = self.initial_value
-        if self.correlated is False:
-            rand = sn_random_numbers((1, M, I), fixed_seed=fixed_seed)
-        else:
-            rand = self.random_numbers
-        snr = sn_random_numbers((1, M, I), fixed_seed=fixed_seed)
+        # own or correlated standard normal numbers, read step by step
+        ran = chunked_random_numbers(
+            self.iter_diffusion_random_chunks(M, I, fixed_seed), M, I)
+        # jump times and sizes of all paths drawn up front
+        bounds, jump_index, jump_factors = self.generate_jumps(fixed_seed,
+                                                               day_count)
+        dt = np.diff(get_year_deltas(self.time_grid, day_count))
         
         # rj --> drift correction for the riskless rate so jumps maintain risk neutrality
         rj = self.lamb * (np.exp(self.mu + 0.5 * self.delt ** 2) - 1)
 
-        pdb.set_trace()
-        for t in range(1, len(self.time_grid)):
-            dt = (self.time_grid[t] - self.time_grid[t - 1]).days / day_count
-            if self.correlated is False:
-                ran = rand[t]
-            else:
-                ran = np.dot(self.cholesky_matrix, rand[:, t, :])
-                ran = ran[self.rn_set]
-            poi = np.random.poisson(self.lamb * dt, I)
+        for t in range(1, M):
+            # jump factors (e^(mu + delta * rand) - 1) of the paths that jump
+            jump = np.zeros(I)
+            jumps = slice(bounds[t], bounds[t + 1])
+            jump[jump_index[jumps]] = jump_factors[jumps]
             
             # full truncation Euler discretization
             # Same mean reversion as sqrt calc diff  --> kappa * (theta - prev value)
@@ -91,11 +91,17 @@ class square_root_jump_diffusion(simulation_class):
             # Same jump diffusion as other jd models --> (mu + delta * stoch var)
             # rj * dt is the drift correction
             # Can have positive jumps, ex: volatility
-            paths_[t, :] = (paths_[t - 1, :] + self.kappa * (self.theta - np.maximum(0, paths_[t - 1, :])) * dt +
-                            np.sqrt(np.maximum(0, paths_[t - 1, :])) * self.volatility * np.sqrt(dt) * ran +
-                            ((np.exp(self.mu + self.delt * snr[t]) - 1) * poi) * np.maximum(0, paths_[t - 1, :]) - rj * dt)
+            paths_[t, :] = (paths_[t - 1, :] + self.kappa * (self.theta - np.maximum(0, paths_[t - 1, :])) * dt[t - 1] +
+                            np.sqrt(np.maximum(0, paths_[t - 1, :])) * self.volatility * np.sqrt(dt[t - 1]) * ran[t] +
+                            jump * np.maximum(0, paths_[t - 1, :]) - rj * dt[t - 1])
             paths[t, :] = np.maximum(0, paths_[t, :])
-        self.instrument_values = paths
+        self.instrument_values = self.get_stored_values(paths)
+
+
+# term structure calibrations: (term structure, initial value) -->
+# (parameters, shift base)
+_shift_base_cache = OrderedDict()
+_shift_base_cache_size = 32
 
 
 class square_root_jump_diffusion_plus(square_root_jump_diffusion):
@@ -114,7 +120,8 @@ class square_root_jump_diffusion_plus(square_root_jump_diffusion):
     srd_forward_error :
         error function for forward rate/vols calibration
     generate_shift_base :
-        generates a shift base to take term structure into account
+        generates a shift base to take term structure into account,
+        calibrated by least squares and cached per term structure
     update :
         updates parameters
     update_shift_values :
@@ -137,6 +144,9 @@ class square_root_jump_diffusion_plus(square_root_jump_diffusion):
         self.forward_rates = []
         self.shift_base = None
         self.shift_values = []
+        # last calibrated (kappa, theta, sigma), warm start of the next fit
+        self.shift_parameters = None
+        self._shift_state = None
 
     def srd_forward_error(self, p0):
         if p0[0] < 0 or p0[1] < 0 or p0[2] < 0:
@@ -148,25 +158,59 @@ class square_root_jump_diffusion_plus(square_root_jump_diffusion):
                       f_model) ** 2) / len(f_model)
         return MSE
 
-    def generate_shift_base(self, p0):
-        # TODO: No idea whats going on here
-        # calibration
-        opt = sco.fmin(self.srd_forward_error, p0)
+    def generate_shift_base(self, p0=None):
+        ''' Calibrates srd_forwards (kappa, theta, sigma) to the term
+        structure by least squares with the analytic Jacobian, starting
+        from p0 or the previous fit, and stores the remaining shifts in
+        shift_base. Results are cached on the term structure contents and
+        the initial value. '''
+        key = (tuple(self.term_structure[:, 0]),
+               tuple(float(v) for v in self.term_structure[:, 1]),
+               float(self.initial_value))
+        cached = _shift_base_cache.get(key)
+        if cached is not None:
+            _shift_base_cache.move_to_end(key)
+            self.shift_parameters, self.shift_base = cached
+            return
+        # calibration, warm start from the previous fit
+        if self.shift_parameters is not None:
+            p0 = self.shift_parameters
+        elif p0 is None:
+            raise ValueError('Initial parameters (kappa, theta, sigma) '
+                             'needed.')
+        dates = self.term_structure[:, 0]
+        target = self.term_structure[:, 1].astype(float)
+        opt = sco.least_squares(
+            lambda p: srd_forwards(self.initial_value, p, dates) - target,
+            np.maximum(np.array(p0, dtype=float), 0.),
+            jac=lambda p: srd_forwards_jacobian(self.initial_value, p, dates),
+            bounds=(0., np.inf)).x
         # shift_calculation
-        f_model = srd_forwards(self.initial_value, opt, self.term_structure[:, 0])
-        shifts = self.term_structure[:, 1] - f_model
-        self.shift_base = np.array((self.term_structure[:, 0], shifts)).T
+        f_model = srd_forwards(self.initial_value, opt, dates)
+        shifts = target - f_model
+        self.shift_parameters = opt
+        self.shift_base = np.array((dates, shifts)).T
+        _shift_base_cache[key] = (opt, self.shift_base)
+        if len(_shift_base_cache) > _shift_base_cache_size:
+            _shift_base_cache.popitem(last=False)
 
     def update_shift_values(self, k=1):
-        # TODO: No idea whats going on here
+        ''' Interpolates the shift base on the time grid; recomputed only
+        if the shift base, the time grid or k changed. '''
+        self.generate_time_grid()
+        state = (self.shift_base, self.time_grid, k)
+        if (self._shift_state is not None and
+                all(a is b for a, b in zip(state, self._shift_state)) and
+                state[2] == self._shift_state[2]):
+            return
         if self.shift_base is not None:
             t = get_year_deltas(self.shift_base[:, 0])
             tck = sci.splrep(t, self.shift_base[:, 1], k=k)
-            self.generate_time_grid()
             st = get_year_deltas(self.time_grid)
             self.shift_values = np.array(list(zip(self.time_grid, sci.splev(st, tck, der=0))))
         else:
             self.shift_values = np.array(list(zip(self.time_grid, np.zeros(len(self.time_grid)))))
+        self._shift_state = state
 
     def generate_paths(self, fixed_seed=True, day_count=365.):
         if self.time_grid is None:
@@ -174,17 +218,19 @@ class square_root_jump_diffusion_plus(square_root_jump_diffusion):
         self.update_shift_values()
         M = len(self.time_grid)
         I = self.paths
-        paths = np.zeros((M, I))
-        paths_ = np.zeros_like(paths)
+        # two path arrays and random numbers, the jumps are sparse
+        self.check_memory(M, I, 3)
+        paths = self.get_path_array(M, I)
+        paths_ = self.get_path_array(M, I, record=False)
         paths[0] = self.initial_value
         paths_[0] = self.initial_value
-        if self.correlated is False:
-            rand = sn_random_numbers((1, M, I),
-                                     fixed_seed=fixed_seed)
-        else:
-            rand = self.random_numbers
-        snr = sn_random_numbers((1, M, I),
-                                fixed_seed=fixed_seed)
+        # own or correlated standard normal numbers, read step by step
+        ran = chunked_random_numbers(
+            self.iter_diffusion_random_chunks(M, I, fixed_seed), M, I)
+        # jump times and sizes of all paths drawn up front
+        bounds, jump_index, jump_factors = self.generate_jumps(fixed_seed,
+                                                               day_count)
+        dt = np.diff(get_year_deltas(self.time_grid, day_count))
                                 
         # forward_rates = self.discount_curve.get_forward_rates(
         #    self.time_grid, dtobjects=True)
@@ -192,24 +238,20 @@ class square_root_jump_diffusion_plus(square_root_jump_diffusion):
         # rj --> drift correction for the riskless rate so jumps maintain risk neutrality
         rj = self.lamb * (np.exp(self.mu + 0.5 * self.delt ** 2) - 1)
         
-        pdb.set_trace()
-        for t in range(1, len(self.time_grid)):
-            dt = (self.time_grid[t] - self.time_grid[t - 1]).days / day_count
-            if self.correlated is False:
-                ran = rand[t]
-            else:
-                ran = np.dot(self.cholesky_matrix, rand[:, t, :])
-                ran = ran[self.rn_set]
-            poi = np.random.poisson(self.lamb * dt, I)
+        for t in range(1, M):
+            # jump factors (e^(mu + delta * rand) - 1) of the paths that jump
+            jump = np.zeros(I)
+            jumps = slice(bounds[t], bounds[t + 1])
+            jump[jump_index[jumps]] = jump_factors[jumps]
             
             # full truncation Euler discretization
             # Brigo-Mercurio model incorporating term structure
             # After adjustments made for term structure, this calc is identical to sqrt_jump_diff above
-            paths_[t] = (paths_[t - 1] + self.kappa * (self.theta - np.maximum(0, paths_[t - 1])) * dt + 
-                        np.sqrt(np.maximum(0, paths_[t - 1])) * self.volatility * np.sqrt(dt) * ran + 
-                        ((np.exp(self.mu + self.delt * snr[t]) - 1) * poi) * np.maximum(0, paths_[t - 1]) - rj * dt)
+            paths_[t] = (paths_[t - 1] + self.kappa * (self.theta - np.maximum(0, paths_[t - 1])) * dt[t - 1] + 
+                        np.sqrt(np.maximum(0, paths_[t - 1])) * self.volatility * np.sqrt(dt[t - 1]) * ran[t] + 
+                        jump * np.maximum(0, paths_[t - 1]) - rj * dt[t - 1])
             paths[t] = np.maximum(0, paths_[t]) + self.shift_values[t, 1]
-        self.instrument_values = paths
+        self.instrument_values = self.get_stored_values(paths)
 
     def update_forward_rates(self, time_grid=None):
         #TODO: No idea whats going on here
@@ -1,5 +1,6 @@
 from ..frame import *
-from .simulation_class import simulation_class
+from .simulation_class import simulation_class, chunked_random_numbers
+from .stochastic_volatility import qe_step
 
 
 class stoch_vol_jump_diffusion(simulation_class):
@@ -13,18 +14,30 @@ class stoch_vol_jump_diffusion(simulation_class):
         market environment data for simulation
     corr : boolean
         True if correlated with other model object
+    scheme : string
+        'euler' (default) for the full truncation Euler discretization of
+        the variance or 'qe' for the quadratic-exponential scheme with
+        martingale correction (small bias also for large steps)
     Methods
     =======
     update :
         updates parameters
     generate_paths :
         returns Monte Carlo paths for the market environment
+    generate_qe_paths :
+        returns Monte Carlo paths based on the QE scheme
     get_volatility_values :
         returns array with simulated volatility paths
     '''
 
-    def __init__(self, name, mar_env, corr=False):
+    # the paths scale linearly in initial_value
+    homogeneous = True
+
+    def __init__(self, name, mar_env, corr=False, scheme='euler'):
         super(stoch_vol_jump_diffusion, self).__init__(name, mar_env, corr)
+        if scheme not in ('euler', 'qe'):
+            raise ValueError("Scheme must be 'euler' or 'qe'.")
+        self.scheme = scheme
         try:
             self.lamb = mar_env.get_constant('lambda')
             self.mu = mar_env.get_constant('mu')
@@ -76,39 +89,43 @@ class stoch_vol_jump_diffusion(simulation_class):
     def generate_paths(self, fixed_seed=True, day_count=365.):
         if self.time_grid is None:
             self.generate_time_grid()
+        if self.scheme == 'qe':
+            self.generate_qe_paths(fixed_seed, day_count)
+            return
         M = len(self.time_grid)
         I = self.paths
-        paths = np.zeros((M, I))
-        va = np.zeros_like(paths)
-        va_ = np.zeros_like(paths)
+        # paths, two volatility arrays and two random number arrays,
+        # the jumps are sparse
+        self.check_memory(M, I, 5)
+        paths = self.get_path_array(M, I)
+        va = self.get_path_array(M, I)
+        va_ = self.get_path_array(M, I, record=False)
         paths[0] = self.initial_value
         va[0] = self.volatility ** 2
         va_[0] = self.volatility ** 2
         
         # Pseudo-random numbers for the monte-carlo simulation
-        if self.correlated is False:
-            sn1 = sn_random_numbers((1, M, I), fixed_seed=fixed_seed)
-        else:
-            sn1 = self.random_numbers
+        # own or correlated (shared) numbers, read step by step
+        sn1 = chunked_random_numbers(
+            self.iter_diffusion_random_chunks(M, I, fixed_seed), M, I)
+
+        # jump times and sizes of all paths drawn up front
+        bounds, jump_index, jump_factors = self.generate_jumps(fixed_seed,
+                                                               day_count)
 
-        # Pseudo-random numbers for the jump component
-        sn2 = sn_random_numbers((1, M, I), fixed_seed=fixed_seed)
-        
         # Pseudo-random numbers for the stochastic volatility
-        sn3 = sn_random_numbers((1, M, I), fixed_seed=fixed_seed)
+        sn3 = self.generate_random_numbers(M, I, 'volatility',
+                                           fixed_seed=fixed_seed)
 
         forward_rates = self.discount_curve.get_forward_rates(
-            self.time_grid, self.paths, dtobjects=True)[1]
+            self.time_grid, self.paths, dtobjects=True,
+            path_offset=self.path_offset)[1]
 
         rj = self.lamb * (np.exp(self.mu + 0.5 * self.delt ** 2) - 1)
 
         for t in range(1, len(self.time_grid)):
             dt = (self.time_grid[t] - self.time_grid[t - 1]).days / day_count
-            if self.correlated is False:
-                ran = sn1[t]
-            else:
-                ran = np.dot(self.cholesky_matrix, sn1[:, t, :])
-                ran = ran[self.rn_set]
+            ran = sn1[t]
             rat = np.array([ran, sn3[t]])
             rat = np.dot(self.leverage, rat)
 
@@ -116,17 +133,60 @@ class stoch_vol_jump_diffusion(simulation_class):
                       np.sqrt(np.maximum(0, va_[t - 1])) * self.vol_vol * np.sqrt(dt) * rat[1])
             va[t] = np.maximum(0, va_[t])
 
-            poi = np.random.poisson(self.lamb * dt, I)
-
             rt = (forward_rates[t - 1] + forward_rates[t]) / 2
-            paths[t] = paths[t - 1] * (np.exp((rt - rj - 0.5 * va[t]) * dt + 
-                       np.sqrt(va[t]) * np.sqrt(dt) * rat[0]) + (np.exp(self.mu + self.delt * sn2[t]) - 1) * poi)
+            factor = np.exp((rt - rj - 0.5 * va[t]) * dt +
+                            np.sqrt(va[t]) * np.sqrt(dt) * rat[0])
+            # jump factors (e^(mu + delta * rand) - 1) of the paths that jump
+            jumps = slice(bounds[t], bounds[t + 1])
+            factor[jump_index[jumps]] += jump_factors[jumps]
+            paths[t] = paths[t - 1] * factor
 
             # moment matching stoch vol part
-            paths[t] -= np.mean(paths[t - 1] * np.sqrt(va[t]) * math.sqrt(dt) * rat[0])
+            # (per block of paths, as blocked runs have to match full runs)
+            paths[t] -= self.get_block_means(paths[t - 1] * np.sqrt(va[t]) * math.sqrt(dt) * rat[0])
+
+        self.instrument_values = self.get_stored_values(paths)
+        self.volatility_values = np.sqrt(self.get_stored_values(va))
 
-        self.instrument_values = paths
-        self.volatility_values = np.sqrt(va)
+    def generate_qe_paths(self, fixed_seed=True, day_count=365.):
+        ''' Simulates the variance with the QE scheme (see qe_step) and the
+        price with the martingale corrected log increments plus the log
+        jump sizes. '''
+        M = len(self.time_grid)
+        I = self.paths
+        # paths, variance and two random number arrays
+        self.check_memory(M, I, 4)
+        paths = self.get_path_array(M, I)
+        va = self.get_path_array(M, I)
+        paths[0] = self.initial_value
+        va[0] = self.volatility ** 2
+        # price (own or correlated) and variance numbers, sparse jumps
+        sn1 = chunked_random_numbers(
+            self.iter_diffusion_random_chunks(M, I, fixed_seed), M, I)
+        bounds, jump_index, jump_sizes = self.generate_jumps(
+            fixed_seed, day_count, log_sizes=True)
+        sn3 = self.generate_random_numbers(M, I, 'volatility',
+                                           fixed_seed=fixed_seed)
+        forward_rates = self.discount_curve.get_forward_rates(
+            self.time_grid, self.paths, dtobjects=True,
+            path_offset=self.path_offset)[1]
+        dt = np.diff(get_year_deltas(self.time_grid, day_count))
+        rj = self.lamb * (np.exp(self.mu + 0.5 * self.delt ** 2) - 1)
+        # float64 state of the variance
+        v = np.full(I, self.volatility ** 2)
+        for t in range(1, M):
+            v, log_increment = qe_step(v, dt[t - 1], self.kappa, self.theta,
+                                       self.vol_vol, self.rho, sn3[t],
+                                       sn1[t])
+            rt = (forward_rates[t - 1] + forward_rates[t]) / 2
+            log_factor = (rt - rj) * dt[t - 1] + log_increment
+            # jumps multiply the diffusion move (exact compound Poisson)
+            jumps = slice(bounds[t], bounds[t + 1])
+            log_factor[jump_index[jumps]] += jump_sizes[jumps]
+            paths[t] = paths[t - 1] * np.exp(log_factor)
+            va[t] = v
+        self.instrument_values = self.get_stored_values(paths)
+        self.volatility_values = np.sqrt(self.get_stored_values(va))
 
     def get_volatility_values(self):
         if self.volatility_values is None:
@@ -1,5 +1,68 @@
 from ..frame import *
-from .simulation_class import simulation_class
+from .simulation_class import simulation_class, chunked_random_numbers
+
+
+def qe_step(v, dt, kappa, theta, vol_vol, rho, zv, zx, psi_c=1.5):
+    ''' One step of the quadratic-exponential (QE) scheme of Andersen
+    (2008) for the Heston variance with the martingale corrected log price
+    increment (central discretization, gamma1 = gamma2 = 0.5).
+    Parameters
+    ==========
+    v : array (I,)
+        variance at the start of the step
+    dt : float
+        step size in years
+    kappa, theta, vol_vol, rho : float
+        parameters of the variance process and price/variance correlation
+    zv, zx : array (I,)
+        independent standard normal numbers for variance and price
+    psi_c : float
+        switching level between the quadratic and exponential sampling
+    Returns
+    =======
+    v_new : array (I,)
+        variance at the end of the step (non-negative)
+    log_increment : array (I,)
+        increment of the log price without the short rate drift, such that
+        the discounted price is a martingale
+    '''
+    decay = math.exp(-kappa * dt)
+    m = theta + (v - theta) * decay
+    s2 = (v * vol_vol ** 2 * decay / kappa * (1 - decay) +
+          theta * vol_vol ** 2 / (2 * kappa) * (1 - decay) ** 2)
+    psi = s2 / np.maximum(m, 1e-300) ** 2
+    quadratic = psi <= psi_c
+    # quadratic sampling: v_new = a * (b + zv) ** 2
+    inv = 2 / np.where(quadratic, psi, psi_c)
+    b2 = np.maximum(inv - 1 + np.sqrt(inv * (inv - 1)), 0.)
+    a = m / (1 + b2)
+    # exponential sampling: mass p at 0, exponential tail with rate beta
+    p = np.where(quadratic, 0., (psi - 1) / (psi + 1))
+    beta = (1 - p) / np.maximum(m, 1e-300)
+    u = scs.ndtr(zv)
+    with np.errstate(divide='ignore'):
+        tail = np.log((1 - p) / np.maximum(1 - u, 1e-300)) / beta
+    v_new = np.where(quadratic, a * (np.sqrt(b2) + zv) ** 2,
+                     np.where(u <= p, 0., tail))
+
+    k1 = 0.5 * dt * (kappa * rho / vol_vol - 0.5) - rho / vol_vol
+    k2 = 0.5 * dt * (kappa * rho / vol_vol - 0.5) + rho / vol_vol
+    k3 = k4 = 0.5 * dt * (1 - rho ** 2)
+    # martingale correction: k0 = -log E[exp(A * v_new)] - (k1 + k3 / 2) * v
+    A = k2 + 0.5 * k4
+    with np.errstate(divide='ignore', invalid='ignore'):
+        q = 1 - 2 * A * a
+        log_mgf = np.where(quadratic,
+                           A * b2 * a / q - 0.5 * np.log(q),
+                           np.log(p + beta * (1 - p) / (beta - A)))
+    # without a finite moment generating function (very large vol_vol
+    # and steps) the uncorrected drift of the scheme is used
+    valid = np.where(quadratic, q > 0, beta > A)
+    k0 = np.where(valid, -log_mgf - (k1 + 0.5 * k3) * v,
+                  -rho * kappa * theta * dt / vol_vol)
+    log_increment = (k0 + k1 * v + k2 * v_new +
+                     np.sqrt(np.maximum(k3 * v + k4 * v_new, 0.)) * zx)
+    return v_new, log_increment
 
 
 class stochastic_volatility(simulation_class):
@@ -13,18 +76,30 @@ class stochastic_volatility(simulation_class):
         market environment data for simulation
     corr : boolean
         True if correlated with other model object
+    scheme : string
+        'euler' (default) for the full truncation Euler discretization of
+        the variance or 'qe' for the quadratic-exponential scheme with
+        martingale correction (small bias also for large steps)
     Methods
     =======
     update :
         updates parameters
     generate_paths :
         returns Monte Carlo paths given the market environment
+    generate_qe_paths :
+        returns Monte Carlo paths based on the QE scheme
     get_volatility_values :
         returns array with simulated volatility paths
     '''
 
-    def __init__(self, name, mar_env, corr=False):
+    # the paths scale linearly in initial_value
+    homogeneous = True
+
+    def __init__(self, name, mar_env, corr=False, scheme='euler'):
         super(stochastic_volatility, self).__init__(name, mar_env, corr)
+        if scheme not in ('euler', 'qe'):
+            raise ValueError("Scheme must be 'euler' or 'qe'.")
+        self.scheme = scheme
         try:
             self.kappa = mar_env.get_constant('kappa')
             self.theta = mar_env.get_constant('theta')
@@ -64,35 +139,35 @@ class stochastic_volatility(simulation_class):
     def generate_paths(self, fixed_seed=False, day_count=365.):
         if self.time_grid is None:
             self.generate_time_grid()
+        if self.scheme == 'qe':
+            self.generate_qe_paths(fixed_seed, day_count)
+            return
         M = len(self.time_grid)
         I = self.paths
-        paths = np.zeros((M, I))
-        va = np.zeros_like(paths)
-        va_ = np.zeros_like(paths)
+        # paths, two volatility arrays and two random number arrays
+        self.check_memory(M, I, 5)
+        paths = self.get_path_array(M, I)
+        va = self.get_path_array(M, I)
+        va_ = self.get_path_array(M, I, record=False)
         paths[0] = self.initial_value
         va[0] = self.volatility ** 2
         va_[0] = self.volatility ** 2
-        if self.correlated is False:
-            sn1 = sn_random_numbers((1, M, I),
-                                    fixed_seed=fixed_seed)
-        else:
-            # Pseudo random numbers for the monte carlo
-            sn1 = self.random_numbers
+        # own or correlated (shared) numbers, read step by step
+        sn1 = chunked_random_numbers(
+            self.iter_diffusion_random_chunks(M, I, fixed_seed), M, I)
         
         # Pseudo-random numbers for the stochastic volatility
-        sn2 = sn_random_numbers((1, M, I), fixed_seed=fixed_seed)
+        sn2 = self.generate_random_numbers(M, I, 'volatility',
+                                           fixed_seed=fixed_seed)
 
         
         forward_rates = self.discount_curve.get_forward_rates(
-            self.time_grid, self.paths, dtobjects=True)[1]
+            self.time_grid, self.paths, dtobjects=True,
+            path_offset=self.path_offset)[1]
 
         for t in range(1, len(self.time_grid)):
             dt = (self.time_grid[t] - self.time_grid[t - 1]).days / day_count
-            if self.correlated is False:
-                ran = sn1[t]
-            else:
-                ran = np.dot(self.cholesky_matrix, sn1[:, t, :])
-                ran = ran[self.rn_set]
+            ran = sn1[t]
             
             # rat = the pair of random numbers we need for each path
             rat = np.array([ran, sn2[t]])
@@ -113,10 +188,43 @@ class stochastic_volatility(simulation_class):
             
             # moment matching stoch vol part
             # moment matching ensures std dev = 1 for normal distribution
-            paths[t] -= np.mean(paths[t - 1] * np.sqrt(va[t]) * math.sqrt(dt) * rat[0])
+            # (per block of paths, as blocked runs have to match full runs)
+            paths[t] -= self.get_block_means(paths[t - 1] * np.sqrt(va[t]) * math.sqrt(dt) * rat[0])
 
-        self.instrument_values = paths
-        self.volatility_values = np.sqrt(va)
+        self.instrument_values = self.get_stored_values(paths)
+        self.volatility_values = np.sqrt(self.get_stored_values(va))
+
+    def generate_qe_paths(self, fixed_seed=False, day_count=365.):
+        ''' Simulates the variance with the QE scheme (see qe_step) and the
+        price with the martingale corrected log increments. '''
+        M = len(self.time_grid)
+        I = self.paths
+        # paths, variance and two random number arrays
+        self.check_memory(M, I, 4)
+        paths = self.get_path_array(M, I)
+        va = self.get_path_array(M, I)
+        paths[0] = self.initial_value
+        va[0] = self.volatility ** 2
+        # price (own or correlated) and variance numbers, independent
+        sn1 = chunked_random_numbers(
+            self.iter_diffusion_random_chunks(M, I, fixed_seed), M, I)
+        sn2 = self.generate_random_numbers(M, I, 'volatility',
+                                           fixed_seed=fixed_seed)
+        forward_rates = self.discount_curve.get_forward_rates(
+            self.time_grid, self.paths, dtobjects=True,
+            path_offset=self.path_offset)[1]
+        dt = np.diff(get_year_deltas(self.time_grid, day_count))
+        # float64 state of the variance
+        v = np.full(I, self.volatility ** 2)
+        for t in range(1, M):
+            v, log_increment = qe_step(v, dt[t - 1], self.kappa, self.theta,
+                                       self.vol_vol, self.rho, sn2[t],
+                                       sn1[t])
+            rt = (forward_rates[t - 1] + forward_rates[t]) / 2
+            paths[t] = paths[t - 1] * np.exp(rt * dt[t - 1] + log_increment)
+            va[t] = v
+        self.instrument_values = self.get_stored_values(paths)
+        self.volatility_values = np.sqrt(self.get_stored_values(va))
 
     def get_volatility_values(self):
         if self.volatility_values is None:
@@ -43,12 +43,6 @@ class interest_rate_swap(object):
             self.discount_curve = underlying.discount_curve
             self.underlying = underlying
             self.payoff = None
-
-            # provide selected dates to underlying
-            self.underlying.special_dates.extend([self.pricing_date,
-                                                  self.effective_date,
-                                                  self.payment_date,
-                                                  self.termination_date])
         except:
             print('Error parsing market environment.')
 
@@ -58,10 +52,11 @@ class interest_rate_swap(object):
         self.payment_dates = [d.replace(day=self.payment_day)
                               for d in self.payment_dates]
         self.payment_dates = pd.DatetimeIndex(self.payment_dates)
-        self.underlying.time_grid = None
-        self.underlying.instrument_values = None
-        self.underlying.special_dates.extend(
-            self.payment_dates.to_pydatetime())
+        # provide selected dates to underlying, existing paths are
+        # refined instead of simulated again
+        self.underlying.insert_dates(
+            [self.pricing_date, self.effective_date, self.payment_date,
+             self.termination_date] + list(self.payment_dates.to_pydatetime()))
 
     def generate_payoff(self, fixed_seed=True):
         ''' Generates the IRS payoff for simulated underlyin values. '''
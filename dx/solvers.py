@@ -0,0 +1,259 @@
+#
+# DX Analytics
+# Root Finding Functions
+# solvers.py
+#
+import numpy as np
+import scipy.optimize as sco
+
+__all__ = ['solver_result', 'newton', 'brent', 'newton_vectorized']
+
+
+class solver_result(object):
+    ''' Class to record the outcome of a root finding run.
+    Attributes
+    ==========
+    root : float or array
+        estimated root(s)
+    iterations : int
+        number of iterations performed
+    function_calls : int
+        number of evaluations of the objective function
+    derivative_calls : int
+        number of evaluations of the (first and second) derivatives
+    converged : boolean or array
+        True if the tolerance was met within the iteration limit
+    method : string
+        name of the algorithm used
+    '''
+
+    def __init__(self, method):
+        self.method = method
+        self.root = None
+        self.iterations = 0
+        self.function_calls = 0
+        self.derivative_calls = 0
+        self.converged = False
+
+    def __repr__(self):
+        return ('solver_result(method=%s, root=%s, iterations=%d, '
+                'function_calls=%d, derivative_calls=%d, converged=%s)'
+                % (self.method, self.root, self.iterations,
+                   self.function_calls, self.derivative_calls,
+                   self.converged))
+
+
+def newton(func, x0, fprime=None, fprime2=None, bracket=None, tol=1e-10,
+           maxiter=100, full_output=False):
+    ''' Safeguarded Newton-Raphson / Halley root finder.
+    Parameters
+    ==========
+    func : callable
+        function f(x) to find the root of
+    x0 : float
+        initial guess
+    fprime : callable
+        analytic first derivative f'(x); if None the secant method is
+        used, costing one function evaluation per iteration
+    fprime2 : callable
+        analytic second derivative f''(x); if given (together with fprime)
+        Halley's method is used
+    bracket : tuple (a, b)
+        interval with a sign change of f; steps leaving the interval or
+        not halving the step before last are replaced by bisection steps
+        (as in rtsafe), so the bracket shrinks at least linearly
+    tol : float
+        absolute tolerance on the step size
+    maxiter : int
+        maximum number of iterations
+    full_output : boolean
+        if True return (root, solver_result) instead of root only
+    Results
+    =======
+    root : float
+        estimated root
+    '''
+    if fprime is None:
+        method = 'secant'
+    elif fprime2 is None:
+        method = 'newton'
+    else:
+        method = 'halley'
+    res = solver_result(method)
+
+    lo = hi = None
+    if bracket is not None:
+        a, b = bracket
+        fa, fb = func(a), func(b)
+        res.function_calls += 2
+        if fa == 0:
+            return _finish(res, a, True, full_output)
+        if fb == 0:
+            return _finish(res, b, True, full_output)
+        if np.sign(fa) == np.sign(fb):
+            raise ValueError('Root not bracketed by (%s, %s).' % (a, b))
+        # orient so that f(lo) < 0 < f(hi)
+        lo, hi = (a, b) if fa < 0 else (b, a)
+        if not min(a, b) < x0 < max(a, b):
+            x0 = 0.5 * (a + b)
+
+    x = x0
+    fx = func(x)
+    res.function_calls += 1
+    x_prev = f_prev = None
+    if lo is not None:
+        # lengths of the last two steps
+        step = step_old = abs(hi - lo)
+    for it in range(1, maxiter + 1):
+        res.iterations = it
+        if fx == 0:
+            return _finish(res, x, True, full_output)
+        if lo is not None:
+            if fx < 0:
+                lo = x
+            else:
+                hi = x
+
+        x_new = None
+        if method == 'secant':
+            if x_prev is None:
+                # start the secant iteration with a small perturbation
+                x_new = x + 1e-4 * (abs(x) + 1e-4)
+            elif fx != f_prev:
+                x_new = x - fx * (x - x_prev) / (fx - f_prev)
+        else:
+            d1 = fprime(x)
+            res.derivative_calls += 1
+            if d1 != 0 and method == 'halley':
+                d2 = fprime2(x)
+                res.derivative_calls += 1
+                denom = 2 * d1 ** 2 - fx * d2
+                x_new = x - (2 * fx * d1 / denom if denom != 0 else fx / d1)
+            elif d1 != 0:
+                x_new = x - fx / d1
+
+        if lo is not None:
+            # safeguard: bisect if the step fails, leaves the bracket or
+            # is not smaller than half the step before last
+            if (x_new is None or not min(lo, hi) < x_new < max(lo, hi) or
+                    abs(x_new - x) > 0.5 * step_old):
+                x_new = 0.5 * (lo + hi)
+            step_old, step = step, abs(x_new - x)
+        elif x_new is None:
+            raise RuntimeError('Zero derivative at x=%s.' % x)
+        if not np.isfinite(x_new):
+            raise RuntimeError('Non-finite iterate after %d iterations.' % it)
+
+        scale = tol * (1 + abs(x_new))
+        converged = x_prev is not None or method != 'secant'
+        converged = converged and abs(x_new - x) <= scale
+        if lo is not None and abs(hi - lo) <= scale:
+            converged = True
+        x_prev, f_prev = x, fx
+        x = x_new
+        fx = func(x)
+        res.function_calls += 1
+        if converged:
+            return _finish(res, x, True, full_output)
+    raise RuntimeError('Failed to converge after %d iterations, last '
+                       'value %s.' % (maxiter, x))
+
+
+def _finish(res, x, converged, full_output):
+    res.root = x
+    res.converged = converged
+    if full_output:
+        return x, res
+    return x
+
+
+def brent(func, a, b, tol=1e-12, maxiter=100, full_output=False):
+    ''' Brent's method on a bracketing interval (a, b).
+    Parameters
+    ==========
+    func : callable
+        function f(x) to find the root of; f(a) and f(b) must differ in sign
+    a, b : float
+        bracketing interval
+    tol : float
+        absolute tolerance
+    maxiter : int
+        maximum number of iterations
+    full_output : boolean
+        if True return (root, solver_result) instead of root only
+    Results
+    =======
+    root : float
+        estimated root
+    '''
+    root, r = sco.brentq(func, a, b, xtol=tol, maxiter=maxiter,
+                         full_output=True, disp=False)
+    res = solver_result('brent')
+    res.iterations = r.iterations
+    res.function_calls = r.function_calls
+    if not r.converged:
+        raise RuntimeError('Failed to converge after %d iterations, last '
+                           'value %s.' % (maxiter, root))
+    return _finish(res, root, True, full_output)
+
+
+def newton_vectorized(func, x0, fprime, lower=None, upper=None, tol=1e-10,
+                      maxiter=100, full_output=False):
+    ''' Newton-Raphson iteration applied element-wise to an array of
+    independent problems. Only elements that have not yet converged are
+    updated.
+    Parameters
+    ==========
+    func : callable
+        vectorized function f(x) returning an array of the shape of x
+    x0 : array
+        initial guesses
+    fprime : callable
+        vectorized analytic first derivative
+    lower, upper : float or array
+        optional bounds; iterates leaving them are moved halfway
+        towards the violated bound
+    tol : float
+        absolute tolerance on the step size
+    maxiter : int
+        maximum number of iterations
+    full_output : boolean
+        if True return (roots, solver_result) instead of roots only;
+        result.converged is a boolean array, False for elements that
+        met a zero derivative away from a root
+    Results
+    =======
+    roots : array
+        estimated roots
+    '''
+    res = solver_result('newton_vectorized')
+    x = np.array(x0, dtype=float, copy=True)
+    active = np.ones(x.shape, dtype=bool)
+    failed = np.zeros(x.shape, dtype=bool)
+    for it in range(1, maxiter + 1):
+        res.iterations = it
+        fx = func(x)
+        d1 = fprime(x)
+        res.function_calls += 1
+        res.derivative_calls += 1
+        # a zero derivative away from a root stops the element unconverged
+        stuck = active & (d1 == 0) & (fx != 0)
+        failed |= stuck
+        active &= ~stuck
+        with np.errstate(divide='ignore', invalid='ignore'):
+            step = np.where(d1 != 0, fx / d1, 0.)
+        x_new = x - np.where(active, step, 0.)
+        if lower is not None:
+            x_new = np.where(x_new <= lower, 0.5 * (x + lower), x_new)
+        if upper is not None:
+            x_new = np.where(x_new >= upper, 0.5 * (x + upper), x_new)
+        active &= ~(np.abs(x_new - x) <= tol * (1 + np.abs(x_new)))
+        active &= np.isfinite(x_new)
+        x = x_new
+        if not active.any():
+            break
+    res.root = x
+    res.converged = ~active & ~failed & np.isfinite(x)
+    if full_output:
+        return x, res
+    return x
@@ -1,3 +1,4 @@
+import re
 from ..frame import *
 from ..models import *
 from .single_risk import *
@@ -93,12 +94,16 @@ class derivatives_portfolio(object):
         returns a pandas DataFrame object with portfolio statistics
     get_port_risk :
         estimates sensitivities for point-wise parameter shocks
+    get_observation_dates :
+        returns the dates of an underlying the positions need
     '''
 
     def __init__(self, name, positions, val_env, risk_factors, correlations=None, fixed_seed=False, parallel=False):
         self.name = name
         self.positions = positions
-        self.val_env = val_env
+        # the portfolio works on its own layers, the environments
+        # passed in are not changed
+        self.val_env = val_env.derive()
         self.risk_factors = risk_factors
         self.underlyings = set()
         if correlations is None or correlations is False:
@@ -139,7 +144,8 @@ class derivatives_portfolio(object):
         # & sort dates in time_grid
         time_grid = sorted(set(time_grid))
 
-        self.time_grid = np.array(time_grid)
+        # one shared grid object for all underlyings and positions
+        self.time_grid = simulation_time_grid(time_grid)
         self.val_env.add_list('time_grid', self.time_grid)
 
         # taking care of correlations
@@ -174,26 +180,39 @@ class derivatives_portfolio(object):
         for asset in self.underlyings:
             rn_set[asset] = ul_list.index(asset)
 
-        # random numbers array, to be used by
-        # all underlyings (if correlations exist)
-        random_numbers = sn_random_numbers(
-            (len(rn_set),
-             len(self.time_grid),
-             self.val_env.constants['paths']),
-            fixed_seed=self.fixed_seed)
-        
+        # one independent stream per underlying from the shared service
+        service = get_random_number_service(self.val_env)
+        self.val_env.add_constant('random_number_service', service)
+
         # adding all to valuation environment which is
         # to be shared with every underlying
         self.val_env.add_list('correlation_matrix', correlation_matrix)
         self.val_env.add_list('cholesky_matrix', cholesky_matrix)
-        self.val_env.add_list('random_numbers', random_numbers)
         self.val_env.add_list('rn_set', rn_set)
+        if self.correlations is not None:
+            # correlated numbers of all underlyings, drawn lazily in blocks
+            # of 'shock_block_steps' steps for the simulated paths only
+            self.val_env.add_list(
+                'correlated_shocks', correlated_shock_generator(
+                    cholesky_matrix,
+                    block_steps=self.val_env.constants.get(
+                        'shock_block_steps', None),
+                    service=service, factors=ul_list,
+                    shape=(len(self.time_grid),
+                           self.val_env.constants['paths']),
+                    fixed_seed=self.fixed_seed,
+                    dtype=self.val_env.constants.get('dtype', np.float64),
+                    times=get_year_deltas(self.time_grid)))
 
         for asset in self.underlyings:
             # select market environment of asset
-            mar_env = self.risk_factors[asset]
+            mar_env = self.risk_factors[asset].derive()
             # add valuation environment to market environment
-            mar_env.add_environment(val_env)
+            mar_env.add_environment(self.val_env)
+            # only the dates the positions need are stored
+            observation_dates = self.get_observation_dates(asset)
+            if observation_dates is not None:
+                mar_env.add_list('observation_dates', observation_dates)
             # select the right simulation class
             model = models[mar_env.constants['model']]
             # instantiate simulation object
@@ -207,7 +226,7 @@ class derivatives_portfolio(object):
             # select right valuation class (European, American)
             val_class = otypes[positions[pos].otype]
             # pick the market environment and add the valuation environment
-            mar_env = positions[pos].mar_env
+            mar_env = positions[pos].mar_env.derive()
             mar_env.add_environment(self.val_env)
             # instantiate valuation class single risk vs. multi risk
             if self.positions[pos].otype[-5:] == 'multi':
@@ -228,6 +247,27 @@ class derivatives_portfolio(object):
                         positions[pos].underlyings[0]],
                     payoff_func=positions[pos].payoff_func)
 
+    def get_observation_dates(self, asset):
+        ''' Returns the dates of the paths of an underlying that the
+        positions on it need or None if all dates are needed. Those are
+        the maturities plus the optional list 'observation_dates' of a
+        position (e.g. averaging dates); American exercise and payoffs
+        using the whole path need all dates. '''
+        dates = set()
+        for pos in self.positions.values():
+            if asset not in pos.underlyings:
+                continue
+            if pos.otype.startswith('American'):
+                return None
+            try:
+                dates.update(pos.mar_env.get_list('observation_dates'))
+            except KeyError:
+                if re.search(r'\b(mean_value|max_value|min_value|'
+                             r'instrument_values)\b', pos.payoff_func):
+                    return None
+            dates.add(pos.mar_env.get_constant('maturity'))
+        return sorted(dates)
+
     def get_positions(self):
         ''' Convenience method to get information about
         all derivatives positions in a portfolio. '''
@@ -59,6 +59,8 @@ class valuation_class_multi(object):
             self.instrument_values = {}
             try:
                 self.time_grid = self.val_env.get_curve('time_grid')
+                if not isinstance(self.time_grid, simulation_time_grid):
+                    self.time_grid = simulation_time_grid(self.time_grid)
             except:
                 self.time_grid = None
             self.correlation_matrix = None
@@ -95,44 +97,39 @@ class valuation_class_multi(object):
                 for asset in self.risk_factors:
                     rn_set[asset] = ul_list.index(asset)
 
-                # random numbers array
-                random_numbers = sn_random_numbers(
-                    (len(rn_set), len(self.time_grid),
-                     self.val_env.constants['paths']),
-                    fixed_seed=self.fixed_seed)
-
                 # adding all to valuation environment
+                service = get_random_number_service(self.val_env)
+                self.val_env.add_constant('random_number_service', service)
                 self.val_env.add_list('cholesky_matrix', cholesky_matrix)
                 self.val_env.add_list('rn_set', rn_set)
-                self.val_env.add_list('random_numbers', random_numbers)
+                # correlated numbers of all underlyings, drawn lazily
+                self.val_env.add_list(
+                    'correlated_shocks', correlated_shock_generator(
+                        cholesky_matrix,
+                        block_steps=self.val_env.constants.get(
+                            'shock_block_steps', None),
+                        service=service, factors=ul_list,
+                        shape=(len(self.time_grid),
+                               self.val_env.constants['paths']),
+                        fixed_seed=self.fixed_seed,
+                        dtype=self.val_env.constants.get('dtype',
+                                                         np.float64),
+                        times=get_year_deltas(self.time_grid)))
             self.generate_underlying_objects()
 
     def generate_time_grid(self):
         ''' Generates time grid for all relevant objects. '''
         start = self.val_env.get_constant('starting_date')
         end = self.val_env.get_constant('final_date')
-        maturity = self.maturity
-        time_grid = pd.date_range(start=start, end=end,
-                                  freq=self.val_env.get_constant('frequency')
-                                  ).to_pydatetime()
-        if start in time_grid and end in time_grid and \
-                maturity in time_grid:
-            self.time_grid = time_grid
-        else:
-            time_grid = list(time_grid)
-            if maturity not in time_grid:
-                time_grid.insert(0, maturity)
-            if start not in time_grid:
-                time_grid.insert(0, start)
-            if end not in time_grid:
-                time_grid.append(end)
-            time_grid.sort()
-            self.time_grid = np.array(time_grid)
+        # shared (cached) grid including the maturity
+        self.time_grid = get_time_grid(
+            start, end, self.val_env.get_constant('frequency'),
+            [self.maturity])
         self.val_env.add_curve('time_grid', self.time_grid)
 
     def generate_underlying_objects(self):
         for asset in self.risk_factors:
-            mar_env = self.risk_factors[asset]
+            mar_env = self.risk_factors[asset].derive()
             mar_env.add_environment(self.val_env)
             model = models[mar_env.constants['model']]
             if self.correlations is not None:
@@ -293,24 +290,30 @@ class valuation_mcs_european_multi(valuation_class_multi):
         returns payoffs given the paths and the payoff function
     present_value :
         returns present value (Monte Carlo estimator)
+    estimate_present_value :
+        returns the online estimator of a block by block valuation
     '''
 
-    def generate_payoff(self, fixed_seed=True):
-        self.get_instrument_values(fixed_seed=True)
-        paths = {key: name.instrument_values for key, name in self.underlying_objects.items()}
-        time_grid = self.time_grid
-        try:
-            time_index = np.where(time_grid == self.maturity)[0]
-            time_index = int(time_index)
-        except:
-            print('Maturity date not in time grid of underlying.')
+    def generate_payoff(self, fixed_seed=True, paths=None):
+        if paths is None:
+            self.get_instrument_values(fixed_seed=True)
+            paths = {key: name.instrument_values for key, name
+                     in self.underlying_objects.items()}
         maturity_value = {}
         mean_value = {}
         max_value = {}
         min_value = {}
         for key in paths:
+            # the underlyings may store different (observation) dates
+            time_grid = self.underlying_objects[key].value_grid
+            try:
+                time_index = time_grid.get_index(self.maturity)
+            except KeyError:
+                raise ValueError('Maturity date not in time grid of '
+                                 'underlying %s.' % key)
             maturity_value[key] = paths[key][time_index]
-            mean_value[key] = np.mean(paths[key][:time_index], axis=1)
+            mean_value[key] = np.mean(paths[key][:time_index], axis=1,
+                                     dtype=np.float64)
             max_value[key] = np.amax(paths[key][:time_index], axis=1)
             min_value[key] = np.amin(paths[key][:time_index], axis=1)
         try:
@@ -319,17 +322,52 @@ class valuation_mcs_european_multi(valuation_class_multi):
         except:
             print('Error evaluating payoff function.')
 
-    def present_value(self, accuracy=3, fixed_seed=True, full=False):
+    def present_value(self, accuracy=3, fixed_seed=True, full=False,
+                      block_size=None):
+        if block_size is not None:
+            # paths generated and valued block by block in constant memory
+            if full:
+                raise ValueError('Full output is not available when '
+                                 'valuing in blocks.')
+            estimator = self.estimate_present_value(block_size, fixed_seed)
+            return round(estimator.mean(), accuracy)
+
         cash_flow = self.generate_payoff(fixed_seed)
 
         discount_factor = self.discount_curve.get_discount_factors(self.time_grid, self.paths)[1][0]
 
-        result = np.sum(discount_factor * cash_flow) / len(cash_flow)
+        result = np.sum(discount_factor * cash_flow,
+                        dtype=np.float64) / len(cash_flow)
         if full:
-            return round(result, accuracy), df * cash_flow
+            return round(result, accuracy), discount_factor * cash_flow
         else:
             return round(result, accuracy)
 
+    def estimate_present_value(self, block_size=None, fixed_seed=True):
+        ''' Generates the paths of all risk factors block by block and
+        returns the online_estimator of the discounted payoffs. '''
+        stochastic = isinstance(self.discount_curve, stochastic_short_rate)
+        if not stochastic:
+            discount_factor = self.discount_curve.get_discount_factors(
+                self.time_grid, self.paths)[1][0]
+        keys = list(self.underlying_objects)
+        objs = [self.underlying_objects[key] for key in keys]
+        estimator = objs[0].random_number_service.get_estimator()
+        blocks = zip(*[obj.iter_path_blocks(block_size, fixed_seed=fixed_seed)
+                       for obj in objs])
+        for block in blocks:
+            paths = dict((key, b[1]) for key, b in zip(keys, block))
+            cash_flow = self.generate_payoff(paths=paths)
+            if stochastic:
+                # short rates of the same block of paths
+                discount_factor = self.discount_curve.get_discount_factors(
+                    self.time_grid, len(cash_flow),
+                    dates=[self.time_grid[0]], path_offset=block[0][0])[1][0]
+            estimator.update(discount_factor * cash_flow, block[0][0])
+        # the risk factors no longer hold (all) instrument values
+        self.instrument_values = {}
+        return estimator
+
 
 class valuation_mcs_american_multi(valuation_class_multi):
     ''' Class to value American options with arbitrary payoff
@@ -347,9 +385,8 @@ class valuation_mcs_american_multi(valuation_class_multi):
         self.instrument_values = {key: name.instrument_values for key, name
                                   in self.underlying_objects.items()}
         try:
-            time_index_start = int(
-                np.where(self.time_grid == self.pricing_date)[0])
-            time_index_end = int(np.where(self.time_grid == self.maturity)[0])
+            time_index_start = self.time_grid.get_index(self.pricing_date)
+            time_index_end = self.time_grid.get_index(self.maturity)
         except:
             print('Pricing or maturity date not in time grid of underlying.')
         instrument_values = {}
@@ -376,15 +413,18 @@ class valuation_mcs_american_multi(valuation_class_multi):
             df = discount_factors[t] / discount_factors[t + 1]
             matrix = {}
             for asset_1 in instrument_values.keys():
-                matrix[asset_1] = instrument_values[asset_1][t]
+                # regression in float64 also for float32 paths
+                matrix[asset_1] = instrument_values[asset_1][t].astype(
+                    np.float64)
                 for asset_2 in instrument_values.keys():
-                    matrix[asset_1 + asset_2] = instrument_values[asset_1][t] \
-                        * instrument_values[asset_2][t]
-            rg = sm.OLS(V * df, np.array(list(matrix.values())).T).fit()
+                    matrix[asset_1 + asset_2] = matrix[asset_1] \
+                        * instrument_values[asset_2][t].astype(np.float64)
+            rg = sm.OLS((V * df).astype(np.float64),
+                        np.array(list(matrix.values())).T).fit()
             C = np.sum(rg.params * np.array(list(matrix.values())).T, axis=1)
             V = np.where(inner_values[t] > C, inner_values[t], V * df)
         df = discount_factors[0] / discount_factors[1]
-        result = np.sum(df * V) / len(V)
+        result = np.sum(df * V, dtype=np.float64) / len(V)
         if full:
             return round(result, accuracy), df * V
         else:
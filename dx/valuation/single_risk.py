@@ -64,8 +64,9 @@ class valuation_class_single(object):
             self.discount_curve = underlying.discount_curve
             self.payoff_func = payoff_func
             self.underlying = underlying
-            # provide pricing_date and maturity to underlying
-            self.underlying.special_dates.extend([self.pricing_date, self.maturity])
+            # provide pricing_date and maturity to underlying, existing
+            # paths are refined instead of simulated again
+            self.underlying.insert_dates([self.pricing_date, self.maturity])
         except:
             print('Error parsing market environment.')
 
@@ -79,10 +80,8 @@ class valuation_class_single(object):
             self.strike = strike
         if maturity is not None:
             self.maturity = maturity
-            # add new maturity date if not in time_grid
-            if maturity not in self.underlying.time_grid:
-                self.underlying.special_dates.append(maturity)
-                self.underlying.instrument_values = None
+            # add new maturity date to the (stored dates of the) paths
+            self.underlying.insert_dates([maturity])
 
     def delta(self, interval=None, accuracy=4):
         ''' Returns the delta for the derivative. '''
@@ -202,30 +201,39 @@ class valuation_mcs_european_single(valuation_class_single):
         returns payoffs given the paths and the payoff function
     present_value :
         returns present value (Monte Carlo estimator)
+    estimate_present_value :
+        returns the online estimator of a block by block valuation
+    standard_error :
+        returns the standard error of the present value estimator
     '''
 
-    def generate_payoff(self, fixed_seed=False):
+    def generate_payoff(self, fixed_seed=False, paths=None):
         '''
         Attributes
         ==========
         fixed_seed : boolean
             used same/fixed seed for valued
+        paths : array
+            simulated paths to use (e.g. one block of paths);
+            default: all paths of the underlying
         '''
         try:
             # strike defined?
             strike = self.strike
         except:
             pass
-        paths = self.underlying.get_instrument_values(fixed_seed=fixed_seed)
-        time_grid = self.underlying.time_grid
+        if paths is None:
+            paths = self.underlying.get_instrument_values(
+                fixed_seed=fixed_seed)
+        time_grid = self.underlying.value_grid
         try:
-            time_index = np.where(time_grid == self.maturity)[0]
-            time_index = int(time_index)
+            time_index = time_grid.get_index(self.maturity)
         except:
             print('Maturity date not in time grid of underlying.')
         maturity_value = paths[time_index]
         # average value over whole path
-        mean_value = np.mean(paths[:time_index], axis=1)
+        mean_value = np.mean(paths[:time_index], axis=1,
+                             dtype=np.float64)
         # maximum value over whole path
         max_value = np.amax(paths[:time_index], axis=1)[-1]
         # minimum value over whole path
@@ -236,7 +244,8 @@ class valuation_mcs_european_single(valuation_class_single):
         except:
             print('Error evaluating payoff function.')
 
-    def present_value(self, accuracy=6, fixed_seed=False, full=False):
+    def present_value(self, accuracy=6, fixed_seed=False, full=False,
+                      block_size=None):
         '''
         Attributes
         ==========
@@ -244,19 +253,82 @@ class valuation_mcs_european_single(valuation_class_single):
             number of decimals in returned result
         fixed_seed :
             used same/fixed seed for valuation
+        block_size : int
+            if given, the paths are generated and valued block by block
+            in constant memory (see estimate_present_value)
         '''
+        if block_size is not None:
+            if full:
+                raise ValueError('Full output is not available when '
+                                 'valuing in blocks.')
+            estimator = self.estimate_present_value(block_size, fixed_seed)
+            return round(estimator.mean(), accuracy)
+
         cash_flow = self.generate_payoff(fixed_seed=fixed_seed)
 
         discount_factor = self.discount_curve.get_discount_factors(
             self.underlying.time_grid, self.paths)[1][0]
 
-        result = np.sum(discount_factor * cash_flow) / len(cash_flow)
+        result = np.sum(discount_factor * cash_flow,
+                        dtype=np.float64) / len(cash_flow)
 
         if full:
             return round(result, accuracy), discount_factor * cash_flow
         else:
             return round(result, accuracy)
 
+    def estimate_present_value(self, block_size=None, fixed_seed=False):
+        '''
+        Attributes
+        ==========
+        block_size : int
+            number of paths per block (default: random number block size)
+        fixed_seed :
+            used same/fixed seed for valuation
+
+        generates the paths of the underlying block by block and returns
+        the online_estimator of the discounted payoffs
+        '''
+        if self.underlying.time_grid is None:
+            self.underlying.generate_time_grid()
+        time_grid = self.underlying.time_grid
+        stochastic = isinstance(self.discount_curve, stochastic_short_rate)
+        if not stochastic:
+            discount_factor = self.discount_curve.get_discount_factors(
+                time_grid, self.paths)[1][0]
+        estimator = self.underlying.random_number_service.get_estimator()
+        for offset, paths in self.underlying.iter_path_blocks(
+                block_size, fixed_seed=fixed_seed):
+            cash_flow = self.generate_payoff(paths=paths)
+            if stochastic:
+                # short rates of the same block of paths
+                discount_factor = self.discount_curve.get_discount_factors(
+                    time_grid, len(cash_flow), dates=[time_grid[0]],
+                    path_offset=offset)[1][0]
+            estimator.update(discount_factor * cash_flow, offset)
+        return estimator
+
+    def standard_error(self, accuracy=6, fixed_seed=False, block_size=None):
+        '''
+        Attributes
+        ==========
+        accuracy : int
+            number of decimals in returned result
+        fixed_seed :
+            used same/fixed seed for valuation
+        block_size : int
+            if given, the paths are valued block by block
+
+        for Sobol sampling the error is estimated from the independent
+        randomized QMC replicates, otherwise from the path sample
+        '''
+        if block_size is not None:
+            estimator = self.estimate_present_value(block_size, fixed_seed)
+            return round(estimator.standard_error(), accuracy)
+        pv = self.present_value(fixed_seed=fixed_seed, full=True)[1]
+        service = self.underlying.random_number_service
+        return round(service.get_standard_error(pv), accuracy)
+
 
 class valuation_mcs_american_single(valuation_class_single):
     ''' Class to value American options with arbitrary payoff
@@ -282,10 +354,10 @@ class valuation_mcs_american_single(valuation_class_single):
         except:
             pass
         paths = self.underlying.get_instrument_values(fixed_seed=fixed_seed)
-        time_grid = self.underlying.time_grid
+        time_grid = self.underlying.value_grid
         try:
-            time_index_start = int(np.where(time_grid == self.pricing_date)[0])
-            time_index_end = int(np.where(time_grid == self.maturity)[0])
+            time_index_start = time_grid.get_index(self.pricing_date)
+            time_index_end = time_grid.get_index(self.maturity)
         except:
             print('Maturity date not in time grid of underlying.')
         instrument_values = paths[time_index_start:time_index_end + 1]
@@ -307,7 +379,7 @@ class valuation_mcs_american_single(valuation_class_single):
             number of basis functions for regression
         '''
         instrument_values, inner_values, time_index_start, time_index_end = self.generate_payoff(fixed_seed=fixed_seed)
-        time_list = self.underlying.time_grid[time_index_start:time_index_end + 1]
+        time_list = self.underlying.value_grid[time_index_start:time_index_end + 1]
 
         discount_factors = self.discount_curve.get_discount_factors(time_list, self.paths, dtobjects=True)[1]
 
@@ -315,16 +387,18 @@ class valuation_mcs_american_single(valuation_class_single):
         for t in range(len(time_list) - 2, 0, -1):
             # derive relevant discount factor for given time interval
             df = discount_factors[t] / discount_factors[t + 1]
-            # regression step
-            rg = np.polyfit(instrument_values[t], V * df, bf)
+            # regression step, in float64 also for float32 paths
+            # (the powers of the basis are badly conditioned otherwise)
+            x = instrument_values[t].astype(np.float64)
+            rg = np.polyfit(x, (V * df).astype(np.float64), bf)
             # calculation of continuation values per path
-            C = np.polyval(rg, instrument_values[t])
+            C = np.polyval(rg, x)
             # optimal decision step:
             # if condition is satisfied (inner value > regressed cont. value)
             # then take inner value; take actual cont. value otherwise
             V = np.where(inner_values[t] > C, inner_values[t], V * df)
         df = discount_factors[0] / discount_factors[1]
-        result = np.sum(df * V) / len(V)
+        result = np.sum(df * V, dtype=np.float64) / len(V)
         if full:
             return round(result, accuracy), df * V
         else:
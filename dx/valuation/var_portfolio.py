@@ -30,7 +30,9 @@ class var_derivatives_portfolio(derivatives_portfolio):
                  fixed_seed=False, parallel=False):
         self.name = name
         self.positions = positions
-        self.val_env = val_env
+        # the portfolio works on its own layers, the environments
+        # passed in are not changed
+        self.val_env = val_env.derive()
         self.var_risk_factors = var_risk_factors
         self.underlyings = set()
 
@@ -68,7 +70,8 @@ class var_derivatives_portfolio(derivatives_portfolio):
         # delete duplicate entries & sort dates in time_grid
         time_grid = sorted(set(time_grid))
 
-        self.time_grid = np.array(time_grid)
+        # one shared grid object for all underlyings and positions
+        self.time_grid = simulation_time_grid(time_grid)
         self.val_env.add_list('time_grid', self.time_grid)
 
         #
@@ -90,7 +93,7 @@ class var_derivatives_portfolio(derivatives_portfolio):
             # select right valuation class (European, American)
             val_class = otypes[positions[pos].otype]
             # pick the market environment and add the valuation environment
-            mar_env = positions[pos].mar_env
+            mar_env = positions[pos].mar_env.derive()
             mar_env.add_environment(self.val_env)
             # instantiate valuation classes
             self.valuation_objects[pos] = \
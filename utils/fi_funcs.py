@@ -10,6 +10,7 @@ from dateutil.relativedelta import relativedelta
 
 from curves.curves import ZeroCurve
 from dx.frame import get_year_deltas
+from dx.solvers import newton
 
 FREQ_MAP = {
     'Semi-Annual' : 0.5,
@@ -45,9 +46,13 @@ def createZeroCurve(pc, trade_dt):
             for cf in rem_cfs:
                 discounted_pv += calcPV(cf[1], pc.getParRate(cf[0]), get_year_deltas([trade_dt, cf[0]])[-1])
 
-            ytm_func = lambda y: \
-                sum([c/(1+y*i._freq)**(t/i._freq) for t,c in mat_cfs]) - px + discounted_pv
-            zc.addRate(i._mat_dt, newton_raphson(ytm_func, 0.01))
+            ts = np.array([t for t, c in mat_cfs])
+            cs = np.array([c for t, c in mat_cfs])
+            freq = i._freq
+            ytm_func = lambda y: np.sum(cs * (1 + y * freq)**(-ts / freq)) - px + discounted_pv
+            # analytic derivative of the discounted maturity cash flows
+            ytm_prime = lambda y: -np.sum(cs * ts * (1 + y * freq)**(-ts / freq - 1))
+            zc.addRate(i._mat_dt, newton(ytm_func, 0.01, fprime=ytm_prime))
     return zc
 
 
@@ -234,35 +239,28 @@ def calcYieldToDate(price, par, mat_date, cpn, freq=0.5, start_date=datetime.dat
     cfs = createCashFlows(start_date, freq, mat_date, cpn, par)
     # filters for only cash flows that haven't occurred yet
     cfs = [c for c in cfs if c[0] > start_date]
-    cpn_dts = [((i[0] - start_date).days / 365, i[1]) for i in cfs]
+    ts = np.array([(i[0] - start_date).days / 365 for i in cfs])
+    cs = np.array([i[1] for i in cfs])
     
     # Need this for bullet bonds
+    # price(y) = sum(c * (1 + y * f)^(-t / f)) so dprice/dy = -sum(c * t * (1 + y * f)^(-t / f - 1))
     if freq != 0:
-        ytm_func = lambda y: \
-            sum([c/(1+y*freq)**(t/freq) for t,c in cpn_dts]) - price
+        ytm_func = lambda y: np.sum(cs * (1 + y * freq)**(-ts / freq)) - price
+        ytm_prime = lambda y: -np.sum(cs * ts * (1 + y * freq)**(-ts / freq - 1))
     else:
-        ytm_func = lambda y: \
-            sum([c/(1+y)**(t) for t,c in cpn_dts]) - price
-    return newton_raphson(ytm_func, guess)
+        ytm_func = lambda y: np.sum(cs * (1 + y)**(-ts)) - price
+        ytm_prime = lambda y: -np.sum(cs * ts * (1 + y)**(-ts - 1))
+    return newton(ytm_func, guess, fprime=ytm_prime)
 
 
 def derivative(f, x, h):
     return (f(x+h) - f(x-h)) / (2.0*h)  # might want to return a small non-zero if ==0
 
 
-def newton_raphson(func, guess, rng=0.00001):
-    try:
-        lastX = guess
-        nextX = lastX + 10* rng  # "different than lastX so loop starts OK
-        while (abs(lastX - nextX) > rng):  # this is how you terminate the loop - note use of abs()
-            newY = func(nextX)                     # just for debug... see what happens
-            # print("f(", nextX, ") = ", newY)     # print out progress... again just debug
-            lastX = nextX
-            nextX = lastX - newY / derivative(func, lastX, rng)  # update estimate using N-R
-        return nextX
-    except Exception as e:
-        pdb.set_trace()
-        print()
+def newton_raphson(func, guess, rng=0.00001, fprime=None, maxiter=100):
+    # kept for backwards compatibility, uses the shared solver in dx.solvers
+    # secant steps (one function call per iteration) unless an analytic derivative is given
+    return newton(func, guess, fprime=fprime, tol=rng, maxiter=maxiter)
     
 
 def calcSurvivalRate(time, rate):
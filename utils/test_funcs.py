@@ -3,15 +3,24 @@ sys.path.append("/home/ubuntu/workspace/finance_lib")
 import matplotlib as mpl
 mpl.use('Agg')
 import datetime, sys, pdb, math
+import multiprocessing as mp
 from math import sqrt, pi, log, e
 import matplotlib.pyplot as plt
 import pandas as pd
 import numpy as np
 import datetime as dt
+import scipy.interpolate as sci
 
 from bond.fixed_bond import FixedRateBond
-from curves.curves import ZeroCurve, ParCurve
+from bond.bond_portfolio import BondPortfolio
+from curves.curves import ZeroCurve, ParCurve, CurveHandle
+from curves.curve_builder import createZeroCurves
 from utils.fi_funcs import *
+from dx.solvers import newton_vectorized
+import dx
+from dx.analytical.stochastic_volatility import H93_call_value
+from dx.analytical.stoch_vol_jump_diffusion import B96_call_value
+from dx.analytical.black_scholes_merton import BSM_european_option
 
 
 def testBootstrap():
@@ -51,8 +60,675 @@ def testFwdCurveCreate():
     fc = zc.createFwdCurve(dt.datetime(2014,1,1))
     new_zc = fc.createSpotCurve(dt.datetime(2014,1,1))
     print()
+
+
+def testYieldSolve():
+    bond = FixedRateBond(mat_dt=dt.datetime(2024, 1, 1), freq=0.5, cpn=3, issue_dt=dt.datetime(2014, 1, 1))
+    for px in [85, 100.1, 120]:
+        ytm = bond.getYield(px, dt.datetime(2014, 1, 1))
+        print(px, ytm)
+        assert abs(bond.getPrice(ytm, dt.datetime(2014, 1, 1)) - px) < 1e-8
+
+
+def testCreateZeroCurves():
+    par_curves = {}
+    for n, trade_dt in enumerate([dt.datetime(2014, 1, 1), dt.datetime(2014, 1, 2), dt.datetime(2014, 1, 3)]):
+        for ccy, shift in [('USD', 0.), ('EUR', -1.)]:
+            insts = [FixedRateBond(mat_dt=dt.datetime(2015, 1, 1), freq=1, cpn=9, issue_dt=dt.datetime(2014, 1, 1)),
+                     FixedRateBond(mat_dt=dt.datetime(2016, 1, 1), freq=1, cpn=9.95, issue_dt=dt.datetime(2014, 1, 1)),
+                     FixedRateBond(mat_dt=dt.datetime(2017, 1, 1), freq=1, cpn=10.85, issue_dt=dt.datetime(2014, 1, 1))]
+            pxs = [100 + shift + 0.1 * n, 100 + shift, 100 + shift - 0.1 * n]
+            par_curves[(trade_dt, ccy)] = ParCurve(insts, pxs, trade_dt)
+    serial = createZeroCurves(par_curves, processes=1)
+    pooled = createZeroCurves(par_curves, processes=2, chunksize=1)
+    print(serial)
+    assert serial.equals(pooled)
+    # the same points as bootstrapping one curve after the other
+    for (trade_dt, ccy), pc in par_curves.items():
+        zc = createZeroCurve(pc, trade_dt)
+        rows = serial[(serial['trade_dt'] == trade_dt) & (serial['currency'] == ccy)]
+        assert list(rows['rate']) == list(zc.rates)
+        assert list(pd.to_datetime(rows['mat'])) == list(pd.to_datetime(zc.mats))
+
+def testCurveHandle():
+    zc = ZeroCurve([dt.datetime(2015, 1, 1), dt.datetime(2016, 1, 1)], [0.01, 0.02])
+    handle = CurveHandle(zc)
+    snap = handle.get()
+    zc.addRate(dt.datetime(2017, 1, 1), 0.03)
+    # readers holding the old snapshot are not affected by the builder
+    assert len(snap.mats) == 2
+    new_snap = handle.publish(zc)
+    assert new_snap.version > snap.version and handle.get() is new_snap
+    try:
+        new_snap.addRate(dt.datetime(2018, 1, 1), 0.04)
+        assert False
+    except ValueError:
+        pass
+
+
+def testBondPortfolio():
+    trade_dt = dt.datetime(2014, 1, 1)
+    bonds = {
+        'b1': FixedRateBond(mat_dt=dt.datetime(2016, 1, 1), freq=0.5, cpn=2, issue_dt=trade_dt),
+        'b2': FixedRateBond(mat_dt=dt.datetime(2019, 1, 1), freq=0.5, cpn=2.5, issue_dt=trade_dt),
+        'b3': FixedRateBond(mat_dt=dt.datetime(2024, 1, 1), freq=0.5, cpn=3, issue_dt=trade_dt)
+    }
+    port = BondPortfolio(trade_dt)
+    port.setPosition('b1', bonds['b1'], 10, 99.5)
+    port.setPosition('b2', bonds['b2'], 5, 99)
+    port.setPosition('b3', bonds['b3'], 20, 100.1)
+    port.trade('b1', 15)
+    port.updatePrice('b3', 98.7)
+    port.removePosition('b2')
+
+    # recompute the book from scratch and compare with the running sums
+    book = [(bonds['b1'], 25, 99.5), (bonds['b3'], 20, 98.7)]
+    mv = sum([q * px for b, q, px in book])
+    yld = sum([q * px * b.getYield(px, trade_dt) for b, q, px in book]) / mv
+    dur = sum([q * px * b.calcDurationModified(px, trade_dt) for b, q, px in book]) / mv
+    print(port.getMarketValue(), port.getYield(), port.getDuration(), port.getDV01())
+    assert abs(port.getMarketValue() - mv) < 1e-8
+    assert abs(port.getYield() - yld) < 1e-10
+    assert abs(port.getDuration() - dur) < 1e-10
+    assert abs(port.getDV01() - dur * mv * 0.0001) < 1e-8
     
 
+def testNewtonVectorized():
+    roots, res = newton_vectorized(lambda x: x ** 2 - 4, [1., 3., 0.], lambda x: 2 * x,
+                                   full_output=True)
+    print(roots, res.converged)
+    assert np.allclose(roots[:2], 2) and list(res.converged) == [True, True, False]
+    # zero derivative away from a root is not reported as converged
+    roots, res = newton_vectorized(lambda x: x ** 2 + 1, [0.], lambda x: 2 * x, full_output=True)
+    assert not res.converged[0]
+    roots, res = newton_vectorized(lambda x: x ** 2, [0.], lambda x: 2 * x, full_output=True)
+    assert res.converged[0] and roots[0] == 0
+
+
+def dxEnvironment(paths=3 * 8192, **constants):
+    ''' Market environment for the simulation tests '''
+    me = dx.market_environment('me', dt.datetime(2016, 1, 1))
+    for key, value in [('initial_value', 36.), ('volatility', 0.2), ('final_date', dt.datetime(2016, 12, 31)),
+                       ('currency', 'EUR'), ('frequency', 'QE'), ('paths', paths), ('lambda', 0.3),
+                       ('mu', -0.2), ('delta', 0.1), ('kappa', 2.), ('theta', 0.04), ('vol_vol', 0.3),
+                       ('rho', -0.5)] + list(constants.items()):
+        me.add_constant(key, value)
+    me.add_curve('discount_curve', dx.constant_short_rate('r', 0.05))
+    return me
+
+
+def testImpliedVolatility():
+    # deep in and out of the money quotes need the bisection steps of the bracketed Newton
+    for strike, vol, otype in [(300., 0.05, 'call'), (20., 0.05, 'put'), (1000., 0.2, 'call'),
+                               (20., 0.5, 'call'), (300., 0.5, 'put'), (100., 4., 'call')]:
+        me = dx.market_environment('me', dt.datetime(2016, 1, 1))
+        for key, value in [('initial_value', 100.), ('strike', strike), ('maturity', dt.datetime(2017, 1, 1)),
+                           ('currency', 'EUR'), ('volatility', vol)]:
+            me.add_constant(key, value)
+        me.add_curve('discount_curve', dx.constant_short_rate('r', 0.05))
+        option = BSM_european_option('option', me)
+        price = option.call_value() if otype == 'call' else option.put_value()
+        iv = option.imp_vol(price, otype)
+        print(strike, vol, otype, price, iv)
+        assert abs(iv - vol) < 1e-8
+
+def testZeroCurveShortRate():
+    pricing_date = dt.datetime(2014, 1, 1)
+    mats = [dt.datetime(2014, 7, 1), dt.datetime(2015, 1, 1), dt.datetime(2017, 1, 1), dt.datetime(2024, 1, 1)]
+    zc = ZeroCurve(mats, [0.01, 0.012, 0.02, 0.031])
+    curve = dx.zero_curve_short_rate('zc', zc, pricing_date)
+    # discount factors from the last date back to the pricing date and the node dates
+    time_list = np.array([pricing_date] + mats)
+    dfs = curve.get_discount_factors(time_list)[1]
+    expected = [zc.getDF(pricing_date, mats[-1]) / (zc.getDF(pricing_date, d) if d > pricing_date else 1.)
+                for d in time_list]
+    print(dfs, expected)
+    assert np.allclose(dfs, expected, rtol=1e-12)
+    # the forward rates are the log derivatives of the discount factors (between the nodes)
+    h = 1e-5
+    for t in [0.2, 0.7, 2.5, 6.]:
+        forward_rate = curve.get_forward_rates([t], dtobjects=False)[1][0]
+        df = curve.get_discount_factors([t - h, t + h], dtobjects=False)[1][0]
+        assert abs(forward_rate + np.log(df) / (2 * h)) < 1e-8
+
+def testYearDeltas():
+    dates = [dt.datetime(2016, 1, 1), dt.datetime(2016, 3, 1), dt.datetime(2016, 7, 1), dt.datetime(2017, 1, 1)]
+    expected = np.array([(d - dates[0]).days / 365. for d in dates])
+    grid = np.array(dates)
+    deltas = dx.get_year_deltas(grid)
+    assert np.array_equal(deltas, expected) and not deltas.flags.writeable
+    # cached per grid object
+    assert dx.get_year_deltas(grid) is deltas
+    index = pd.DatetimeIndex(dates)
+    assert np.array_equal(dx.get_year_deltas(index), expected) and dx.get_year_deltas(index) is dx.get_year_deltas(index)
+    # in place changes of the grid (also of inner dates) are seen
+    grid[1] = dt.datetime(2016, 2, 1)
+    assert dx.get_year_deltas(grid)[1] == 31 / 365.
+    # new grids, which may reuse the ids of collected ones, get their own year fractions
+    for n in range(50):
+        grid = np.array([dates[0], dates[0] + dt.timedelta(days=n + 1), dates[-1], dates[-1] + dt.timedelta(days=1)])
+        assert dx.get_year_deltas(grid)[1] == (n + 1) / 365.
+        del grid
+
+def testDeterministicShortRate():
+    yields = [(dt.datetime(2016, 1, 1), 0.01), (dt.datetime(2016, 7, 1), 0.015), (dt.datetime(2017, 1, 1), 0.02),
+              (dt.datetime(2018, 1, 1), 0.025), (dt.datetime(2021, 1, 1), 0.03)]
+    curve = dx.deterministic_short_rate('r', yields)
+
+    def discount_factors(time_list):
+        # the former implementation: spline fitted per call, nested loop over the dates
+        dlist = dx.get_year_deltas(time_list)
+        spline = sci.splrep(dx.get_year_deltas([y[0] for y in yields]), [y[1] for y in yields],
+                            k=1 if len(time_list) <= 3 else 3)
+        forward_rate = sci.splev(dlist, spline) + sci.splev(dlist, spline, der=1) * dlist
+        factors = []
+        for no in range(len(dlist)):
+            factor = 0.0
+            for d in range(no, len(dlist) - 1):
+                factor += (dlist[d + 1] - dlist[d]) * (0.5 * (forward_rate[d + 1] + forward_rate[d]))
+            factors.append(np.exp(-factor))
+        return np.array(factors)
+    time_lists = [np.array(dx.get_time_grid(dt.datetime(2016, 1, 1), dt.datetime(2020, 6, 30), 'ME')),
+                  [dt.datetime(2016, 1, 1), dt.datetime(2017, 3, 1)],
+                  [dt.datetime(2016, 2, 1), dt.datetime(2016, 5, 1), dt.datetime(2019, 1, 1)],
+                  list(dx.get_time_grid(dt.datetime(2016, 3, 1), dt.datetime(2017, 3, 1), 'W'))]
+    batch = curve.get_discount_factors_batch(time_lists)
+    for time_list, (tl, factors) in zip(time_lists, batch):
+        expected = discount_factors(time_list)
+        print(len(time_list), np.abs(curve.get_discount_factors(time_list)[1] - expected).max())
+        assert np.allclose(curve.get_discount_factors(time_list)[1], expected, rtol=1e-14, atol=0)
+        assert tl is time_list and np.allclose(factors, expected, rtol=1e-14, atol=0)
+
+def testStochasticShortRate():
+    curve = dx.stochastic_short_rate('r', dxEnvironment(paths=2000, initial_value=0.03, volatility=0.1))
+    time_list = np.array(dx.get_time_grid(dt.datetime(2016, 1, 1), dt.datetime(2017, 6, 30), 'ME'))
+    forward_rate = curve.get_forward_rates(time_list, 2000)[1]
+    # the former nested loop over the dates
+    dlist = dx.get_year_deltas(time_list)
+    expected = []
+    for no in range(len(dlist)):
+        factor = np.zeros_like(forward_rate[0, :])
+        for d in range(no, len(dlist) - 1):
+            factor += (dlist[d + 1] - dlist[d]) * (0.5 * (forward_rate[d + 1] + forward_rate[d]))
+        expected.append(np.exp(-factor))
+    expected = np.array(expected)
+    factors = curve.get_discount_factors(time_list, 2000)[1]
+    assert np.allclose(factors, expected, rtol=1e-13, atol=0)
+    assert np.allclose(curve.get_discount_factors(dlist, 2000, dtobjects=False)[1], expected, rtol=1e-13, atol=0)
+    factors = curve.get_discount_factors(time_list, 2000, dtype=np.float32)[1]
+    assert factors.dtype == np.float32 and np.allclose(factors, expected, rtol=1e-6, atol=0)
+    dates = [time_list[6], time_list[0], time_list[6]]
+    rows, factors = curve.get_discount_factors(time_list, 2000, dates=dates)
+    assert rows is dates and np.allclose(factors, expected[[6, 0, 6]], rtol=1e-13, atol=0)
+    factors = curve.get_discount_factors(time_list, 2000, dtype=np.float32, dates=dates)[1]
+    assert factors.dtype == np.float32 and np.allclose(factors, expected[[6, 0, 6]], rtol=1e-6, atol=0)
+
+def testMarketEnvironment():
+    base = dx.market_environment('base', dt.datetime(2016, 1, 1))
+    base.add_constant('volatility', 0.2)
+    base.add_constant('initial_value', 36.)
+    base.add_list('dates', [dt.datetime(2016, 6, 30)])
+    base.add_curve('discount_curve', dx.constant_short_rate('r', 0.05))
+    child = base.derive('stress')
+    grandchild = child.derive()
+    assert (child.name, child.pricing_date, grandchild.name) == ('stress', base.pricing_date, 'stress')
+    # keys not set locally come from the parents
+    assert grandchild.get_constant('volatility') == 0.2 and grandchild.get_curve('discount_curve').short_rate == 0.05
+    # writes of a child leave the parent untouched
+    version = base.version
+    child.add_constant('volatility', 0.3)
+    child.add_list('dates', [])
+    child.add_curve('discount_curve', dx.constant_short_rate('r', 0.06))
+    assert base.get_constant('volatility') == 0.2 and base.get_list('dates') == [dt.datetime(2016, 6, 30)]
+    assert base.get_curve('discount_curve').short_rate == 0.05 and base.version == version
+    assert grandchild.get_constant('volatility') == 0.3 and grandchild.get_constant('initial_value') == 36.
+    other = dx.market_environment('other', dt.datetime(2016, 1, 1))
+    other.add_constant('paths', 1000)
+    grandchild.add_environment(other)
+    assert grandchild.get_constant('paths') == 1000
+    assert 'paths' not in child.constants and 'paths' not in base.constants
+    # versions increase with every change, of the environment or of its parents
+    versions = [grandchild.version]
+    base.add_constant('initial_value', 40.)
+    versions.append(grandchild.version)
+    assert grandchild.get_constant('initial_value') == 40.
+    del child.constants['volatility']
+    versions.append(grandchild.version)
+    assert grandchild.get_constant('volatility') == 0.2
+    grandchild.add_constant('strike', 40.)
+    versions.append(grandchild.version)
+    assert versions == sorted(set(versions))
+    assert child.version < grandchild.version
+    # reads do not change versions
+    grandchild.get_constant('strike')
+    assert grandchild.version == versions[-1]
+
+def testTimeGrid():
+    start, end, maturity = dt.datetime(2016, 1, 1), dt.datetime(2016, 12, 31), dt.datetime(2016, 5, 17)
+    grid = dx.get_time_grid(start, end, 'ME', [maturity, dt.datetime(2015, 1, 1)])
+    assert grid[0] == start and grid[-1] == end and maturity in grid and dt.datetime(2015, 1, 1) not in grid
+    assert list(grid) == sorted(grid)
+    # O(1) lookup by datetime, Timestamp and datetime64 keys
+    i = list(grid).index(maturity)
+    for key in [maturity, pd.Timestamp(maturity), np.datetime64(maturity), pd.Timestamp(maturity).to_datetime64()]:
+        assert grid.get_index(key) == i and key in grid
+    try:
+        grid.get_index(dt.datetime(2016, 5, 18))
+        assert False
+    except KeyError:
+        pass
+    # the year fractions of the grid are reused, not recomputed
+    assert dx.get_year_deltas(grid) is grid.year_fractions
+    assert np.array_equal(grid.year_fractions, dx.get_year_deltas(list(grid)))
+    assert not dx.get_year_deltas(grid, day_count=360.) is grid.year_fractions
+    # equal grids are one shared, immutable object
+    assert dx.get_time_grid(start, end, 'ME', [maturity]) is grid
+    try:
+        grid[1] = start
+        assert False
+    except ValueError:
+        pass
+    # one grid for all underlyings and positions of a portfolio
+    risk_factors = {'a': dxEnvironment(model='gbm'), 'b': dxEnvironment(model='gbm', initial_value=50.)}
+    val_env = dxEnvironment(starting_date=start, final_date=start)
+    positions = {}
+    for key, payoff in [('a', 'np.maximum(maturity_value - 36, 0)'), ('b', 'np.maximum(50 - maturity_value, 0)')]:
+        me = dxEnvironment(maturity=maturity if key == 'a' else end)
+        positions[key] = dx.derivatives_position(key, 1, [key], me, 'European single', payoff)
+    port = dx.derivatives_portfolio('port', positions, val_env, risk_factors)
+    assert maturity in port.time_grid
+    for key in ('a', 'b'):
+        assert port.underlying_objects[key].time_grid is port.time_grid
+        assert port.valuation_objects[key].underlying.time_grid is port.time_grid
+
+def testFloat32American():
+    # the LSM regression on daily float32 paths agrees with float64 (different samples)
+    values = {}
+    for dtype in (np.float64, np.float32):
+        me = dxEnvironment(paths=50000, dtype=dtype, frequency='B', maturity=dt.datetime(2016, 12, 31),
+                           strike=40.)
+        me.add_curve('discount_curve', dx.constant_short_rate('r', 0.06))
+        underlying = dx.geometric_brownian_motion('asset', me)
+        put = dx.valuation_mcs_american_single('put', underlying, me, 'np.maximum(strike - instrument_values, 0)')
+        pv, v = put.present_value(accuracy=6, fixed_seed=True, full=True)
+        values[dtype] = pv, v.std() / np.sqrt(len(v))
+    (pv64, se64), (pv32, se32) = values[np.float64], values[np.float32]
+    print(pv64, pv32, se64, se32)
+    assert abs(pv32 - pv64) < 3 * np.sqrt(se64 ** 2 + se32 ** 2)
+
+def testCorrelatedPortfolio():
+    risk_factors = {'a': dxEnvironment(initial_value=36., model='gbm', frequency='W'),
+                    'b': dxEnvironment(initial_value=50., model='gbm', frequency='W')}
+    val_env = dxEnvironment(starting_date=dt.datetime(2016, 1, 1), final_date=dt.datetime(2016, 1, 1), frequency='W')
+    positions = {}
+    for key, otype, underlyings, payoff in [
+            ('spread', 'European multi', ['a', 'b'], "np.maximum(maturity_value['b'] - maturity_value['a'] - 14, 0)"),
+            ('asian', 'European single', ['a'], 'np.maximum(mean_value - 36, 0)')]:
+        me = dxEnvironment(maturity=dt.datetime(2016, 12, 31))
+        positions[key] = dx.derivatives_position(key, 1, underlyings, me, otype, payoff)
+    corr = pd.DataFrame([[1., 0.6], [0.6, 1.]], index=['a', 'b'], columns=['a', 'b'])
+    port = dx.derivatives_portfolio('port', positions, val_env, risk_factors, correlations=corr, fixed_seed=True)
+    shocks = port.val_env.get_list('correlated_shocks')
+    a, b = port.underlying_objects['a'], port.underlying_objects['b']
+    for obj in (a, b):
+        obj.use_path_cache = False
+    # b stores only its maturity values
+    returns = [np.log(obj.get_instrument_values(fixed_seed=True)[-1]) for obj in (a, b)]
+    assert len(b.instrument_values) == 2
+    print(np.corrcoef(*returns)[0, 1])
+    assert abs(np.corrcoef(*returns)[0, 1] - 0.6) < 0.02
+    # blocked runs agree with full runs and only hold blocks of shocks
+    for key, obj in port.valuation_objects.items():
+        full = obj.present_value(accuracy=10, fixed_seed=True)
+        blocked = obj.present_value(accuracy=10, fixed_seed=True, block_size=8192)
+        print(key, full, blocked)
+        assert abs(full - blocked) < 1e-8
+        assert shocks.shocks is None
+        assert all(state['block'].shape[0] <= shocks.block_steps and state['block'].shape[1] <= 8192
+                   for state in shocks.states.values())
+    # uncorrelated portfolios do not set up correlated shocks
+    port = dx.derivatives_portfolio('port', {'asian': positions['asian']}, val_env, risk_factors)
+    try:
+        port.val_env.get_list('correlated_shocks')
+        assert False
+    except KeyError:
+        pass
+
+def testPathKernels():
+    # vectorized GBM and OU kernels against the step by step recursion on the same numbers
+    rand = np.random.default_rng(5).standard_normal((2, 262, 2000))
+    cholesky = np.linalg.cholesky(np.array([[1., 0.7], [0.7, 1.]]))
+    for model, kwargs in [(dx.geometric_brownian_motion, {}), (dx.mean_reverting_diffusion, {}),
+                          (dx.mean_reverting_diffusion, {'scheme': 'exact'})]:
+        for corr in (False, True):
+            me = dxEnvironment(paths=2000, frequency='B',
+                               initial_value=36. if model is dx.geometric_brownian_motion else 0.05)
+            if corr:
+                me.add_list('cholesky_matrix', cholesky)
+                me.add_list('random_numbers', rand)
+                me.add_list('rn_set', {'asset': 1})
+            obj = model('asset', me, corr=corr, **kwargs)
+            obj.use_path_cache = False
+            paths = obj.get_instrument_values(fixed_seed=True)
+            M, I = paths.shape
+            if corr:
+                ran = np.array([np.dot(cholesky, rand[:, t, :])[1] for t in range(M)])
+            else:
+                ran = obj.generate_random_numbers(M, I, fixed_seed=True)
+            loop = np.zeros((M, I))
+            loop[0] = obj.initial_value
+            t_grid = obj.time_grid
+            vol = obj.volatility
+            for t in range(1, M):
+                dt_ = (t_grid[t] - t_grid[t - 1]).days / 365.
+                if model is dx.geometric_brownian_motion:
+                    loop[t] = loop[t - 1] * np.exp((0.05 - 0.5 * vol ** 2) * dt_ + vol * np.sqrt(dt_) * ran[t])
+                elif kwargs == {}:
+                    loop[t] = loop[t - 1] + obj.kappa * (obj.theta - loop[t - 1]) * dt_ + vol * np.sqrt(dt_) * ran[t]
+                else:
+                    a = np.exp(-obj.kappa * dt_)
+                    c = vol * np.sqrt((1 - a ** 2) / (2 * obj.kappa))
+                    loop[t] = obj.theta + (loop[t - 1] - obj.theta) * a + c * ran[t]
+            print(model.__name__, kwargs, corr, np.abs(paths - loop).max())
+            assert np.allclose(paths, loop, rtol=1e-12, atol=1e-14)
+
+def testPathCache():
+    cache = dx.get_path_cache()
+    cache.clear()
+    yields = [(dt.datetime(2016, 1, 1), 0.01), (dt.datetime(2016, 7, 1), 0.015), (dt.datetime(2017, 1, 1), 0.02),
+              (dt.datetime(2018, 1, 1), 0.025)]
+
+    def model(curve=None):
+        me = dxEnvironment(paths=1000)
+        me.add_curve('discount_curve', curve or dx.deterministic_short_rate('r', yields))
+        return dx.geometric_brownian_motion('asset', me)
+    stats = cache.get_statistics()
+    obj = model()
+    paths = obj.get_instrument_values(fixed_seed=True)
+    # a miss, then a hit for a new object with equal parameters and an equal (new) curve
+    assert model().get_instrument_values(fixed_seed=True) is paths
+    new = cache.get_statistics()
+    assert (new['misses'], new['hits']) == (stats['misses'] + 1, stats['hits'] + 1)
+    # cached arrays are read-only
+    try:
+        paths[1, 0] = 0.
+        assert False
+    except ValueError:
+        pass
+    # changed parameters and in-place changes of the curve are misses
+    obj.update(volatility=0.3)
+    assert not np.array_equal(obj.get_instrument_values(fixed_seed=True), paths)
+    obj.update(volatility=0.2)
+    assert obj.get_instrument_values(fixed_seed=True) is paths
+    obj.discount_curve.yield_list[2, 1] = 0.03
+    obj.instrument_values = None
+    changed = obj.get_instrument_values(fixed_seed=True)
+    assert changed[-1].mean() > paths[-1].mean()
+    assert np.array_equal(changed, model(dx.deterministic_short_rate(
+        'r', yields[:2] + [(dt.datetime(2017, 1, 1), 0.03)] + yields[3:])).get_instrument_values(fixed_seed=True))
+    # least recently used entries are evicted beyond the byte budget
+    max_bytes = cache.max_bytes
+    try:
+        cache.clear()
+        cache.max_bytes = 2 * paths.nbytes + 16
+        for vol in (0.1, 0.2, 0.3):
+            obj.update(volatility=vol)
+            obj.get_instrument_values(fixed_seed=True)
+        assert cache.get_statistics()['entries'] == 2 and cache.evictions >= 1
+        obj.update(volatility=0.1)
+        misses = cache.misses
+        obj.get_instrument_values(fixed_seed=True)
+        assert cache.misses == misses + 1
+    finally:
+        cache.max_bytes = max_bytes
+        cache.clear()
+
+def testRescaledPaths():
+    # initial value bumps of homogeneous models are served by rescaling the cached paths
+    cache = dx.get_path_cache()
+    for model in (dx.geometric_brownian_motion, dx.jump_diffusion):
+        obj = model('asset', dxEnvironment(paths=5000))
+        obj.get_instrument_values(fixed_seed=True)
+        obj.update(initial_value=40.)
+        hits, misses = cache.hits, cache.misses
+        paths = obj.get_instrument_values(fixed_seed=True)
+        assert (cache.hits, cache.misses) == (hits + 1, misses)
+        fresh = model('asset', dxEnvironment(paths=5000, initial_value=40.))
+        fresh.use_path_cache = False
+        assert np.allclose(paths, fresh.get_instrument_values(fixed_seed=True), rtol=1e-13, atol=0)
+        # the delta through the cache equals the delta of new simulations
+        deltas = []
+        for use_path_cache in (True, False):
+            obj = model('asset', dxEnvironment(paths=5000))
+            obj.use_path_cache = use_path_cache
+            me = dxEnvironment(strike=36., maturity=dt.datetime(2016, 12, 31))
+            call = dx.valuation_mcs_european_single('call', obj, me, 'np.maximum(maturity_value - strike, 0)')
+            deltas.append(call.delta(accuracy=10))
+        print(model.__name__, deltas)
+        assert abs(deltas[0] - deltas[1]) < 1e-8
+
+def testBlockedJumps():
+    models = [(dx.jump_diffusion, {}), (dx.square_root_jump_diffusion, {}),
+              (dx.stoch_vol_jump_diffusion, {'scheme': 'qe'})]
+    for model, kwargs in models:
+        obj = model('jumps', dxEnvironment(), **kwargs)
+        obj.use_path_cache = False
+        obj.generate_paths(fixed_seed=True)
+        full = obj.instrument_values.copy()
+        blocks = np.concatenate([p for o, p in obj.iter_path_blocks(8192)], axis=1)
+        print(model.__name__, np.abs(full - blocks).max())
+        assert np.array_equal(full, blocks)
+
+
+def serviceBlock(offset, paths=64):
+    ''' Worker for testRandomNumberService, numbers of one block of paths '''
+    service = dx.random_number_service(seed=7, block_size=64)
+    return service.standard_normal((6, paths), 'asset', path_offset=offset)
+
+
+def testRandomNumberService():
+    service = dx.random_number_service(seed=7, block_size=64)
+    full = service.standard_normal((6, 192), 'asset')
+    # same seed, same streams (also from a new service)
+    assert np.array_equal(full, serviceBlock(0, 192))
+    assert not np.array_equal(full, dx.random_number_service(seed=8, block_size=64).standard_normal((6, 192), 'asset'))
+    # components and factors are independent streams
+    assert not np.array_equal(full, service.standard_normal((6, 192), 'asset', 'volatility'))
+    assert not np.array_equal(full, service.standard_normal((6, 192), 'other'))
+    # chunks of steps, blocks of paths and blocks from worker processes equal the serial run
+    chunks = np.concatenate(list(service.standard_normal_chunks((6, 192), 'asset', chunk_steps=4)))
+    assert np.array_equal(full, chunks)
+    blocks = [service.standard_normal((6, 64), 'asset', path_offset=o) for o in (0, 64, 128)]
+    assert np.array_equal(full, np.concatenate(blocks, axis=1))
+    with mp.Pool(2) as pool:
+        blocks = pool.map(serviceBlock, [0, 64, 128])
+    assert np.array_equal(full, np.concatenate(blocks, axis=1))
+    # blocked simulations equal full simulations
+    for model in [dx.geometric_brownian_motion, dx.stochastic_volatility, dx.mean_reverting_diffusion]:
+        me = dxEnvironment(paths=192, random_number_service=service)
+        obj = model('asset', me)
+        obj.use_path_cache = False
+        obj.generate_paths(fixed_seed=True)
+        paths = obj.instrument_values
+        blocks = np.concatenate([p for o, p in obj.iter_path_blocks(64)], axis=1)
+        assert np.array_equal(paths, blocks)
+
+
+def testSobolService():
+    me = dxEnvironment(strike=40., maturity=dt.datetime(2016, 12, 31), frequency='ME')
+    value = BSM_european_option('bsm', me).call_value()
+    # unbiased over independent scramblings, with standard errors matching the spread
+    errors, ses = [], []
+    for seed in range(20):
+        service = dx.sobol_number_service(seed=seed)
+        underlying = dx.geometric_brownian_motion('asset', dxEnvironment(
+            paths=4096, frequency='ME', random_number_service=service))
+        underlying.use_path_cache = False
+        call = dx.valuation_mcs_european_single('call', underlying, me, 'np.maximum(maturity_value - strike, 0)')
+        pv, values = call.present_value(accuracy=10, fixed_seed=True, full=True)
+        errors.append(pv - value)
+        ses.append(service.get_standard_error(values))
+    print(np.mean(errors), np.std(errors), np.mean(ses))
+    assert abs(np.mean(errors)) < 3 * np.std(errors) / np.sqrt(len(errors))
+    assert 0.5 < np.mean(ses) / np.std(errors) < 2
+    # Brownian bridge: the end point first, then midpoints between filled points
+    times = np.linspace(0, 1, 13)
+    schedule = service.get_bridge(times)
+    assert schedule[0][0] == 12 and sorted(s[0] for s in schedule) == list(range(1, 13))
+    filled = {0}
+    for m, l, r, wl, wr, sd in schedule:
+        assert m == 12 or (l in filled and r in filled and l < m < r)
+        filled.add(m)
+    # standard normal increments on an uneven grid
+    times = np.cumsum(np.r_[0, np.random.default_rng(1).uniform(0.01, 0.2, 9)])
+    ran = service.standard_normal((10, 8192), 'asset', times=times)
+    assert np.all(ran[0] == 0)
+    assert np.allclose(ran[1:].mean(axis=1), 0, atol=0.01) and np.allclose(ran[1:].std(axis=1), 1, atol=0.01)
+    # blocked runs equal full runs
+    underlying = dx.geometric_brownian_motion('asset', dxEnvironment(
+        paths=2 * service.path_block_size, random_number_service=service))
+    underlying.use_path_cache = False
+    underlying.generate_paths(fixed_seed=True)
+    full = underlying.instrument_values
+    blocks = np.concatenate([p for o, p in underlying.iter_path_blocks()], axis=1)
+    assert np.array_equal(full, blocks)
+
+def testShiftBase():
+    # the module, its name in dx.models is the class
+    srjd_module = sys.modules['dx.models.square_root_jump_diffusion']
+    dates = [dt.datetime(2016, 1, 1) + dt.timedelta(days=91 * n) for n in range(1, 13)]
+    # the analytic Jacobian against central differences
+    kts, h = np.array([1.2, 0.25, 0.4]), 1e-6
+    jac = dx.srd_forwards_jacobian(0.2, kts, dates)
+    for i in range(3):
+        up, down = kts.copy(), kts.copy()
+        up[i] += h
+        down[i] -= h
+        diff = (dx.srd_forwards(0.2, up, dates) - dx.srd_forwards(0.2, down, dates)) / (2 * h)
+        assert np.allclose(jac[:, i], diff, rtol=1e-6, atol=1e-9)
+    # least squares fit: the remaining shifts are orthogonal to the Jacobian
+    target = dx.srd_forwards(0.2, kts, dates) + 0.01 * np.sin(np.arange(12))
+    me = dxEnvironment(initial_value=0.2, paths=1000)
+    me.add_curve('term_structure', np.array(list(zip(dates, target)), dtype=object))
+    obj = dx.square_root_jump_diffusion_plus('vol', me)
+    obj.generate_shift_base((1., 0.2, 0.3))
+    shifts = obj.shift_base[:, 1].astype(float)
+    opt = obj.shift_parameters
+    assert np.allclose(target - dx.srd_forwards(0.2, opt, dates), shifts)
+    print(opt, np.dot(dx.srd_forwards_jacobian(0.2, opt, dates).T, shifts))
+    assert np.allclose(np.dot(dx.srd_forwards_jacobian(0.2, opt, dates).T, shifts), 0, atol=1e-7)
+    assert obj.srd_forward_error(opt) <= obj.srd_forward_error(kts)
+    # calibrations are cached on the term structure and initial value, up to a bounded number
+    other = dx.square_root_jump_diffusion_plus('vol', me)
+    other.generate_shift_base((1., 0.2, 0.3))
+    assert other.shift_base is obj.shift_base
+    for n in range(srjd_module._shift_base_cache_size + 5):
+        obj.initial_value = 0.2 + 0.001 * n
+        obj.generate_shift_base()
+    assert len(srjd_module._shift_base_cache) == srjd_module._shift_base_cache_size
+
+def testInsertDates():
+    new = dt.datetime(2016, 5, 17)
+    for model in [dx.geometric_brownian_motion, dx.mean_reverting_diffusion]:
+        obj = model('asset', dxEnvironment(paths=100000, initial_value=0.05 if model is dx.mean_reverting_diffusion else 36.))
+        paths = obj.get_instrument_values(fixed_seed=True).copy()
+        grid = obj.time_grid
+        assert obj.insert_dates([new]) is True
+        i = obj.time_grid.get_index(new)
+        assert len(obj.time_grid) == len(grid) + 1
+        # the values at the old dates are kept
+        assert np.array_equal(np.delete(obj.instrument_values, i, axis=0), paths)
+        # standardized values at the new date given both neighbours
+        t = obj.time_grid.year_fractions
+        dt_left, dt_right = t[i] - t[i - 1], t[i + 1] - t[i]
+        left, mid, right = obj.instrument_values[i - 1:i + 2]
+        vol = obj.volatility
+        if model is dx.geometric_brownian_motion:
+            w = dt_left / (dt_left + dt_right)
+            mean = (1 - w) * np.log(left) + w * np.log(right)
+            var = vol ** 2 * dt_left * dt_right / (dt_left + dt_right)
+            z = (np.log(mid) - mean) / np.sqrt(var)
+        else:
+            # joint normal law of (mid, right) given left
+            k, th = obj.kappa, obj.theta
+            v = lambda h: vol ** 2 * (1 - np.exp(-2 * k * h)) / (2 * k)
+            mean_mid = th + (left - th) * np.exp(-k * dt_left)
+            mean_right = th + (left - th) * np.exp(-k * (dt_left + dt_right))
+            cov = np.exp(-k * dt_right) * v(dt_left)
+            var_right = v(dt_left + dt_right)
+            mean = mean_mid + cov / var_right * (right - mean_right)
+            var = v(dt_left) - cov ** 2 / var_right
+            z = (mid - mean) / np.sqrt(var)
+        print(model.__name__, z.mean(), z.var())
+        assert abs(z.mean()) < 0.02 and abs(z.var() - 1) < 0.02
+    # dates after the last date of the grid need a new simulation
+    obj = dx.geometric_brownian_motion('asset', dxEnvironment(paths=1000))
+    obj.get_instrument_values()
+    assert obj.insert_dates([dt.datetime(2017, 2, 1)]) is False and obj.instrument_values is None
+    assert dt.datetime(2017, 2, 1) in obj.time_grid
+    assert obj.get_instrument_values().shape[0] == len(obj.time_grid)
+    # as do correlated models
+    me = dxEnvironment(paths=1000)
+    me.add_list('cholesky_matrix', np.eye(2))
+    me.add_list('random_numbers', np.random.standard_normal((2, 5, 1000)))
+    me.add_list('rn_set', {'asset': 0})
+    obj = dx.geometric_brownian_motion('asset', me, corr=True)
+    obj.get_instrument_values()
+    assert obj.insert_dates([new]) is False and obj.instrument_values is None
+
+
+def testExactSquareRootDiffusion():
+    me = dxEnvironment(paths=100000, initial_value=0.02, volatility=0.3, final_date=dt.datetime(2018, 1, 1),
+                       frequency='YE')
+    srd = dx.square_root_diffusion('rate', me, scheme='exact')
+    paths = srd.get_instrument_values(fixed_seed=True)
+    x0, k, th, vol = srd.initial_value, srd.kappa, srd.theta, srd.volatility
+    # transition moments of the CIR process from the initial value
+    for t, x in zip(srd.time_grid.year_fractions[1:], paths[1:]):
+        e = np.exp(-k * t)
+        mean = th + (x0 - th) * e
+        var = x0 * vol ** 2 / k * (e - e ** 2) + th * vol ** 2 / (2 * k) * (1 - e) ** 2
+        print(t, x.mean(), mean, x.var(), var)
+        assert abs(x.mean() - mean) < 4 * np.sqrt(var / len(x))
+        se_var = np.sqrt((np.mean((x - x.mean()) ** 4) - x.var() ** 2) / len(x))
+        assert abs(x.var() - var) < 4 * se_var
+        assert x.min() >= 0
+    # blocked runs draw the same transitions
+    srd.use_path_cache = False
+    srd.paths = 3 * 8192
+    srd.generate_paths(fixed_seed=True)
+    full = srd.instrument_values
+    blocks = np.concatenate([p for o, p in srd.iter_path_blocks(8192)], axis=1)
+    assert np.array_equal(full, blocks)
+
+
+def testQEScheme():
+    # QE on monthly steps against the semi-analytic Heston (1993) and Bates (1996) prices
+    for model, value in [(dx.stochastic_volatility, H93_call_value), (dx.stoch_vol_jump_diffusion, B96_call_value)]:
+        me = dxEnvironment(paths=100000, initial_value=100., final_date=dt.datetime(2018, 1, 1), frequency='ME',
+                           kappa=1.5, vol_vol=0.9, rho=-0.7, maturity=dt.datetime(2018, 1, 1), strike=100.)
+        underlying = model('asset', me, scheme='qe')
+        call = dx.valuation_mcs_european_single('call', underlying, me, 'np.maximum(maturity_value - strike, 0)')
+        pv, values = call.present_value(fixed_seed=True, full=True)
+        se = values.std() / np.sqrt(len(values))
+        print(model.__name__, pv, value(me), se)
+        assert abs(pv - value(me)) < 3 * se
+
+
+def testSabrJacobian():
+    # central differences, with a larger step at the money where z / x is a limit
+    for strikes, h in [(np.array([[60., 80., 99., 120., 150.]]), 1e-6), (100., 1e-3)]:
+        args = {'forward': 100., 'strike': strikes, 'expiry': np.array([[0.5], [2.]]), 'alpha': 2.,
+                'beta': 0.5, 'rho': -0.4, 'vol_vol': 0.6}
+        jac = dx.sabr_implied_vol_jacobian(**args)
+        for key in ['alpha', 'beta', 'rho', 'vol_vol', 'forward']:
+            up, down = dict(args), dict(args)
+            up[key] += h
+            down[key] -= h
+            diff = (dx.sabr_implied_vol(**up) - dx.sabr_implied_vol(**down)) / (2 * h)
+            assert np.allclose(jac[key], diff, rtol=1e-4, atol=1e-8), key
+
+
 if __name__ == '__main__':
     # testBootstrap()
     testFwdCurveCreate()
\ No newline at end of file